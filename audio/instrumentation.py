@@ -0,0 +1,238 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\audio\instrumentation.py
+import array
+import bisect
+import logging
+import time
+import discord
+from config import AUDIO_STATS_LATE_FRAME_MS, AUDIO_STATS_PIPE_SAMPLE_FRAMES
+from core.metrics import REGISTRY, MetricFamily
+
+try:
+    import fcntl
+    import termios
+except ImportError: # Windows にはないので、パイプの残量は測らないわ
+    fcntl = None
+    termios = None
+
+logger = logging.getLogger(__name__)
+
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+FRAME_SECONDS = discord.opus.Encoder.FRAME_LENGTH / 1000 # 1フレームの長さ (0.02秒)
+# read() にかかった時間と、読み出し間隔の揺れ (ジッター) のヒストグラムの区切り (秒)
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.015, 0.02, 0.04, 0.1)
+JITTER_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+_GAP_SECONDS = 0.2 # 読み出しの間がこれより空いたら一時停止とみなして、ジッターに数えない
+
+def _pipe_bytes(source: discord.AudioSource) -> int | None:
+    """FFmpegの出力パイプに溜まっているバイト数 (測れなければNone)"""
+    if fcntl is None:
+        return None
+    while source is not None:
+        stdout = getattr(source, "_stdout", None)
+        if stdout is not None:
+            try:
+                buf = array.array("i", [0])
+                fcntl.ioctl(stdout.fileno(), termios.FIONREAD, buf)
+                return buf[0]
+            except (AttributeError, OSError, ValueError): # もう片付けられたパイプなど
+                return None
+        source = getattr(source, "inner", None)
+    return None
+
+class _Histogram:
+    """
+    プレイヤーのスレッドから1フレームごとに足し込む軽いヒストグラム (ロックはしないわ)。
+    counts・total・count は増えるだけ (Prometheus にはこれを出すの)。/audiostats で見る区間の分は、
+    reset_window() のときの値を覚えておいて差を取るわ。max だけは区間の最大値よ。
+    """
+    __slots__ = ("buckets", "counts", "total", "count", "max", "_base")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+        self._base: tuple[list[int], float, int] = (list(self.counts), 0.0, 0) # 区間の始まりの counts, total, count
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def reset_window(self):
+        self._base = (list(self.counts), self.total, self.count)
+        self.max = 0.0
+
+    def window(self) -> tuple[list[int], float, int]:
+        """区間 (最後に reset_window してから) の counts, total, count"""
+        base_counts, base_total, base_count = self._base
+        return [now - base for now, base in zip(self.counts, base_counts)], self.total - base_total, self.count - base_count
+
+    def percentile(self, ratio: float) -> float | None:
+        """区間のパーセンタイルを区切りの単位でざっくり求める (秒)"""
+        counts, _, total_count = self.window()
+        if not total_count:
+            return None
+        target = total_count * ratio
+        seen = 0
+        for bound, count in zip((*self.buckets, self.max), counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def add_to(self, family: MetricFamily, **labels):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float("inf")), self.counts):
+            cumulative += count
+            family.add(cumulative, "_bucket", **labels, le="+Inf" if bound == float("inf") else repr(bound))
+        family.add(self.total, "_sum", **labels)
+        family.add(self.count, "_count", **labels)
+
+class FrameStats:
+    """
+    1ギルドの1チャンネル (音楽・声) 分の再生の統計。
+    書き込むのはプレイヤーのスレッドだけなのでロックはしないの (読む側は多少ずれても気にしないわ)。
+    数は増えるだけで、Prometheus にはそのまま出すわ。reset() は /audiostats で見る区間を区切り直すだけで、
+    summary() はその区間の分を返すの (出力しているカウンターが巻き戻らないように)。
+    """
+    _COUNTERS = ("frames", "late_frames", "short_frames", "pipe_empty_samples", "pipe_samples")
+
+    def __init__(self, guild_id: int, channel: str):
+        self.guild_id = guild_id
+        self.channel = channel
+        self.frames = 0
+        self.late_frames = 0 # read() が AUDIO_STATS_LATE_FRAME_MS より長くかかったフレーム
+        self.short_frames = 0 # 20ms分に足りないPCMしか返ってこなかったフレーム (途中で切れた音)
+        self.read_latency = _Histogram(LATENCY_BUCKETS)
+        self.jitter = _Histogram(JITTER_BUCKETS)
+        self.pipe_bytes: int | None = None # 最後に測ったFFmpegのパイプの残量
+        self.pipe_empty_samples = 0 # パイプが空だった回数 (デコードが追いついていない)
+        self.pipe_samples = 0
+        self._base = dict.fromkeys(self._COUNTERS, 0) # 区間の始まりの数
+        self.since = time.time() # 区間の始まり
+
+    def reset(self):
+        """/audiostats で見る区間を今から数え直す (カウンターそのものは戻さないわ)"""
+        self._base = {name: getattr(self, name) for name in self._COUNTERS}
+        self.read_latency.reset_window()
+        self.jitter.reset_window()
+        self.since = time.time()
+
+    def summary(self) -> dict[str, float | int | None]:
+        """区間 (最後に reset() してから) の統計"""
+        window = {name: getattr(self, name) - self._base[name] for name in self._COUNTERS}
+        _, read_total, read_count = self.read_latency.window()
+        p95 = self.read_latency.percentile(0.95)
+        jitter_p95 = self.jitter.percentile(0.95)
+        return {
+            **window,
+            "read_avg_ms": read_total / read_count * 1000 if read_count else None,
+            "read_p95_ms": p95 * 1000 if p95 is not None else None,
+            "read_max_ms": self.read_latency.max * 1000,
+            "jitter_p95_ms": jitter_p95 * 1000 if jitter_p95 is not None else None,
+            "jitter_max_ms": self.jitter.max * 1000,
+            "pipe_bytes": self.pipe_bytes,
+        }
+
+_stats: dict[tuple[int, str], FrameStats] = {}
+
+def get_frame_stats(guild_id: int, channel: str) -> FrameStats:
+    key = (guild_id, channel)
+    stats = _stats.get(key)
+    if stats is None:
+        stats = _stats[key] = FrameStats(guild_id, channel)
+    return stats
+
+def guild_frame_stats(guild_id: int) -> list[FrameStats]:
+    return [stats for (gid, _), stats in list(_stats.items()) if gid == guild_id]
+
+class InstrumentedAudioSource(discord.AudioSource):
+    """
+    read() のたびに、かかった時間・読み出し間隔の揺れ (ジッター)・短いフレームを測るラッパー。
+    数フレームに1回、FFmpegの出力パイプにどれだけ溜まっているかも見るわ (Linux/macOSのみ)。
+    測るのは perf_counter 2回と足し算くらいなので軽いけど、AUDIO_STATS_ENABLED がFalseならそもそも包まないの。
+    片付けるときに、この曲の分のまとめをログに出すわ。
+    """
+    def __init__(self, inner: discord.AudioSource, stats: FrameStats, label: str = ""):
+        self.inner = inner
+        self.stats = stats
+        self.label = label
+        self._last_read_at: float | None = None
+        self._frames = 0
+        self._late = 0
+        self._short = 0
+        self._max_read = 0.0
+        self._cleaned_up = False
+
+    def read(self) -> bytes:
+        started = time.perf_counter()
+        data = self.inner.read()
+        elapsed = time.perf_counter() - started
+        if not data:
+            return data
+
+        stats = self.stats
+        stats.frames += 1
+        self._frames += 1
+        stats.read_latency.observe(elapsed)
+        if elapsed > self._max_read:
+            self._max_read = elapsed
+        if elapsed * 1000 > AUDIO_STATS_LATE_FRAME_MS:
+            stats.late_frames += 1
+            self._late += 1
+        if len(data) < FRAME_SIZE and not self.inner.is_opus():
+            stats.short_frames += 1
+            self._short += 1
+        if self._last_read_at is not None:
+            interval = started - self._last_read_at
+            if interval < _GAP_SECONDS:
+                stats.jitter.observe(abs(interval - FRAME_SECONDS))
+        self._last_read_at = started
+        if self._frames % AUDIO_STATS_PIPE_SAMPLE_FRAMES == 0:
+            pipe_bytes = _pipe_bytes(self.inner)
+            if pipe_bytes is not None:
+                stats.pipe_bytes = pipe_bytes
+                stats.pipe_samples += 1
+                if pipe_bytes == 0:
+                    stats.pipe_empty_samples += 1
+        return data
+
+    def is_opus(self) -> bool:
+        return self.inner.is_opus()
+
+    def cleanup(self):
+        if not self._cleaned_up:
+            self._cleaned_up = True
+            if self._late or self._short:
+                logger.warning(
+                    f"再生が詰まり気味だったわ (ギルド {self.stats.guild_id}, {self.stats.channel}, {self.label}): "
+                    f"{self._frames} フレーム中 遅延 {self._late}, 短い {self._short}, read() 最大 {self._max_read * 1000:.1f}ms"
+                )
+            elif self._frames:
+                logger.debug(
+                    f"再生の統計 (ギルド {self.stats.guild_id}, {self.stats.channel}, {self.label}): "
+                    f"{self._frames} フレーム, read() 最大 {self._max_read * 1000:.1f}ms"
+                )
+        self.inner.cleanup()
+
+def _collect_frame_stats() -> list[MetricFamily]:
+    frames = MetricFamily("mama_audio_frames_total", "counter", "流したフレーム数 (kind=late は read() が遅かったもの、short は短かったもの)")
+    read_latency = MetricFamily("mama_audio_read_seconds", "histogram", "フレームごとの read() の所要時間 (秒)")
+    jitter = MetricFamily("mama_audio_jitter_seconds", "histogram", "読み出し間隔の20msからのずれ (秒)")
+    pipe = MetricFamily("mama_audio_pipe_buffer_bytes", "gauge", "FFmpegの出力パイプに溜まっていたバイト数 (最後に測った値)")
+    for stats in list(_stats.values()):
+        labels = {"guild": stats.guild_id, "channel": stats.channel}
+        frames.add(stats.frames, **labels, kind="all")
+        frames.add(stats.late_frames, **labels, kind="late")
+        frames.add(stats.short_frames, **labels, kind="short")
+        stats.read_latency.add_to(read_latency, **labels)
+        stats.jitter.add_to(jitter, **labels)
+        if stats.pipe_bytes is not None:
+            pipe.add(stats.pipe_bytes, **labels)
+    return [frames, read_latency, jitter, pipe]
+
+REGISTRY.register_collector(_collect_frame_stats)
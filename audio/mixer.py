@@ -0,0 +1,292 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\audio\mixer.py
+import logging
+import threading
+from collections.abc import Callable
+import discord
+import numpy as np
+from config import MIXER_DUCK_VOLUME, MIXER_DUCK_FADE_MS, MIXER_IDLE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE # 20ms分のPCM (48kHz ステレオ 16bit) のバイト数
+FRAME_SAMPLES = FRAME_SIZE // 2 # 1フレームのint16サンプル数 (左右交互に並んでいる)
+SILENCE_FRAME = b"\x00" * FRAME_SIZE
+
+# チャンネル名。音楽は MusicCog、声は VoiceCog が使うわ
+MUSIC = "music"
+VOICE = "voice"
+
+class _Stream:
+    """ミキサーに差し込まれた1本の音声"""
+    __slots__ = ("source", "after", "paused", "gain", "decoder")
+
+    def __init__(self, source: discord.AudioSource, after: Callable[[Exception | None], None] | None):
+        self.source = source
+        self.after = after
+        self.paused = False
+        self.gain = 1.0 # 直前のフレームで掛けた音量 (ダッキングのフェード用)
+        self.decoder: discord.opus.Decoder | None = None # Opusのチャンネルを混ぜるとき用
+
+class AudioMixer(discord.AudioSource):
+    """
+    ギルドごとの音声ミキサー。VCではこれ1本だけを play() しておいて、音楽や声はチャンネルとして抜き差しするの。
+    フレームごとに各チャンネルのPCMをNumPyでまとめて足し合わせて、int16の範囲に収まるようにクリップするわ。
+    流れているのがOpusのチャンネル1本だけなら、パケットをそのまま素通しするのでエンコードも要らないの
+    (discord.py はフレームごとに is_opus() を見るので、直前に返したフレームの種類を返しているわ)。
+    声が流れている間は音楽の音量をフェードしながら下げる (ダッキング) ので、
+    喋るたびに音楽を止めたりFFmpegを立ち上げ直したりしなくて済むのよ。
+    チャンネルには「次に流すもの」も予約しておけて、今のが終わったフレームでそのまま切り替えるから曲間が空かないわ。
+    """
+    def __init__(self, duck_volume: float = MIXER_DUCK_VOLUME, fade_ms: int = MIXER_DUCK_FADE_MS, idle_timeout: float = MIXER_IDLE_TIMEOUT):
+        self.duck_volume = duck_volume
+        frame_ms = discord.opus.Encoder.FRAME_LENGTH
+        self._fade_step = 1.0 / max(1, fade_ms // frame_ms) # 1フレームで動かす音量
+        self._idle_limit = int(idle_timeout * 1000 // frame_ms)
+        self._streams: dict[str, _Stream] = {}
+        self._next: dict[str, _Stream] = {} # チャンネルごとの、今のが終わったらすぐ流すもの
+        self._lock = threading.RLock()
+        self._idle_frames = 0
+        self.ended = False # 流すものがなくなって、プレイヤーに終わりを返したらTrue
+        self._opus_frame = False # 直前に返したフレームがOpusのパケットならTrue
+
+        # フレームごとに配列を作らないように、作業用のバッファを使い回す
+        self._mix = np.zeros(FRAME_SAMPLES, dtype=np.float32)
+        self._scratch = np.empty(FRAME_SAMPLES, dtype=np.float32)
+        self._out = np.empty(FRAME_SAMPLES, dtype=np.int16)
+        # フレーム内で音量をなめらかに変えるための 0→1 の傾き (左右で同じ値)
+        self._ramp = np.repeat(np.arange(1, FRAME_SAMPLES // 2 + 1, dtype=np.float32) / (FRAME_SAMPLES // 2), 2)
+
+    def is_opus(self) -> bool:
+        return self._opus_frame
+
+    # --- チャンネルの操作 (イベントループ側から呼ぶ) ---
+
+    def play(self, channel: str, source: discord.AudioSource, *, after: Callable[[Exception | None], None] | None = None):
+        """
+        チャンネルに音声を差し込む。すでに何か流れていたら、それは止めて入れ替えるわ。
+        after は discord.py の VoiceClient.play と同じく、流し終わったか止めたときにプレイヤーのスレッドなどから呼ばれるの。
+        """
+        with self._lock:
+            previous = self._streams.pop(channel, None)
+            self._streams[channel] = _Stream(source, after)
+            self._idle_frames = 0
+        if previous:
+            self._finish(channel, previous, None)
+
+    def stop(self, channel: str) -> bool:
+        """チャンネルの音声を止める。予約してあった次のものも取り消すわ。止めたものがあればTrue"""
+        with self._lock:
+            stream = self._streams.pop(channel, None)
+            pending = self._next.pop(channel, None)
+        if pending:
+            pending.source.cleanup()
+        if stream is None:
+            return False
+        self._finish(channel, stream, None)
+        return True
+
+    def skip(self, channel: str) -> bool:
+        """チャンネルの音声を止めて、予約してあった次のものがあればすぐ流す。止めたものがあればTrue"""
+        with self._lock:
+            stream = self._streams.pop(channel, None)
+            pending = self._next.pop(channel, None)
+            if pending:
+                self._streams[channel] = pending
+                self._idle_frames = 0
+        if stream is None:
+            return False
+        self._finish(channel, stream, None)
+        return True
+
+    def set_next(self, channel: str, source: discord.AudioSource, *, after: Callable[[Exception | None], None] | None = None):
+        """
+        チャンネルの今の音声が終わったら、同じフレームで切り替えて流すものを予約する。
+        すでに予約があれば、それは流さずに片付けるわ。
+        """
+        with self._lock:
+            previous = self._next.pop(channel, None)
+            self._next[channel] = _Stream(source, after)
+        if previous:
+            previous.source.cleanup()
+
+    def clear_next(self, channel: str) -> bool:
+        """予約してあった次のものを取り消す (流さずに片付ける)。取り消したものがあればTrue"""
+        with self._lock:
+            pending = self._next.pop(channel, None)
+        if pending is None:
+            return False
+        pending.source.cleanup()
+        return True
+
+    def next_source(self, channel: str) -> discord.AudioSource | None:
+        stream = self._next.get(channel)
+        return stream.source if stream else None
+
+    def pause(self, channel: str) -> bool:
+        with self._lock:
+            stream = self._streams.get(channel)
+            if stream is None or stream.paused:
+                return False
+            stream.paused = True
+            return True
+
+    def resume(self, channel: str) -> bool:
+        with self._lock:
+            stream = self._streams.get(channel)
+            if stream is None or not stream.paused:
+                return False
+            stream.paused = False
+            self._idle_frames = 0
+            return True
+
+    def is_active(self, channel: str) -> bool:
+        """チャンネルに音声が差し込まれているか (一時停止中も含む)"""
+        return channel in self._streams
+
+    def is_paused(self, channel: str) -> bool:
+        stream = self._streams.get(channel)
+        return stream is not None and stream.paused
+
+    def source(self, channel: str) -> discord.AudioSource | None:
+        stream = self._streams.get(channel)
+        return stream.source if stream else None
+
+    def close(self):
+        """全部のチャンネルを止める (VCから抜けるとき用)"""
+        with self._lock:
+            streams = list(self._streams.items())
+            pending = list(self._next.values())
+            self._streams.clear()
+            self._next.clear()
+        for stream in pending:
+            stream.source.cleanup()
+        for channel, stream in streams:
+            self._finish(channel, stream, None)
+
+    def ensure_playing(self, vc: discord.VoiceClient):
+        """
+        VCでこのミキサーが流れているようにする。チャンネルに音声を差し込んだあとに呼んでね。
+        一度流すものがなくなって終わっていたら、プレイヤーを作り直すわ。
+        """
+        with self._lock:
+            if vc.source is self and vc.is_playing() and not self.ended:
+                return
+            if vc.source is self and vc.is_paused() and not self.ended:
+                vc.resume()
+                return
+            if vc.is_playing() or vc.is_paused():
+                vc.stop() # 終わりかけのプレイヤーか、ミキサーを通していない古い再生
+            self.ended = False
+            self._idle_frames = 0
+            self._opus_frame = False # play() はこの時点の is_opus() を見てエンコーダーを用意するので、PCMとして始める
+        vc.play(self, after=self._after_player)
+        logger.info(f"ミキサーの再生を開始しました (チャンネル {vc.channel})")
+
+    def _after_player(self, error: Exception | None):
+        if error:
+            logger.error(f"ミキサーのプレイヤーがエラーで止まりました: {error}")
+
+    def _finish(self, channel: str, stream: _Stream, error: Exception | None):
+        # discord.py の AudioPlayer と同じく、after を呼んでから後片付けする
+        if stream.after is not None:
+            try:
+                stream.after(error)
+            except Exception as e:
+                logger.error(f"ミキサーの {channel} チャンネルの after でエラー: {e}", exc_info=True)
+        try:
+            stream.source.cleanup()
+        except Exception as e:
+            logger.error(f"ミキサーの {channel} チャンネルの後片付けでエラー: {e}", exc_info=True)
+
+    # --- プレイヤーのスレッドから呼ばれる ---
+
+    def read(self) -> bytes:
+        # source.read() はFFmpegのパイプ待ちなどでブロッキングすることがあるので、ロックを持ったまま読まないの。
+        # 読むものをロックの中で写し取ってから外で読んで、次のものへの切り替えだけもう一度ロックを取ってやるわ
+        with self._lock:
+            ducking = any(not s.paused for name, s in self._streams.items() if name != MUSIC)
+            active = [(channel, stream) for channel, stream in self._streams.items() if not stream.paused]
+
+        finished: list[tuple[str, _Stream, Exception | None]] = []
+        frames: list[tuple[bytes, _Stream, float, bool]] = []
+        for channel, stream in active:
+            while stream is not None and not stream.paused:
+                try:
+                    data = stream.source.read()
+                except Exception as e:
+                    data, error = b"", e
+                else:
+                    error = None
+                if data:
+                    target = self.duck_volume if ducking and channel == MUSIC else 1.0
+                    frames.append((data, stream, target, stream.source.is_opus()))
+                    break
+                with self._lock:
+                    if self._streams.get(channel) is not stream:
+                        break # 読んでいる間に止められたか入れ替えられた (後片付けはそっちでやるわ)
+                    finished.append((channel, stream, error))
+                    # 次のものが予約されていたら、このフレームからすぐ流す
+                    following = self._next.pop(channel, None)
+                    if following is None:
+                        del self._streams[channel]
+                    else:
+                        following.gain = stream.gain # 音量のフェードは引き継ぐ
+                        self._streams[channel] = following
+                stream = following
+
+        with self._lock:
+            self._opus_frame = False
+            if frames:
+                self._idle_frames = 0
+                result = self._mix_frames(frames)
+            elif self._idle_frames < self._idle_limit:
+                self._idle_frames += 1
+                result = SILENCE_FRAME
+            else:
+                self.ended = True
+                result = b""
+
+        for channel, stream, error in finished:
+            if error:
+                logger.error(f"ミキサーの {channel} チャンネルの読み込みでエラー: {error}")
+            self._finish(channel, stream, error)
+        return result
+
+    def _mix_frames(self, frames: list[tuple[bytes, _Stream, float, bool]]) -> bytes:
+        if len(frames) == 1:
+            data, stream, target, opus = frames[0]
+            if stream.gain == target == 1.0 and (opus or len(data) == FRAME_SIZE):
+                self._opus_frame = opus
+                return data # 1本だけで音量もそのままなら、足し算は要らないわ
+
+        mix, scratch = self._mix, self._scratch
+        mix.fill(0)
+        for data, stream, target, opus in frames:
+            if opus:
+                if stream.decoder is None:
+                    stream.decoder = discord.opus.Decoder()
+                data = stream.decoder.decode(data)
+            pcm = np.frombuffer(data, dtype=np.int16, count=min(len(data) // 2, FRAME_SAMPLES))
+            n = len(pcm)
+            start = stream.gain
+            # 目標の音量へ、1フレームあたり _fade_step ずつ近づける
+            end = min(target, start + self._fade_step) if target > start else max(target, start - self._fade_step)
+            stream.gain = end
+            if start == end == 1.0:
+                mix[:n] += pcm
+            elif start == end:
+                np.multiply(pcm, end, out=scratch[:n])
+                mix[:n] += scratch[:n]
+            else:
+                np.multiply(self._ramp[:n], end - start, out=scratch[:n])
+                scratch[:n] += start
+                scratch[:n] *= pcm
+                mix[:n] += scratch[:n]
+        np.clip(mix, -32768, 32767, out=mix)
+        np.copyto(self._out, mix, casting="unsafe")
+        return self._out.tobytes()
+
+    def cleanup(self):
+        # プレイヤーが止まっても (流すものがなくなった・VCの切断など) チャンネルはそのまま残しておく。
+        # 本当に片付けるときは close() を呼んでね
+        pass
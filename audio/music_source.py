@@ -0,0 +1,56 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\audio\music_source.py
+import collections
+import logging
+import discord
+from core.metrics import FFMPEG_PROCESSES
+
+logger = logging.getLogger(__name__)
+
+class CountedFFmpegPCMAudio(discord.FFmpegPCMAudio):
+    """discord.FFmpegPCMAudio と同じだけど、立ち上がっているFFmpegの数をメトリクスで数えておくの"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs) # FFmpegを起動できなければここで例外になるので、数えないわ
+        self._counted = True
+        FFMPEG_PROCESSES.inc(purpose="playback")
+
+    def cleanup(self):
+        try:
+            super().cleanup()
+        finally:
+            if self._counted: # cleanup は何度か呼ばれることがあるので、減らすのは1回だけ
+                self._counted = False
+                FFMPEG_PROCESSES.dec(purpose="playback")
+
+class PrimedAudioSource(discord.AudioSource):
+    """
+    先頭の数フレームを前もってデコードしておくラッパー。
+    prime() でFFmpegの起動と最初のデコードを済ませておけば、流し始めた瞬間に音が出るわ。
+    """
+    def __init__(self, inner: discord.AudioSource):
+        self.inner = inner
+        self._frames: collections.deque[bytes] = collections.deque()
+        self._exhausted = False
+
+    def prime(self, frame_count: int) -> int:
+        """最初の frame_count フレームを読んで溜めておく。ブロッキングするので asyncio.to_thread から呼んでね"""
+        while len(self._frames) < frame_count and not self._exhausted:
+            data = self.inner.read()
+            if not data:
+                self._exhausted = True
+                break
+            self._frames.append(data)
+        return len(self._frames)
+
+    def read(self) -> bytes:
+        if self._frames:
+            return self._frames.popleft()
+        if self._exhausted:
+            return b""
+        return self.inner.read()
+
+    def is_opus(self) -> bool:
+        return self.inner.is_opus()
+
+    def cleanup(self):
+        self._frames.clear()
+        self.inner.cleanup()
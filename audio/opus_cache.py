@@ -0,0 +1,115 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\audio\opus_cache.py
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import discord
+from discord.oggparse import OggStream
+from config import MUSIC_OPUS_CACHE_DIR, MUSIC_OPUS_BITRATE, MUSIC_LIMITER_THRESHOLD, MUSIC_DEFAULT_VOLUME
+from library.index import Track
+from core.metrics import FFMPEG_PROCESSES
+
+logger = logging.getLogger(__name__)
+
+_HEADER_PACKETS = (b"OpusHead", b"OpusTags") # Oggの先頭にある、音声ではないパケット
+
+class OggOpusSource(discord.AudioSource):
+    """
+    変換済みのOgg Opusファイルから、Opusのパケットをそのまま読み出すAudioSource。
+    FFmpegを立ち上げずにPython側でOggを分解するだけなので、デコードもエンコードもしないわ。
+    """
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._packets = OggStream(self._file).iter_packets()
+
+    def read(self) -> bytes:
+        for packet in self._packets:
+            if not packet.startswith(_HEADER_PACKETS):
+                return packet
+        return b""
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        self._file.close()
+
+class OpusCache:
+    """
+    音楽ライブラリの曲を48kHzのOgg Opusに一度だけ変換して取っておくキャッシュ。
+    ファイル名はパス・更新日時・サイズ・ラウドネス補正から決めるので、曲が変わったら自然に作り直しになるわ。
+    ラウドネス補正といつもの音量 (baked_volume) は変換のときに焼き込んでおくので、
+    /volume がいつもの音量のままなら、再生時はパケットを流すだけで済むの (デコードもエンコードもしないわ)。
+    """
+    def __init__(self, cache_dir: str = MUSIC_OPUS_CACHE_DIR, bitrate: int = MUSIC_OPUS_BITRATE, baked_volume: float = MUSIC_DEFAULT_VOLUME):
+        self.cache_dir = cache_dir
+        self.bitrate = bitrate
+        self.baked_volume = baked_volume
+
+    def _key(self, track: Track) -> str:
+        gain_db = track.gain_db or 0.0
+        raw = f"{track.path}\0{track.mtime_ns}\0{track.size}\0{gain_db:.2f}\0{self.bitrate}\0{self.baked_volume:.3f}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def path_for(self, track: Track) -> str:
+        return os.path.join(self.cache_dir, f"{self._key(track)}.opus")
+
+    def lookup(self, track: Track) -> str | None:
+        """変換済みならファイルのパスを返す"""
+        path = self.path_for(track)
+        return path if os.path.exists(path) else None
+
+    async def transcode(self, track: Track) -> bool:
+        """曲をOpusに変換する。FFmpegは呼び出し側で1本ずつ動かしてね"""
+        path = self.path_for(track)
+        if os.path.exists(path):
+            return True
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        baked_db = (track.gain_db or 0.0) + 20 * math.log10(self.baked_volume) # ラウドネス補正といつもの音量をまとめて掛ける
+        filters = f"volume={baked_db:.2f}dB,alimiter=limit={MUSIC_LIMITER_THRESHOLD}"
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-y", "-hide_banner", "-nostats", "-loglevel", "error", "-i", track.path,
+                "-vn", "-map_metadata", "-1", "-af", filters,
+                "-ar", "48000", "-ac", "2", "-c:a", "libopus", "-b:a", f"{self.bitrate}k",
+                "-frame_duration", "20", "-application", "audio", "-f", "ogg", tmp_path,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+            )
+        except OSError as e:
+            logger.error(f"Opus変換のためのFFmpegを起動できませんでした: {e}")
+            return False
+        with FFMPEG_PROCESSES.track_inprogress(purpose="opus_cache"):
+            try:
+                _, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                self._remove(tmp_path)
+                raise
+        if process.returncode != 0:
+            logger.warning(f"Opusに変換できませんでした (終了コード {process.returncode}): {track.path} {stderr.decode(errors='replace').strip()}")
+            self._remove(tmp_path)
+            return False
+        os.replace(tmp_path, path)
+        return True
+
+    def prune(self, tracks: list[Track]) -> int:
+        """ライブラリにもう無い曲 (や作り直した曲) の古い変換結果を消す。消した数を返すわ"""
+        if not os.path.isdir(self.cache_dir):
+            return 0
+        keep = {f"{self._key(track)}.opus" for track in tracks}
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            if name not in keep:
+                self._remove(os.path.join(self.cache_dir, name))
+                removed += 1
+        return removed
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
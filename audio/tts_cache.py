@@ -0,0 +1,154 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\audio\tts_cache.py
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import unicodedata
+from config import TTS_CACHE_MEMORY_BYTES, TTS_CACHE_DISK_DIR, TTS_CACHE_DISK_BYTES
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+def normalize_text(text: str) -> str:
+    """全角/半角の揺れと空白の違いを吸収して、同じ台詞を同じキーにする。"""
+    return _WHITESPACE_PATTERN.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+def make_cache_key(text: str, speaker: int, params: dict | None = None) -> str:
+    """(正規化テキスト, スピーカーID, 合成パラメータのハッシュ) から内容アドレスのキーを作る。"""
+    params_hash = hashlib.sha256(json.dumps(params or {}, sort_keys=True).encode("utf-8")).hexdigest()
+    material = f"{normalize_text(text)}\0{speaker}\0{params_hash}"
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+class TTSCache:
+    """
+    合成済みのWAVバイト列を覚えておくキャッシュ。
+    最近使ったものはメモリ上のLRUに置き、あふれた古いものはディスクに退避するわ。
+    メモリもディスクもバイト数の上限を超えたら古い順に捨てるの。
+    """
+    def __init__(
+        self,
+        memory_budget: int = TTS_CACHE_MEMORY_BYTES,
+        disk_dir: str | None = TTS_CACHE_DISK_DIR,
+        disk_budget: int = TTS_CACHE_DISK_BYTES,
+    ):
+        self.memory_budget = memory_budget
+        self.disk_dir = disk_dir
+        self.disk_budget = disk_budget
+        self._memory: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._disk: collections.OrderedDict[str, int] = collections.OrderedDict() # キー: ファイルサイズ (古い順)
+        self._disk_bytes = 0
+        self.stats = {
+            "memory_hits": 0, "disk_hits": 0, "misses": 0,
+            "memory_evictions": 0, "disk_evictions": 0,
+        }
+        self._load_disk_index()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.wav")
+
+    def _load_disk_index(self):
+        """起動時にディスク上のキャッシュを古い順に並べて索引を作る。"""
+        if not self.disk_dir:
+            return
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            entries = []
+            with os.scandir(self.disk_dir) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.endswith(".wav"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+            for _, key, size in sorted(entries):
+                self._disk[key] = size
+                self._disk_bytes += size
+            logger.info(f"TTSディスクキャッシュを読み込みました: {len(self._disk)} 件, {self._disk_bytes} bytes ({self.disk_dir})")
+        except Exception as e:
+            logger.error(f"TTSディスクキャッシュの読み込み中にエラー ({self.disk_dir}): {e}")
+            self.disk_dir = None # 以後はメモリだけで動く
+
+    async def get(self, key: str) -> bytes | None:
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return data
+
+        if self.disk_dir and key in self._disk:
+            try:
+                data = await asyncio.to_thread(self._read_file, self._disk_path(key))
+            except OSError as e:
+                logger.warning(f"TTSディスクキャッシュの読み込みに失敗したわ (キー {key[:12]}): {e}")
+                self._forget_disk(key)
+            else:
+                self.stats["disk_hits"] += 1
+                self._forget_disk(key, delete_file=True) # メモリに昇格させる
+                await self.put(key, data)
+                return data
+
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, data: bytes):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        if len(data) > self.memory_budget:
+            await self._spill(key, data) # 大きすぎるものは直接ディスクへ
+            return
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_budget:
+            old_key, old_data = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old_data)
+            self.stats["memory_evictions"] += 1
+            await self._spill(old_key, old_data)
+
+    async def _spill(self, key: str, data: bytes):
+        if not self.disk_dir or len(data) > self.disk_budget or key in self._disk:
+            return
+        try:
+            await asyncio.to_thread(self._write_file, self._disk_path(key), data)
+        except OSError as e:
+            logger.warning(f"TTSディスクキャッシュへの書き込みに失敗したわ (キー {key[:12]}): {e}")
+            return
+        self._disk[key] = len(data)
+        self._disk_bytes += len(data)
+        while self._disk_bytes > self.disk_budget:
+            old_key = next(iter(self._disk))
+            self._forget_disk(old_key, delete_file=True)
+            self.stats["disk_evictions"] += 1
+
+    def _forget_disk(self, key: str, delete_file: bool = False):
+        size = self._disk.pop(key, None)
+        if size is None:
+            return
+        self._disk_bytes -= size
+        if delete_file:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def _write_file(path: str, data: bytes):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def summary(self) -> dict:
+        return {
+            **self.stats,
+            "memory_entries": len(self._memory), "memory_bytes": self._memory_bytes,
+            "disk_entries": len(self._disk), "disk_bytes": self._disk_bytes,
+        }
@@ -0,0 +1,182 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\audio\tts_pipeline.py
+import asyncio
+import collections
+import logging
+import re
+import time
+from collections.abc import AsyncIterable, AsyncIterator, Iterable
+import discord
+from audio.wav_source import WavPCMAudio, FRAME_SIZE
+from config import VOICEVOX_SPEAKER_ID, TTS_PIPELINE_MAX_PARALLEL
+from handlers.voicevox_handler import VoicevoxClient
+from core.metrics import AUDIO_UNDERRUNS
+
+logger = logging.getLogger(__name__)
+
+SILENCE_FRAME = b"\x00" * FRAME_SIZE
+
+# 句点・感嘆符・疑問符 (閉じ括弧まで含める) か改行で文を区切る
+_SENTENCE_PATTERN = re.compile(r"[^。！？!?\n]*[。！？!?]+[」』）)]*|[^。！？!?\n]+")
+_SPEAKABLE_PATTERN = re.compile(r"\w")
+_BOUNDARY_PATTERN = re.compile(r"[。！？!?\n][」』）)]*")
+
+def split_sentences(text: str) -> list[str]:
+    """
+    文章を日本語の文の区切り (。！？ と改行) で分割する。
+    絵文字だけのような読み上げられない断片は直前の文にくっつけるわ。
+    """
+    sentences: list[str] = []
+    for match in _SENTENCE_PATTERN.finditer(text):
+        fragment = match.group().strip()
+        if not fragment:
+            continue
+        if sentences and not _SPEAKABLE_PATTERN.search(fragment):
+            sentences[-1] += fragment
+        else:
+            sentences.append(fragment)
+    return sentences
+
+async def stream_sentences(chunks: AsyncIterable[str]) -> AsyncIterator[str]:
+    """
+    ストリーミングで届くテキストの断片から、文が完成したそばから1文ずつ返す。
+    最後の区切り以降の書きかけの部分は、続きが届くまで溜めておくわ。
+    """
+    buffer = ""
+    async for chunk in chunks:
+        buffer += chunk
+        last_boundary = None
+        for last_boundary in _BOUNDARY_PATTERN.finditer(buffer):
+            pass
+        if last_boundary is None:
+            continue
+        complete, buffer = buffer[:last_boundary.end()], buffer[last_boundary.end():]
+        for sentence in split_sentences(complete):
+            yield sentence
+    for sentence in split_sentences(buffer):
+        yield sentence
+
+class QueuedPCMAudio(discord.AudioSource):
+    """
+    順番に追加されるPCMのかたまりを、1本の連続した音声として流すAudioSource。
+    次のかたまりがまだ合成中なら無音を流して待ち (アンダーランとして数えるわ)、finish() されたら再生を終えるわ。
+    """
+    def __init__(self):
+        self._chunks: collections.deque[WavPCMAudio] = collections.deque()
+        self._current: WavPCMAudio | None = None
+        self._finished = False
+        self.closed = False
+        self.first_frame_at: float | None = None # 最初に音のあるフレームを返した時刻 (time.perf_counter)
+
+    def put(self, chunk: WavPCMAudio):
+        self._chunks.append(chunk)
+
+    def finish(self):
+        """これ以上かたまりが来ないことを知らせる"""
+        self._finished = True
+
+    def read(self) -> bytes:
+        while True:
+            if self._current is not None:
+                frame = self._current.read()
+                if frame:
+                    if self.first_frame_at is None:
+                        self.first_frame_at = time.perf_counter()
+                    return frame
+                self._current = None
+            if self._chunks:
+                self._current = self._chunks.popleft()
+                continue
+            if self._finished:
+                return b""
+            AUDIO_UNDERRUNS.inc(source="tts")
+            return SILENCE_FRAME # 次の文の合成待ち
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self):
+        # 再生が止められたら、合成中の残りも打ち切ってもらう
+        self.closed = True
+        self._chunks.clear()
+
+class SpeechPipeline:
+    """
+    文ごとに区切ったテキストを並列で合成し、順番通りに QueuedPCMAudio へ流し込む。
+    最初の文は後ろの文の合成を待たずに喋り始めるわ。
+    """
+    def __init__(
+        self,
+        voicevox_client: VoicevoxClient,
+        source: QueuedPCMAudio,
+        speaker: int = VOICEVOX_SPEAKER_ID,
+        max_parallel: int = TTS_PIPELINE_MAX_PARALLEL,
+    ):
+        self.voicevox_client = voicevox_client
+        self.source = source
+        self.speaker = speaker
+        self._slots = asyncio.Semaphore(max_parallel)
+        self.synthesized_count = 0
+        self.failed_count = 0
+        self.first_chunk_ready = asyncio.Event() # 最初の文が流せる状態になったか、合成が終わったらセット
+
+    async def _synthesize_one(self, sentence: str) -> WavPCMAudio | None:
+        try:
+            if self.source.closed:
+                return None
+            wav_bytes = await self.voicevox_client.synthesize(sentence, self.speaker)
+            if not wav_bytes:
+                return None
+            return await asyncio.to_thread(WavPCMAudio, wav_bytes)
+        finally:
+            self._slots.release()
+
+    async def _produce(self, sentences: AsyncIterable[str] | Iterable[str], tasks: asyncio.Queue):
+        try:
+            if isinstance(sentences, AsyncIterable):
+                async for sentence in sentences:
+                    await self._schedule(sentence, tasks)
+            else:
+                for sentence in sentences:
+                    await self._schedule(sentence, tasks)
+        finally:
+            await tasks.put(None) # 終端の合図
+
+    async def _schedule(self, sentence: str, tasks: asyncio.Queue):
+        if self.source.closed or not _SPEAKABLE_PATTERN.search(sentence):
+            return # 絵文字だけの断片などは読み上げようがないので飛ばす
+        await self._slots.acquire()
+        await tasks.put(asyncio.create_task(self._synthesize_one(sentence)))
+
+    async def _consume(self, tasks: asyncio.Queue):
+        while (task := await tasks.get()) is not None:
+            # 止められた後のタスクも、合成前に自分で打ち切るのでそのまま待つ
+            try:
+                chunk = await task
+            except Exception as e:
+                logger.error(f"文の音声合成中にエラー: {e}", exc_info=True)
+                chunk = None
+            if self.source.closed:
+                continue
+            if chunk is None:
+                self.failed_count += 1
+                continue
+            self.synthesized_count += 1
+            self.source.put(chunk)
+            self.first_chunk_ready.set()
+
+    async def run(self, sentences: AsyncIterable[str] | Iterable[str]):
+        """
+        すべての文を合成し終えるまで待つ。合成結果は到着順ではなく文の順番で流れるわ。
+        """
+        tasks: asyncio.Queue = asyncio.Queue()
+        try:
+            results = await asyncio.gather(
+                self._produce(sentences, tasks), self._consume(tasks), return_exceptions=True,
+            )
+        finally:
+            self.source.finish()
+            self.first_chunk_ready.set()
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        logger.info(f"パイプライン合成完了: 成功 {self.synthesized_count} 文, 失敗 {self.failed_count} 文")
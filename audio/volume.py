@@ -0,0 +1,95 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\audio\volume.py
+import logging
+import discord
+import numpy as np
+from config import MUSIC_LIMITER_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+FRAME_SAMPLES = FRAME_SIZE // 2
+
+def db_to_gain(db: float) -> float:
+    return 10 ** (db / 20)
+
+class VolumeProcessor(discord.AudioSource):
+    """
+    PCMVolumeTransformer の代わりの音量調整。
+    ギルドの音量 (volume) と曲ごとのラウドネス補正 (gain_db) をまとめて掛けて、
+    はみ出しそうな山はソフトリミッター (tanh) でなめらかに丸めるわ。
+    計算は最初に用意したバッファの上でやるので、フレームごとに配列を作らないの。
+    中身がOpus (変換済みキャッシュ) のときは、音量を変えなくていいフレームはパケットのまま素通しして、
+    変えるときだけデコードするわ。is_opus() は直前に返したフレームの種類を返すの。
+    base_volume は入力にすでに焼き込まれている音量よ。キャッシュはいつもの音量 (MUSIC_DEFAULT_VOLUME) で変換してあるので、
+    /volume がその音量のままならデコードもエンコードもせずに流して、/volume で変えたときだけデコードして掛け直すの。
+    """
+    def __init__(self, inner: discord.AudioSource, volume: float = 1.0, gain_db: float = 0.0,
+                 limiter_threshold: float = MUSIC_LIMITER_THRESHOLD, base_volume: float = 1.0):
+        self.inner = inner
+        self._opus_input = inner.is_opus()
+        self._decoder: discord.opus.Decoder | None = None
+        self._passthrough = False # 直前のフレームをOpusのまま返したか
+        self.volume = volume # 再生中でも書き換えていいわ (/volume 用)
+        self.base_volume = base_volume
+        self.track_gain = db_to_gain(gain_db)
+        self.threshold = limiter_threshold
+
+        self._buffer = bytearray(FRAME_SIZE)
+        self._pcm = np.frombuffer(self._buffer, dtype=np.int16) # _buffer をそのまま int16 として見る
+        self._work = np.empty(FRAME_SAMPLES, dtype=np.float32)
+        self._excess = np.empty(FRAME_SAMPLES, dtype=np.float32)
+        self._soft = np.empty(FRAME_SAMPLES, dtype=np.float32)
+
+    def read(self) -> bytes:
+        data = self.inner.read()
+        if not data:
+            return data
+        gain = self.volume / self.base_volume * self.track_gain
+        if self._opus_input:
+            passthrough = abs(gain - 1.0) < 1e-6
+            if passthrough != self._passthrough:
+                # 素通ししていた間のパケットはデコーダーに通していないので、続きからは新しいデコーダーで始めるわ
+                self._decoder = None
+                self._passthrough = passthrough
+            if passthrough:
+                return data
+            if self._decoder is None:
+                self._decoder = discord.opus.Decoder()
+            data = self._decoder.decode(data)
+        if abs(gain - 1.0) < 1e-6:
+            return data
+
+        size = min(len(data), FRAME_SIZE)
+        self._buffer[:size] = data[:size]
+        if size < FRAME_SIZE: # 最後の半端なフレームは無音で埋める
+            self._buffer[size:] = bytes(FRAME_SIZE - size)
+
+        work = self._work
+        np.multiply(self._pcm, gain / 32768, out=work) # -1.0〜1.0 の範囲で考える
+        peak = max(float(work.max()), -float(work.min()))
+        if peak > self.threshold:
+            self._limit(work)
+        work *= 32767
+        np.copyto(self._pcm, work, casting="unsafe")
+        return bytes(self._buffer)
+
+    def _limit(self, work: np.ndarray):
+        # しきい値 T を超えた分 e を (1-T)*tanh(e/(1-T)) に縮める。どんなに大きくても 1.0 は超えないわ
+        threshold = self.threshold
+        knee = 1.0 - threshold
+        excess, soft = self._excess, self._soft
+        np.abs(work, out=excess)
+        excess -= threshold
+        np.maximum(excess, 0, out=excess)
+        np.multiply(excess, 1 / knee, out=soft)
+        np.tanh(soft, out=soft)
+        soft *= knee
+        excess -= soft # 削る量
+        np.copysign(excess, work, out=excess)
+        work -= excess
+
+    def is_opus(self) -> bool:
+        return self._passthrough
+
+    def cleanup(self):
+        self.inner.cleanup()
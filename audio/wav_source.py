@@ -0,0 +1,65 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\audio\wav_source.py
+import io
+import logging
+import wave
+import discord
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# discord.py が期待するPCM形式: 48kHz / 16bit / ステレオ、20msごとに1フレーム
+SAMPLING_RATE = discord.opus.Encoder.SAMPLING_RATE
+CHANNELS = discord.opus.Encoder.CHANNELS
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE # 1フレームのバイト数 (3840)
+
+def decode_wav_to_pcm(wav_bytes: bytes) -> bytes:
+    """
+    WAVのバイト列 (VOICEVOXの出力は24kHz/16bit/モノラル) を、
+    discordに渡せる48kHz/16bit/ステレオのPCMバイト列に変換する。
+    """
+    with wave.open(io.BytesIO(wav_bytes), "rb") as wav:
+        n_channels = wav.getnchannels()
+        sample_width = wav.getsampwidth()
+        frame_rate = wav.getframerate()
+        raw = wav.readframes(wav.getnframes())
+
+    if sample_width != 2:
+        raise ValueError(f"16bit以外のWAVには対応していないわ (sample_width={sample_width})")
+
+    samples = np.frombuffer(raw, dtype="<i2").reshape(-1, n_channels)
+    mono = samples.mean(axis=1) if n_channels > 1 else samples[:, 0].astype(np.float64)
+
+    if frame_rate != SAMPLING_RATE and len(mono) > 1:
+        # 線形補間でリサンプリング (24kHz -> 48kHz ならちょうど2倍)
+        n_out = int(round(len(mono) * SAMPLING_RATE / frame_rate))
+        positions = np.arange(n_out) * (frame_rate / SAMPLING_RATE)
+        mono = np.interp(positions, np.arange(len(mono)), mono)
+
+    stereo = np.repeat(np.clip(mono, -32768, 32767).astype("<i2")[:, None], CHANNELS, axis=1)
+    return stereo.tobytes()
+
+class WavPCMAudio(discord.AudioSource):
+    """
+    メモリ上のWAVバイト列をそのまま流すAudioSource。
+    一時ファイルもFFmpegのプロセスも使わないわ。
+    """
+    def __init__(self, wav_bytes: bytes):
+        self._pcm = memoryview(decode_wav_to_pcm(wav_bytes))
+        self._position = 0
+
+    @property
+    def duration(self) -> float:
+        """音声の長さ (秒)"""
+        return len(self._pcm) / (SAMPLING_RATE * CHANNELS * 2)
+
+    def read(self) -> bytes:
+        if self._position >= len(self._pcm):
+            return b""
+        chunk = bytes(self._pcm[self._position:self._position + FRAME_SIZE])
+        self._position += FRAME_SIZE
+        if len(chunk) < FRAME_SIZE: # 最後のフレームは無音で埋める
+            chunk += b"\x00" * (FRAME_SIZE - len(chunk))
+        return chunk
+
+    def is_opus(self) -> bool:
+        return False
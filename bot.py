@@ -1,3 +1,17 @@
+import sys
+import time
+
+_BOOT_STARTED = time.perf_counter() # 起動にかかった時間はここから測るわ
+
+# python bot.py --profile-startup で起動すると、モジュールの読み込み時間と準備完了までの時間を表示して終了するの。
+# ほかのモジュールの読み込みも測れるように、何より先に計測を始めておくわ
+PROFILE_STARTUP = "--profile-startup" in sys.argv[1:]
+if PROFILE_STARTUP:
+    from core.startup_profile import ImportProfiler
+    import_profiler = ImportProfiler().install()
+else:
+    import_profiler = None
+
 # 必要なライブラリをインポート
 import discord
 from discord.ext import commands
@@ -6,23 +20,22 @@ import logging
 import asyncio
 
 # 設定ファイルをインポート
-from config import DISCORD_BOT_TOKEN, GEMINI_API_KEY, GUILDS, PROMPT_Q_FILE_PATH, PROMPT_VOICE_FILE_PATH
+from config import DISCORD_BOT_TOKEN, GEMINI_API_KEY, GUILDS, STARTUP_PROFILE_TOP_MODULES, METRICS_ENABLED
+from core.command_sync import sync_changed_commands
+from core.metrics import MetricsServer
+from core.startup_profile import format_report
+from handlers.gemini_service import get_gemini_service
+from handlers.prompt_store import get_prompt_store
 
 # ログ出力の設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# プロンプトファイルの読み込みとフォールバックはconfig.py側で行われるため、
+# プロンプトファイルの読み込みとフォールバックはconfig.py側 (Settings) で行われるため、
 # bot.py側での存在確認は不要になります。
-# PROMPT_Q_FILE_PATH や PROMPT_VOICE_FILE_PATH が None の場合でも、
-# config.py 内で BASE_Q_PROMPT などにフォールバック値が設定されるため、
+# プロンプトファイルが見つからない場合でも、config.py 内でフォールバック値が設定されるため、
 # Cog 側ではプロンプト文字列が常に利用可能です。
 
-# Discordボットの基本設定
-intents = discord.Intents.default()  # デフォルトのインテントを使用
-intents.message_content = True # メッセージ内容の取得を有効にする場合 (Cog内で履歴取得などに使うなら)
-bot = commands.Bot(command_prefix="!", intents=intents) # client から bot に変数名変更
-
 # Cogのファイル名 (拡張子なし)
 INITIAL_EXTENSIONS = [
     'cogs.ask_cog',
@@ -30,44 +43,85 @@ INITIAL_EXTENSIONS = [
     'cogs.music_cog' # MusicCogを追加
 ]
 
-# Botが起動したときに実行される処理
-@bot.event
-async def on_ready():
-    logger.info(f'{bot.user} としてログインしました')
+class MamaBot(commands.Bot):
+    """
+    起動時の準備 (Cogの読み込みとコマンドの同期) は setup_hook で1回だけやるわ。
+    on_ready は再接続のたびに呼ばれるので、そこで読み込み直したり同期し直したりしないようにしているの。
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.started_at = time.perf_counter()
+        self.startup_timings: dict[str, float] = {"imports": self.started_at - _BOOT_STARTED} # 起動の段階ごとにかかった時間 (秒)
+        self._ready_once = False
+        self._warm_up_task: asyncio.Task | None = None
+        self.metrics_server: MetricsServer | None = None
 
-    # Cogをロード
-    for extension in INITIAL_EXTENSIONS:
+    async def _load_extension_timed(self, extension: str):
+        started = time.perf_counter()
         try:
-            await bot.load_extension(extension)
-            logger.info(f"{extension} をロードしました。")
+            await self.load_extension(extension)
+            self.startup_timings[extension] = time.perf_counter() - started
+            logger.info(f"{extension} をロードしました。({self.startup_timings[extension]:.2f}秒)")
         except Exception as e:
             logger.error(f"{extension} のロードに失敗しました: {e}", exc_info=True)
-    try:
-
-        # 既存のグローバルコマンドを削除
-        # ただし、app_commands.guilds() を使っている場合、基本的にはギルドコマンドとして登録されるので、
-        # グローバルコマンドの削除は不要なケースが多い。
-        # もし過去にグローバルコマンドを登録してしまっていた場合のみ、一度実行して削除する。
-        # global_commands = await bot.tree.fetch_commands()
-        # deleted_count = 0
-        # for command in global_commands:
-        #     if command.guild_id is None: # グローバルコマンドのみ対象
-        #         await bot.tree.remove_command(command.name)
-        #         deleted_count += 1
-        # if deleted_count > 0:
-        #    logger.info(f"{deleted_count} 個のグローバルコマンドを削除しました")
-
-        # 各ギルドにコマンドを同期 (Cogがロードされた後に行う)
-        for guild_obj in GUILDS:
+
+    async def setup_hook(self):
+        self.startup_timings["login"] = time.perf_counter() - self.started_at
+
+        # Cogは互いに待ち合わせる必要がないので、まとめて並列に読み込む (音楽ライブラリの走査などが重なるわ)
+        started = time.perf_counter()
+        await asyncio.gather(*(self._load_extension_timed(extension) for extension in INITIAL_EXTENSIONS))
+        self.startup_timings["extensions"] = time.perf_counter() - started
+
+        # コマンド定義が前回から変わったギルドだけ同期する (Cogがロードされた後に行う)
+        started = time.perf_counter()
+        try:
+            await sync_changed_commands(self.tree, GUILDS, self.application_id)
+        except Exception as e:
+            logger.error(f"コマンド同期中にエラー: {e}", exc_info=True)
+        self.startup_timings["command_sync"] = time.perf_counter() - started
+
+        # メトリクスのHTTPサーバー (ポートが使えなくてもボット自体は動かすわ)
+        if METRICS_ENABLED:
             try:
-                synced = await bot.tree.sync(guild=guild_obj)
-                logger.info(f"{len(synced)} 個のコマンドをギルド {guild_obj.id} に同期しました")
-            except discord.errors.Forbidden:
-                 logger.error(f"ギルド {guild_obj.id} へのコマンド同期権限がありません。ボットが 'applications.commands' スコープで招待されているか確認してください。")
-            except Exception as e:
-                logger.error(f"ギルド {guild_obj.id} へのコマンド同期中にエラー: {e}", exc_info=True)
-    except Exception as e:
-        logger.error(f"on_ready処理中にエラー: {e}", exc_info=True)
+                self.metrics_server = MetricsServer()
+                await self.metrics_server.start()
+            except OSError as e:
+                logger.error(f"メトリクスのHTTPサーバーを起動できませんでした: {e}")
+                self.metrics_server = None
+
+    async def close(self):
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+            self.metrics_server = None
+        await super().close()
+
+    async def on_ready(self):
+        logger.info(f'{self.user} としてログインしました')
+        if self._ready_once:
+            logger.info("再接続しました (Cogの読み込みとコマンド同期は起動時に済んでいるわ)")
+            return
+        self._ready_once = True
+        self.startup_timings["ready"] = time.perf_counter() - _BOOT_STARTED # プロセスの起動から準備完了まで
+        phases = ", ".join(f"{name}: {seconds:.2f}秒" for name, seconds in self.startup_timings.items())
+        logger.info(f"起動の所要時間 — {phases}")
+
+        if PROFILE_STARTUP:
+            import_profiler.uninstall()
+            logger.info(format_report(import_profiler, self.startup_timings, STARTUP_PROFILE_TOP_MODULES))
+            await self.close() # 測るだけのモードなので、ここで終わるわ
+            return
+
+        # 準備ができてから、重いSDKの読み込みを裏で済ませておく (最初の質問を待たせないように)
+        try:
+            self._warm_up_task = asyncio.create_task(get_gemini_service().handler.warm_up())
+        except Exception as e:
+            logger.error(f"Geminiの準備中にエラー: {e}", exc_info=True)
+
+# Discordボットの基本設定
+intents = discord.Intents.default()  # デフォルトのインテントを使用
+intents.message_content = True # メッセージ内容の取得を有効にする (AskCogが会話履歴を覚えておくのに使うわ)
+bot = MamaBot(command_prefix="!", intents=intents) # client から bot に変数名変更
 
 # ボットをログアウトさせるコマンド (オーナーのみ)
 @bot.command(name='logout', hidden=True) # hidden=True でヘルプに表示しない
@@ -85,6 +139,28 @@ async def logout_command_error(ctx, error):
     else:
         logger.error(f"logoutコマンドで予期せぬエラー: {error}", exc_info=True)
         await ctx.send("あらやだ、なんだかおかしなことになっちゃったわ…")
+
+# プロンプトファイルを探し直して読み直すコマンド (オーナーのみ)
+# 中身を書き換えただけなら自動で読み直すので、ファイルを足したり名前を変えたりしたときに使ってね
+@bot.command(name='reloadprompts', hidden=True)
+@commands.is_owner()
+async def reload_prompts_command(ctx):
+    """プロンプトファイルを読み直します（オーナーのみ）。"""
+    logger.info(f"{ctx.author} によりプロンプトの読み直しが実行されました。")
+    store = get_prompt_store()
+    changed = store.reload()
+    lines = [f"・{keyword}: {'新しくなったわ' if is_changed else '変わってないわ'}" for keyword, is_changed in changed.items()]
+    personas = ", ".join(store.personas()) or "なし"
+    await ctx.send("\n".join(["プロンプトを読み直したわよ♪", *lines, f"使える人格: {personas}"]))
+
+@reload_prompts_command.error
+async def reload_prompts_command_error(ctx, error):
+    if isinstance(error, commands.NotOwner):
+        await ctx.send("あら、アタシの人格をいじれるのはオーナーだけよ？")
+    else:
+        logger.error(f"reloadpromptsコマンドで予期せぬエラー: {error}", exc_info=True)
+        await ctx.send("あらやだ、なんだかおかしなことになっちゃったわ…")
+
 # ボットを起動（トークンが存在すれば）
 async def main():
     if not DISCORD_BOT_TOKEN:
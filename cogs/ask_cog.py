@@ -3,60 +3,117 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import logging
-from config import BASE_Q_PROMPT, GUILDS # configから読み込み
-from handlers.gemini_handler import GeminiHandler # GeminiHandlerをインポート
+import time
+from config import GUILDS, ASK_STREAM_EDIT_INTERVAL, RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_INCLUDE_HISTORY, CONVERSATION_HISTORY_SIZE, PROMPT_Q_KEYWORD # configから読み込み
+from handlers.gemini_service import GeminiService, PRIORITY_ASK, get_gemini_service
+from handlers.response_cache import ResponseCache, get_response_cache
+from handlers.prompt_builder import build_q_prompt
+from handlers.prompt_store import persona_choices, resolve_persona
+from core.history import ConversationHistory
+from core.metrics import COMMAND_LATENCY
 
 logger = logging.getLogger(__name__)
 
 class AskCog(commands.Cog):
-    def __init__(self, bot: commands.Bot, gemini_handler: GeminiHandler):
+    def __init__(self, bot: commands.Bot, gemini_service: GeminiService, response_cache: ResponseCache | None = None):
         self.bot = bot
-        self.gemini_handler = gemini_handler
-        if not BASE_Q_PROMPT:
-            logger.warning("qコマンド用のベースプロンプトが読み込まれていません。")
+        self.gemini_service = gemini_service
+        self.response_cache = response_cache
+        self.history = ConversationHistory() # チャンネルごとの最近の発言
+        # ベースプロンプトはコマンドのたびに PromptStore から受け取る (ファイルを書き換えたらすぐ反映されるわ)
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        if message.guild:
+            self.history.add(message)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self.history.remove(payload.channel_id, payload.message_id)
+
+    async def _recent_history(self, channel: discord.abc.Messageable) -> list[str]:
+        """チャンネルの最近の発言を古い順に返す。起動してから初めてのチャンネルだけ、APIから一度読み込むわ"""
+        if not self.history.is_seeded(channel.id):
+            try:
+                # ボットの発言も混ざるので、少し多めに取っておく
+                messages = [msg async for msg in channel.history(limit=CONVERSATION_HISTORY_SIZE * 2, oldest_first=False)]
+            except discord.HTTPException as e:
+                logger.warning(f"チャンネル {channel.id} の履歴を読み込めませんでした: {e}")
+                messages = []
+            self.history.seed(channel.id, messages)
+        return self.history.recent(channel.id)
 
     @app_commands.command(name="q", description="ママにお悩み質問するのよ！")
+    @app_commands.describe(persona="答える人格 (prompt フォルダのファイル名)。省略したらいつものアタシよ")
     @app_commands.guilds(*GUILDS) # GUILDSリストを展開して渡す
-    async def ask_gemini_command(self, interaction: discord.Interaction, *, question: str):
-        logger.info(f"/q 質問: {question} from {interaction.user} in {interaction.guild.name if interaction.guild else 'DM'}")
+    async def ask_gemini_command(self, interaction: discord.Interaction, *, question: str, persona: str | None = None):
+        logger.info(f"/q 質問: {question} (人格: {persona or PROMPT_Q_KEYWORD}) from {interaction.user} in {interaction.guild.name if interaction.guild else 'DM'}")
+        started = time.perf_counter()
         await interaction.response.defer(thinking=True)
 
-        if not BASE_Q_PROMPT:
-            await interaction.followup.send("ごめんなさい、なんだか調子が悪いの… (プロンプト設定エラー)")
-            return
+        base_prompt, persona_notice = resolve_persona(persona, PROMPT_Q_KEYWORD)
+        header = f"{persona_notice}\n> {question}\n\n" if persona_notice else f"> {question}\n\n" # 人格が見つからなかったら一言添える
 
         try:
-            # 過去の会話履歴を取得してプロンプトに組み込む (元のロジックを流用)
+            # 過去の会話履歴をプロンプトに組み込む (on_message で覚えておいたものを使うので、APIは呼ばないわ)
             history = []
-            # DMではchannel.historyが使えない場合があるので、ギルド内のみ履歴取得
+            # DMではchannel.historyが使えない場合があるので、ギルド内のみ
             if interaction.guild:
-                async for msg in interaction.channel.history(limit=5, oldest_first=False):
-                    if msg.author.bot:
-                        continue
-                    if msg.content.strip():
-                        # ユーザー名がNoneの場合を考慮
-                        author_name = msg.author.display_name if msg.author else "不明なユーザー"
-                        history.append(f"{author_name}: {msg.content.strip()}")
-                    if len(history) >= 5:
-                        break
-                history.reverse()
+                with COMMAND_LATENCY.time(command="q", stage="history"):
+                    history = await self._recent_history(interaction.channel)
             history_text = "\n".join(history)
             user_display_name = interaction.user.display_name if interaction.user else "アンタ"
 
-            full_prompt = f"{BASE_Q_PROMPT}\n--- 会話履歴 ---\n{history_text}\n\n--- {user_display_name}からの質問 ---\n{question}"
+            # 同じ人の同じ質問にさっき答えていたら、Geminiを呼ばずにそのまま返す (プロンプトに名前が入るので、人ごとに分けるわ)
+            cache_history = history_text if RESPONSE_CACHE_INCLUDE_HISTORY else None
+            if self.response_cache:
+                cached_answer = self.response_cache.get(base_prompt, question, cache_history, user=user_display_name)
+                if cached_answer:
+                    logger.info(f"/q の返答をキャッシュから返します: {question}")
+                    await interaction.followup.send(f"{header}{cached_answer}")
+                    return
 
-            answer_text = await self.gemini_handler.generate_response(full_prompt)
+            # 人格設定 (base_prompt) は使い回せるように別に渡して、毎回送るのは履歴 (トークン数の上限まで) と質問だけにするわ
+            full_prompt = build_q_prompt(history, user_display_name, question)
 
-            if answer_text:
-                await interaction.followup.send(f"> {question}\n\n{answer_text}")
-            else:
+            # 返答をストリーミングで受け取り、届いた分だけメッセージを少しずつ更新する
+            # (編集しすぎるとレート制限に引っかかるので ASK_STREAM_EDIT_INTERVAL 秒ごとにまとめるわ)
+            answer_text = ""
+            message = None
+            last_edit = 0.0
+            gemini_started = time.perf_counter()
+            async for chunk in self.gemini_service.stream_response(full_prompt, priority=PRIORITY_ASK, system_prompt=base_prompt):
+                answer_text += chunk
+                now = time.monotonic()
+                if message is None:
+                    COMMAND_LATENCY.observe(time.perf_counter() - gemini_started, command="q", stage="gemini_first_chunk")
+                    message = await interaction.followup.send(f"{header}{answer_text}", wait=True)
+                    last_edit = now
+                elif now - last_edit >= ASK_STREAM_EDIT_INTERVAL:
+                    await message.edit(content=f"{header}{answer_text}")
+                    last_edit = now
+            COMMAND_LATENCY.observe(time.perf_counter() - gemini_started, command="q", stage="gemini")
+
+            answer_text = answer_text.strip()
+            if not answer_text:
                 await interaction.followup.send("うまく答えが出なかったわ… もう一度試してみてちょうだい。")
+            else:
+                await message.edit(content=f"{header}{answer_text}") # 最後の分を反映
+                if self.response_cache:
+                    self.response_cache.put(base_prompt, question, answer_text, cache_history, user=user_display_name)
         except Exception as e:
             logger.error(f"/q コマンド処理中にエラー: {e}", exc_info=True)
             await interaction.followup.send("質問処理中にトラブル発生よ💦 ちょっと待っててちょうだい。")
+        finally:
+            COMMAND_LATENCY.observe(time.perf_counter() - started, command="q", stage="total")
+
+    @ask_gemini_command.autocomplete("persona")
+    async def persona_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        return [app_commands.Choice(name=name[:100], value=name[:100]) for name in persona_choices(current)]
 
 async def setup(bot: commands.Bot):
-    gemini_h = GeminiHandler() # Bot起動時にGeminiHandlerを初期化
-    await bot.add_cog(AskCog(bot, gemini_h), guilds=GUILDS)
+    # Geminiの窓口はVoiceCogと共有する (同時実行数とレート制限をボット全体でまとめて守るため)
+    response_cache = get_response_cache() if RESPONSE_CACHE_ENABLED else None # 返答キャッシュもVoiceCogと共有
+    await bot.add_cog(AskCog(bot, get_gemini_service(), response_cache), guilds=GUILDS)
     logger.info("AskCogが正常にロードされました。")
 
@@ -1,23 +1,33 @@
 # c:\Users\super\.github\新宿二丁目のママ\cogs\music_cog.py
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 import logging, math
 import os
-import asyncio, enum # enumを追加
-from pathlib import Path # フォルダパスの操作のために追加
-from config import GUILDS # configからGUILDSを読み込み
+import asyncio
+from config import (
+    GUILDS, MUSIC_LIBRARY_REFRESH_INTERVAL, LOUDNESS_ANALYSIS_ENABLED,
+    MUSIC_PREFETCH_ENABLED, MUSIC_PREFETCH_FRAMES, MUSIC_OPUS_CACHE_ENABLED, MUSIC_IDLE_TIMEOUT,
+    AUDIO_STATS_ENABLED,
+) # configから読み込み
+from library.search import SearchIndex
+from library.folders import FolderTree
+from library.index import MusicLibrary, Track
+from library.queue import RepeatMode
+from library.loudness import measure_loudness, loudness_to_gain_db
+from audio.music_source import CountedFFmpegPCMAudio, PrimedAudioSource
+from audio.mixer import MUSIC, VOICE
+from audio.volume import VolumeProcessor
+from audio.opus_cache import OggOpusSource, OpusCache
+from audio.instrumentation import InstrumentedAudioSource, get_frame_stats, guild_frame_stats
+from core.session import VoiceSession, all_sessions, get_session
 
 logger = logging.getLogger(__name__)
 
 MUSIC_DIR = "music" # プロジェクトルートからの相対パス
 ITEMS_PER_PAGE = 20 # /listmusic で1ページに表示する曲数
 ITEMS_IN_SUMMARY = 5 # /playfolder などで表示する曲数の上限
-
-class RepeatMode(enum.Enum):
-    NONE = 0    # リピートなし
-    ONE = 1     # 現在の曲をリピート
-    ALL = 2     # キュー全体をリピート
+QUEUE_ITEMS_PER_PAGE = 10 # /queuemusic で1ページに表示する曲数
 
 class MusicListView(discord.ui.View):
     def __init__(self, music_files_details: list[tuple[str, str]], author_id: int):
@@ -70,13 +80,107 @@ class MusicListView(discord.ui.View):
 class MusicCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.vc_connections = {}  # ギルドID: discord.VoiceClient
-        self.music_queues = {}    # ギルドID: list[tuple[str, str]] (song_path, song_name)
-        self.currently_playing_info = {} # ギルドID: {'path': str, 'name': str} 現在再生中の曲情報
-        self.song_details_to_resume_after_voice = {} # ギルドID: {'path': str, 'name': str} VoiceCogによる中断後再開する曲
-        self.last_text_channel_ids = {} # ギルドID: 最後に音楽コマンドが使われたテキストチャンネルID
-        self.repeat_modes = {} # ギルドID: RepeatMode (デフォルトは RepeatMode.NONE)
+        # VC接続・キュー・再生中の曲・音量などのギルドごとの状態は VoiceSession にまとめてあるわ (VoiceCogと共有)
         self._ensure_music_dir()
+        self.library = MusicLibrary(MUSIC_DIR) # 曲一覧は毎回走査せず、この索引から返す
+        # 曲名検索・オートコンプリート用の索引と /playfolder 用のフォルダ索引 (cog_load で作って、ライブラリが変わったら差し替えるわ)
+        self.search_index: SearchIndex | None = None
+        self.folder_tree: FolderTree | None = None
+        self._library_jobs_task: asyncio.Task | None = None # ラウドネス測定やOpus変換をバックグラウンドでするタスク
+        self.opus_cache = OpusCache() if MUSIC_OPUS_CACHE_ENABLED else None # 変換済みの曲 (無効ならNone)
+
+    async def cog_load(self):
+        # 保存済みの索引があれば読み込んで、変わったディレクトリだけ読み直す
+        await asyncio.to_thread(self.library.load)
+        if await asyncio.to_thread(self.library.refresh):
+            await asyncio.to_thread(self.library.save)
+        await self._rebuild_indexes()
+        self._refresh_library_loop.start()
+        self._start_library_jobs()
+
+    async def cog_unload(self):
+        for session in all_sessions():
+            session.cancel_idle() # 音楽が止まったままのときの退出はMusicCogの仕事なので取り消しておく
+        self._refresh_library_loop.cancel()
+        if self._library_jobs_task:
+            self._library_jobs_task.cancel()
+        await asyncio.to_thread(self.library.save)
+
+    @tasks.loop(seconds=MUSIC_LIBRARY_REFRESH_INTERVAL)
+    async def _refresh_library_loop(self):
+        """定期的に音楽ライブラリの差分を取り込む"""
+        try:
+            if await asyncio.to_thread(self.library.refresh):
+                await asyncio.to_thread(self.library.save)
+                await self._rebuild_indexes()
+                self._start_library_jobs()
+        except Exception as e:
+            logger.error(f"音楽ライブラリの再走査中にエラー: {e}", exc_info=True)
+
+    @_refresh_library_loop.before_loop
+    async def _before_refresh_library_loop(self):
+        await asyncio.sleep(MUSIC_LIBRARY_REFRESH_INTERVAL) # 起動直後はcog_loadで走査済み
+
+    def _start_library_jobs(self):
+        """まだラウドネスを測っていない曲やOpusに変換していない曲があれば、バックグラウンドで処理し始める"""
+        if not LOUDNESS_ANALYSIS_ENABLED and self.opus_cache is None:
+            return
+        if self._library_jobs_task is None or self._library_jobs_task.done():
+            self._library_jobs_task = asyncio.create_task(self._run_library_jobs())
+
+    async def _run_library_jobs(self):
+        # 変換のときにラウドネス補正を焼き込むので、測定を先に済ませる
+        if LOUDNESS_ANALYSIS_ENABLED:
+            await self._analyze_loudness()
+        if self.opus_cache is not None:
+            await self._transcode_opus()
+
+    async def _analyze_loudness(self):
+        """
+        曲のラウドネスを1曲ずつ測って、揃えるための補正量を索引に書き込む。
+        再生とCPUを取り合わないように、FFmpegは1本ずつしか動かさないわ。
+        """
+        pending = [track for track in self.library.tracks if track.gain_db is None]
+        if not pending:
+            return
+        logger.info(f"ラウドネスの測定を始めます: {len(pending)} 曲")
+        measured = 0
+        try:
+            for track in pending:
+                loudness = await measure_loudness(track.path)
+                # 測れなかった曲は補正なしにしておく (毎回測り直さないように)
+                track.gain_db = loudness_to_gain_db(loudness) if loudness is not None else 0.0
+                measured += 1
+                if measured % 50 == 0:
+                    await asyncio.to_thread(self.library.save)
+        except Exception as e:
+            logger.error(f"ラウドネスの測定中にエラー: {e}", exc_info=True)
+        finally:
+            if measured:
+                await asyncio.to_thread(self.library.save)
+                logger.info(f"ラウドネスの測定が終わりました: {measured}/{len(pending)} 曲")
+
+    async def _transcode_opus(self):
+        """
+        ライブラリの曲を1曲ずつOpusに変換しておく。変換済みの曲は再生のたびにFFmpegでデコードしなくて済むわ。
+        最後に、もう使わない古い変換結果を消しておくの。
+        """
+        tracks = self.library.tracks
+        pending = [track for track in tracks if self.opus_cache.lookup(track) is None]
+        converted = 0
+        if pending:
+            logger.info(f"Opusへの変換を始めます: {len(pending)} 曲")
+            try:
+                for track in pending:
+                    if await self.opus_cache.transcode(track):
+                        converted += 1
+            except Exception as e:
+                logger.error(f"Opusへの変換中にエラー: {e}", exc_info=True)
+                return
+            logger.info(f"Opusへの変換が終わりました: {converted}/{len(pending)} 曲")
+        removed = await asyncio.to_thread(self.opus_cache.prune, tracks)
+        if removed:
+            logger.info(f"古いOpusの変換結果を {removed} 個消しました")
 
     def _ensure_music_dir(self):
         if not os.path.exists(MUSIC_DIR):
@@ -88,95 +192,229 @@ class MusicCog(commands.Cog):
         else:
             logger.info(f"音楽ディレクトリ '{MUSIC_DIR}' は既に存在します。")
 
+    def _session(self, guild_id: int) -> VoiceSession:
+        return get_session(self.bot, guild_id)
+
     def get_vc_connection(self, guild_id: int) -> discord.VoiceClient | None:
-        return self.vc_connections.get(guild_id)
+        session = self._session(guild_id)
+        return session.voice_client if session.is_connected() else None
+
+    def _schedule_idle_leave(self, guild_id: int):
+        """音楽が止まったまま MUSIC_IDLE_TIMEOUT 秒たったら退出する (曲が始まったら取り消すわ)"""
+        session = self._session(guild_id)
+        if session.is_connected():
+            session.schedule_idle(MUSIC_IDLE_TIMEOUT, lambda: self._on_idle_timeout(guild_id))
+
+    async def _on_idle_timeout(self, guild_id: int):
+        session = self._session(guild_id)
+        if session.mixer.is_active(MUSIC):
+            return # その間にまた流れ始めていた
+        if session.mixer.is_active(VOICE): # ママが喋っている最中なら、喋り終わるまで待ってあげる
+            self._schedule_idle_leave(guild_id)
+            return
+        await session.disconnect(f"音楽が{MUSIC_IDLE_TIMEOUT}秒止まったままだった")
+
+    def _build_indexes(self) -> tuple[SearchIndex, FolderTree]:
+        tracks, version = self.library.tracks, self.library.version
+        return SearchIndex(tracks, version), FolderTree(tracks)
+
+    async def _rebuild_indexes(self):
+        """
+        ライブラリの走査結果から検索索引とフォルダ索引を別スレッドで作り直して、できあがったら差し替える。
+        作っている間も、コマンドやオートコンプリートは前の索引でそのまま答えるわ (イベントループでは作らないの)
+        """
+        self.search_index, self.folder_tree = await asyncio.to_thread(self._build_indexes)
+
+    def _get_search_index(self) -> SearchIndex:
+        return self.search_index
 
-    def set_vc_connection(self, guild_id: int, vc: discord.VoiceClient | None):
-        if vc is None and guild_id in self.vc_connections:
-            del self.vc_connections[guild_id]
-        elif vc:
-            self.vc_connections[guild_id] = vc
+    def _get_folder_tree(self) -> FolderTree:
+        return self.folder_tree
 
     def _get_music_files(self) -> list[tuple[str, str]]: # (absolute_path, display_name)
-        music_files_details = []
-        if not os.path.exists(MUSIC_DIR) or not os.path.isdir(MUSIC_DIR):
-            return []
-        
-        # サポートする可能性のある拡張子 (FFmpegが対応するもの)
-        supported_extensions = ('.mp3', '.wav', '.ogg', '.flac', '.m4a', '.aac')
-        
-        for root, _, files in os.walk(MUSIC_DIR):
-            for file in files:
-                if file.lower().endswith(supported_extensions):
-                    full_path = os.path.abspath(os.path.join(root, file)) # 絶対パスで保存
-                    # MUSIC_DIR からの相対パスを表示名とし、OSの標準パス区切り文字に正規化
-                    display_name = os.path.normpath(os.path.relpath(full_path, os.path.abspath(MUSIC_DIR)))
-                    music_files_details.append((full_path, display_name))
-        
-        music_files_details.sort(key=lambda x: x[1]) # display_name (相対パス) でソート
-        return music_files_details
+        # 索引から返すだけなのでディスクには触らない (display_name 順にソート済み)
+        return self.library.details()
+
+    def _create_source(self, track: Track, guild_id: int, prime_frames: int = 0) -> VolumeProcessor:
+        """
+        曲を再生するソースを作る。ギルドの音量と曲ごとのラウドネス補正を掛けるわ。
+        prime_frames を指定すると最初のフレームを先にデコードしておく (ブロッキングするので先読み用ね)。
+        """
+        cached_path = self.opus_cache.lookup(track) if self.opus_cache else None
+        if cached_path:
+            # 変換済みならOggを分解してパケットを読むだけ。ラウドネス補正は変換のときに焼き込み済みよ
+            decoder = OggOpusSource(cached_path)
+            gain_db = 0.0
+            base_volume = self.opus_cache.baked_volume # いつもの音量も焼き込み済みなので、その音量なら素通しよ
+        else:
+            decoder = CountedFFmpegPCMAudio(track.path)
+            gain_db = track.gain_db or 0.0
+            base_volume = 1.0
+        if prime_frames:
+            decoder = PrimedAudioSource(decoder)
+            decoder.prime(prime_frames)
+        if AUDIO_STATS_ENABLED: # デコードの遅れやジッターを測る (/audiostats で見られるわ)
+            decoder = InstrumentedAudioSource(decoder, get_frame_stats(guild_id, MUSIC), label=track.display_name)
+        return VolumeProcessor(decoder, volume=self._session(guild_id).volume, gain_db=gain_db, base_volume=base_volume)
+
+    def _upcoming_track(self, guild_id: int) -> Track | None:
+        """今の曲が終わったら次に流れるはずの曲 (_after_playing のリピート処理と同じ考え方)"""
+        session = self._session(guild_id)
+        current, mode = session.current, session.repeat_mode
+        if mode == RepeatMode.ONE and current:
+            return current
+        if session.queue:
+            return session.queue.peek()
+        if mode == RepeatMode.ALL:
+            return current # キューが今の曲だけなら、もう一度頭から
+        return None
+
+    def _cancel_prefetch(self, guild_id: int):
+        """予約済みの次の曲を取り消す (キューやリピートモードが変わったとき用)"""
+        session = self._session(guild_id)
+        session.prefetch_generation += 1
+        if session.prefetched:
+            session.prefetched = None
+            session.mixer.clear_next(MUSIC)
+
+    def _schedule_prefetch(self, guild_id: int):
+        """次の曲の先読みを (必要なら) バックグラウンドで始める。イベントループから呼んでね"""
+        if MUSIC_PREFETCH_ENABLED:
+            asyncio.create_task(self._prefetch_next(guild_id))
+
+    async def _prefetch_next(self, guild_id: int):
+        """
+        次に流れる曲のFFmpegを立ち上げて最初の数フレームをデコードしておき、ミキサーに予約する。
+        今の曲が終わったフレームでそのまま切り替わるので、曲間にFFmpegの起動待ちが入らないわ。
+        """
+        session = self._session(guild_id)
+        track = self._upcoming_track(guild_id)
+        pending = session.prefetched
+        if pending and pending[0] is track:
+            return # 予約済みの曲のままでいい
+        self._cancel_prefetch(guild_id)
+        if track is None or not self._is_music_active(guild_id) or not os.path.exists(track.path):
+            return
+        generation = session.prefetch_generation
+        try:
+            source = await asyncio.to_thread(self._create_source, track, guild_id, MUSIC_PREFETCH_FRAMES)
+        except Exception as e:
+            logger.warning(f"次の曲の先読みに失敗しました (ギルド {guild_id}, 曲: {track.display_name}): {e}")
+            return
+        # 先読みしている間にキューなどが変わっていたら、この先読みは捨てる
+        if generation != session.prefetch_generation or self._upcoming_track(guild_id) is not track or not self._is_music_active(guild_id):
+            source.cleanup()
+            return
+        session.mixer.set_next(MUSIC, source, after=lambda e: self._after_playing(e, guild_id, track))
+        session.prefetched = (track, source)
+        logger.info(f"次の曲を先読みしました: '{track.display_name}' (ギルド {guild_id})")
+
+    def _on_queue_changed(self, guild_id: int):
+        """キューやリピートモードが変わったら、予約済みの次の曲を見直す"""
+        pending = self._session(guild_id).prefetched
+        if pending and pending[0] is not self._upcoming_track(guild_id):
+            self._cancel_prefetch(guild_id)
+        self._schedule_prefetch(guild_id)
+
+    def _is_music_active(self, guild_id: int) -> bool:
+        """音楽のチャンネルで曲が流れているか (一時停止中も含む)。VCが声だけ流しているときはFalseよ"""
+        return self._session(guild_id).mixer.is_active(MUSIC)
+
+    def _after_playing(self, error, guild_id: int, track_played: Track):
+        """
+        ミキサーから曲が終わったときに呼ばれる。プレイヤーのスレッドから呼ばれることが多いので、
+        ここではセッションに触らずに、終わった曲だけをイベントループに渡すわ (キューの処理は _on_song_finished で)
+        """
+        if not self.bot.loop.is_running(): # ボットがまだ動作しているか確認
+            logger.warning(f"_after_playing: Bot loop not running, cannot play next song for guild {guild_id}")
+            return
+        self.bot.loop.call_soon_threadsafe(self._on_song_finished, error, guild_id, track_played)
 
-    def _after_playing(self, error, guild_id: int, song_path_played: str, song_name_played: str):
-        logger.info(f'_after_playing: Song "{song_name_played}" (Path: {song_path_played}) finished/stopped for guild {guild_id}. Error: {error}')
+    def _on_song_finished(self, error, guild_id: int, track_played: Track):
+        """曲が終わったあとのキュー処理 (リピート・先読みへの切り替え・次の曲の再生)。イベントループで動くわ"""
+        song_name_played = track_played.display_name
+        logger.info(f'_after_playing: Song "{song_name_played}" (Path: {track_played.path}) finished/stopped for guild {guild_id}. Error: {error}')
         
-        # 再生が終わった曲の情報を取得 (リピート処理で使うため pop する前に)
-        # currently_playing_info は _play_next_song で設定されるが、_after_playing の時点ではまだ残っているはず
-        # しかし、song_path_played と song_name_played を引数で受け取るようにしたので、そちらを使用する
-
-        self.currently_playing_info.pop(guild_id, None) # 現在再生中の情報をクリア
+        # 再生が終わった曲は引数で受け取るので、session.current はここでクリアしてよい
+        session = self._session(guild_id)
+        session.current = None # 現在再生中の情報をクリア
 
         if error:
             logger.error(f'音楽再生エラー (ギルド {guild_id}, 曲: {song_name_played}): {error}')
 
-        current_repeat_mode = self.repeat_modes.get(guild_id, RepeatMode.NONE)
-        queue = self.music_queues.setdefault(guild_id, [])
+        # ミキサーが予約済みの次の曲にもう切り替えていたら、キューの状態をそれに合わせるだけでいいわ
+        pending, session.prefetched = session.prefetched, None
+        if pending and session.mixer.source(MUSIC) is pending[1]:
+            self._advance_to_prefetched(guild_id, track_played, pending[0])
+            return
+        if pending:
+            session.mixer.clear_next(MUSIC) # 切り替わらなかった先読みは捨てる
+
+        current_repeat_mode = session.repeat_mode
+        queue = session.queue
 
-        if song_path_played and song_name_played: # 有効な曲情報がある場合のみリピート処理
+        if track_played: # 有効な曲情報がある場合のみリピート処理
             if current_repeat_mode == RepeatMode.ONE:
-                queue.insert(0, (song_path_played, song_name_played))
+                queue.push_front(track_played)
                 logger.info(f"[Guild {guild_id}] リピート(1曲): {song_name_played} をキューの先頭に追加しました。")
             elif current_repeat_mode == RepeatMode.ALL:
-                queue.append((song_path_played, song_name_played))
+                queue.push(track_played)
                 logger.info(f"[Guild {guild_id}] リピート(全曲): {song_name_played} をキューの末尾に追加しました。")
 
-        # VoiceCogによる中断からの再開が保留されている場合は、自動で次の曲へは進まない
-        if guild_id not in self.song_details_to_resume_after_voice:
-            if self.bot.loop.is_running(): # ボットがまだ動作しているか確認
-                logger.info(f"_after_playing: Not a voice interruption, attempting to play next for guild {guild_id}")
-                asyncio.run_coroutine_threadsafe(self._play_next_song(guild_id), self.bot.loop)
-            else:
-                logger.warning(f"_after_playing: Bot loop not running, cannot play next song for guild {guild_id}")
+        # VoiceCogの声はミキサーで重ねるだけなので、曲が終わったら常に次の曲へ進んでいいわ
+        logger.info(f"_after_playing: Attempting to play next for guild {guild_id}")
+        asyncio.create_task(self._play_next_song(guild_id))
+
+    def _advance_to_prefetched(self, guild_id: int, track_played: Track, next_track: Track):
+        """先読みしていた曲に切り替わったときのキュー処理。_on_song_finished からイベントループで呼ばれるわ"""
+        session = self._session(guild_id)
+        queue = session.queue
+        current_repeat_mode = session.repeat_mode
+        if current_repeat_mode == RepeatMode.ONE:
+            queue.push_front(track_played)
+        elif current_repeat_mode == RepeatMode.ALL:
+            queue.push(track_played)
+        # 普通はキューの先頭が先読みした曲。切り替えと同時にキューがいじられていたら、その曲だけ取り除く
+        if queue.peek() is next_track:
+            queue.pop()
         else:
-            logger.info(f"_after_playing: Voice interruption detected (resume pending for {self.song_details_to_resume_after_voice.get(guild_id, {}).get('name')}) for guild {guild_id}. Not playing next song automatically.")
+            queue.discard(next_track)
+        session.current = next_track
+        logger.info(f"_after_playing: Switched to prefetched '{next_track.display_name}' without a gap for guild {guild_id}")
+        asyncio.create_task(self._on_song_started(guild_id, next_track))
+
+    async def _on_song_started(self, guild_id: int, track: Track):
+        """曲が流れ始めたら、通知して次の曲を先読みしておく"""
+        current_vc = self.get_vc_connection(guild_id)
+        if current_vc:
+            await self._announce_now_playing(guild_id, current_vc, track.display_name)
+        self._schedule_prefetch(guild_id)
 
     async def _play_next_song(self, guild_id: int):
         """キューから次の曲を再生する内部メソッド"""
-        current_vc = self.get_vc_connection(guild_id)
-        if not current_vc or not current_vc.is_connected():
+        session = self._session(guild_id)
+        current_vc = session.voice_client
+        if not session.is_connected():
             logger.warning(f"VCに接続されていません。次の曲を再生できません (ギルド {guild_id})。")
-            if guild_id in self.music_queues: # VCがないならキューもクリアした方が安全
-                self.music_queues[guild_id].clear()
+            session.queue.clear() # VCがないならキューもクリアした方が安全
             return
         
         logger.info(f"_play_next_song: Called for guild {guild_id}. VC Status - Playing: {current_vc.is_playing()}, Paused: {current_vc.is_paused()}")
 
-        if guild_id not in self.music_queues or not self.music_queues[guild_id]:
+        if not session.queue:
             logger.info(f"_play_next_song: 音楽キューが空です (ギルド {guild_id})。再生を停止します。")
-            # オプション: キューが空になったらVCから自動退出するロジック
-            # if current_vc and current_vc.is_connected():
-            #     # await current_vc.channel.send("キューが空になったので、少ししたら退出するわね。")
-            #     # await asyncio.sleep(60) # 60秒後に退出など
-            #     # if not self.music_queues.get(guild_id): # 再度キューが空か確認
-            #     #    await current_vc.disconnect()
-            #     #    self.set_vc_connection(guild_id, None)
+            # しばらく何も流さなければVCから自動退出する (その間に曲が追加されたら取り消すわ)
+            self._schedule_idle_leave(guild_id)
             return
 
-        if current_vc.is_playing() or current_vc.is_paused():
+        mixer = session.mixer
+        if mixer.is_active(MUSIC):
             # 通常、_after_playing から呼ばれるので、この状態は稀だが念のため
-            logger.info(f"_play_next_song: VCは既に何かを再生/一時停止中です。処理をスキップします (ギルド {guild_id})。")
+            logger.info(f"_play_next_song: 音楽は既に再生/一時停止中です。処理をスキップします (ギルド {guild_id})。")
             return
 
-        song_path, song_name = self.music_queues[guild_id].pop(0) # キューの先頭から取得して削除
+        track = session.queue.pop() # キューの先頭から取得して削除 (O(1))
+        song_path, song_name = track.path, track.display_name
 
         if not os.path.exists(song_path):
             logger.error(f"次の曲のファイルが見つかりません: {song_path} (ギルド {guild_id})")
@@ -194,57 +432,20 @@ class MusicCog(commands.Cog):
 
         try:
             # 現在再生中の情報を更新
-            self.currently_playing_info[guild_id] = {'path': song_path, 'name': song_name}
+            session.current = track
+            session.cancel_idle()
             logger.info(f"_play_next_song: Preparing to play '{song_name}' in guild {guild_id}")
 
-            # FFmpegPCMAudioをPCMVolumeTransformerでラップして音量を調整
-            source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(song_path), volume=0.1) # 音量を調整
-            current_vc.play(source, after=lambda e: self._after_playing(e, guild_id, song_path, song_name)) # song_pathも渡す
+            # FFmpegPCMAudioを音量調整 (VolumeProcessor) と再生位置を数えるラッパーで包む
+            # VCにはミキサーを流しておいて、曲はその音楽チャンネルに差し込む (声と重ねられるように)
+            source = self._create_source(track, guild_id)
+            mixer.play(MUSIC, source, after=lambda e: self._after_playing(e, guild_id, track)) # 再生した曲も渡す
+            mixer.ensure_playing(current_vc)
             
             log_message = f"'{song_name}' の再生を開始するわよ♬ (ギルド {guild_id})"
             logger.info(log_message)
-
-            # Discordにも通知
-            notification_channel = None
-            voice_channel_for_notification = current_vc.channel
-
-            if voice_channel_for_notification and isinstance(voice_channel_for_notification, discord.VoiceChannel):
-                try:
-                    notification_channel = voice_channel_for_notification.text_in_voice_channel
-                    if notification_channel:
-                        logger.info(f"再生開始通知: ボイスチャンネル '{voice_channel_for_notification.name}' のテキストチャット (ID: {notification_channel.id}) を使用します。")
-                except AttributeError:
-                    logger.warning(f"再生開始通知: 'text_in_voice_channel' 属性が見つかりません。コマンド実行チャンネルへのフォールバックを試みます。 (ギルド {guild_id})")
-                    notification_channel = None
-                
-                if not notification_channel:
-                    logger.info(f"再生開始通知: ボイスチャンネル '{voice_channel_for_notification.name}' に紐づくテキストチャットが見つからないか属性がありません。コマンド実行チャンネルへのフォールバックを試みます。 (ギルド {guild_id})")
-            
-            if not notification_channel:
-                last_cmd_channel_id = self.last_text_channel_ids.get(guild_id)
-                if last_cmd_channel_id:
-                    notification_channel = self.bot.get_channel(last_cmd_channel_id)
-                    if notification_channel and isinstance(notification_channel, discord.TextChannel):
-                        logger.info(f"再生開始通知: フォールバックとしてコマンド実行チャンネル '{notification_channel.name}' (ID: {notification_channel.id}) を使用します。 (ギルド {guild_id})")
-                    elif notification_channel:
-                        logger.warning(f"再生開始通知: フォールバック先のチャンネルID {last_cmd_channel_id} はテキストチャンネルではありません。タイプ: {type(notification_channel)} (ギルド {guild_id})")
-                        notification_channel = None
-                    else:
-                        logger.warning(f"再生開始通知: フォールバック先のチャンネルID {last_cmd_channel_id} が見つかりません。 (ギルド {guild_id})")
-                        notification_channel = None
-                else:
-                    logger.warning(f"再生開始通知: ボイスチャンネルチャットもコマンド実行チャンネルも見つかりません (ギルド {guild_id})。")
-
-            if notification_channel:
-                try:
-                    await notification_channel.send(f"🎶 '{song_name}' の再生を開始するわよ♬")
-                    logger.info(f"再生開始通知をチャンネル '{notification_channel.name}' に送信しました: '{song_name}' (ギルド {guild_id})")
-                except discord.Forbidden:
-                    logger.warning(f"チャンネル {notification_channel.id} ('{notification_channel.name}') へのメッセージ送信権限がありません。 (ギルド {guild_id})")
-                except Exception as e:
-                    logger.error(f"再生開始通知の送信中にエラー (チャンネル: {notification_channel.name}, ID: {notification_channel.id}, ギルド {guild_id}): {e}", exc_info=True)
-            else:
-                logger.warning(f"再生開始通知: 送信先のチャンネルが見つかりませんでした (ギルド {guild_id})。")
+            await self._announce_now_playing(guild_id, current_vc, song_name)
+            self._schedule_prefetch(guild_id)
 
         except Exception as e:
             logger.error(f"_play_next_song: 再生開始時にエラー (ギルド {guild_id}, 曲: {song_name}): {e}", exc_info=True)
@@ -254,7 +455,7 @@ class MusicCog(commands.Cog):
             # (この部分は上記通知ロジックをコピー＆ペーストして変数名を変えるなどして実装)
             # ... (上記 notification_channel を特定するロジックと同様のものをここに記述) ...
             # 簡単のため、ここでは最後にコマンドが使われたチャンネルのみ試行
-            last_cmd_channel_id_for_error = self.last_text_channel_ids.get(guild_id)
+            last_cmd_channel_id_for_error = session.text_channel_id
             if last_cmd_channel_id_for_error:
                 error_notification_channel = self.bot.get_channel(last_cmd_channel_id_for_error)
 
@@ -266,23 +467,65 @@ class MusicCog(commands.Cog):
             else:
                 logger.warning(f"再生エラー通知の送信先チャンネルが見つかりませんでした (ギルド {guild_id})。")
 
-            self.currently_playing_info.pop(guild_id, None) # 再生失敗したのでクリア
+            session.current = None # 再生失敗したのでクリア
             await self._play_next_song(guild_id) # エラーが発生した場合でも、次の曲の再生を試みる
 
-    async def _add_to_queue_and_play(self, interaction: discord.Interaction, songs_to_add: list[tuple[str, str]], success_message_prefix: str):
+    async def _announce_now_playing(self, guild_id: int, current_vc: discord.VoiceClient, song_name: str):
+        """再生開始をDiscordにも通知する"""
+        # Discordにも通知
+        notification_channel = None
+        voice_channel_for_notification = current_vc.channel
+
+        if voice_channel_for_notification and isinstance(voice_channel_for_notification, discord.VoiceChannel):
+            try:
+                notification_channel = voice_channel_for_notification.text_in_voice_channel
+                if notification_channel:
+                    logger.info(f"再生開始通知: ボイスチャンネル '{voice_channel_for_notification.name}' のテキストチャット (ID: {notification_channel.id}) を使用します。")
+            except AttributeError:
+                logger.warning(f"再生開始通知: 'text_in_voice_channel' 属性が見つかりません。コマンド実行チャンネルへのフォールバックを試みます。 (ギルド {guild_id})")
+                notification_channel = None
+            
+            if not notification_channel:
+                logger.info(f"再生開始通知: ボイスチャンネル '{voice_channel_for_notification.name}' に紐づくテキストチャットが見つからないか属性がありません。コマンド実行チャンネルへのフォールバックを試みます。 (ギルド {guild_id})")
+        
+        if not notification_channel:
+            last_cmd_channel_id = self._session(guild_id).text_channel_id
+            if last_cmd_channel_id:
+                notification_channel = self.bot.get_channel(last_cmd_channel_id)
+                if notification_channel and isinstance(notification_channel, discord.TextChannel):
+                    logger.info(f"再生開始通知: フォールバックとしてコマンド実行チャンネル '{notification_channel.name}' (ID: {notification_channel.id}) を使用します。 (ギルド {guild_id})")
+                elif notification_channel:
+                    logger.warning(f"再生開始通知: フォールバック先のチャンネルID {last_cmd_channel_id} はテキストチャンネルではありません。タイプ: {type(notification_channel)} (ギルド {guild_id})")
+                    notification_channel = None
+                else:
+                    logger.warning(f"再生開始通知: フォールバック先のチャンネルID {last_cmd_channel_id} が見つかりません。 (ギルド {guild_id})")
+                    notification_channel = None
+            else:
+                logger.warning(f"再生開始通知: ボイスチャンネルチャットもコマンド実行チャンネルも見つかりません (ギルド {guild_id})。")
+
+        if notification_channel:
+            try:
+                await notification_channel.send(f"🎶 '{song_name}' の再生を開始するわよ♬")
+                logger.info(f"再生開始通知をチャンネル '{notification_channel.name}' に送信しました: '{song_name}' (ギルド {guild_id})")
+            except discord.Forbidden:
+                logger.warning(f"チャンネル {notification_channel.id} ('{notification_channel.name}') へのメッセージ送信権限がありません。 (ギルド {guild_id})")
+            except Exception as e:
+                logger.error(f"再生開始通知の送信中にエラー (チャンネル: {notification_channel.name}, ID: {notification_channel.id}, ギルド {guild_id}): {e}", exc_info=True)
+        else:
+            logger.warning(f"再生開始通知: 送信先のチャンネルが見つかりませんでした (ギルド {guild_id})。")
+
+    async def _add_to_queue_and_play(self, interaction: discord.Interaction, songs_to_add: list[Track], success_message_prefix: str):
         """複数の曲をキューに追加し、必要であれば再生を開始する共通ヘルパー"""
         guild_id = interaction.guild.id
-        self.last_text_channel_ids[guild_id] = interaction.channel.id # コマンドが使われたチャンネルを記憶
+        self._session(guild_id).text_channel_id = interaction.channel.id # コマンドが使われたチャンネルを記憶
         vc_channel = interaction.user.voice.channel # このメソッドを呼ぶ前にVCにいることは確認済みのはず
         if not songs_to_add:
             await interaction.followup.send("追加する曲が見つからなかったわ。") # 基本的にはここには来ないはず
             return
 
-        if guild_id not in self.music_queues:
-            self.music_queues[guild_id] = []
-
-        for song_path, song_name in songs_to_add:
-            self.music_queues[guild_id].append((song_path, song_name))
+        session = self._session(guild_id)
+        session.queue.extend(songs_to_add)
+        self._on_queue_changed(guild_id)
         
         added_songs_summary = ""
         if songs_to_add:
@@ -291,26 +534,24 @@ class MusicCog(commands.Cog):
                 pass
             else: # 複数曲の場合
                 added_songs_summary += "\n**追加された曲の一部:**\n"
-                for i, (_, display_name) in enumerate(songs_to_add[:ITEMS_IN_SUMMARY]):
-                    added_songs_summary += f"- {display_name}\n"
+                for track in songs_to_add[:ITEMS_IN_SUMMARY]:
+                    added_songs_summary += f"- {track.display_name}\n"
                 if len(songs_to_add) > ITEMS_IN_SUMMARY:
                     added_songs_summary += f"...他{len(songs_to_add) - ITEMS_IN_SUMMARY}曲\n"
 
-        current_vc = self.get_vc_connection(guild_id)
         base_response_message = "" # "再生するわね" や "キューに追加したわ" の部分
 
         try:
-            if current_vc is None or not current_vc.is_connected():
-                current_vc = await vc_channel.connect()
-                self.set_vc_connection(guild_id, current_vc)
-                logger.info(f"VCに接続しました: {vc_channel.name} (ギルド {guild_id})")
+            # 接続や移動はセッションがまとめてやってくれる (VoiceCogが接続済みならそれを使い回すわ)
+            was_connected = session.is_connected()
+            previous_channel = session.channel
+            await session.connect(vc_channel)
+            if not was_connected:
                 base_response_message = f"{success_message_prefix} 再生するわね 🎶"
                 await interaction.followup.send(f"{base_response_message}{added_songs_summary}")
                 asyncio.create_task(self._play_next_song(guild_id))
-            elif current_vc.channel != vc_channel:
-                await current_vc.move_to(vc_channel)
-                logger.info(f"VCを移動しました: {vc_channel.name} (ギルド {guild_id})")
-                if not (current_vc.is_playing() or current_vc.is_paused()):
+            elif previous_channel != vc_channel:
+                if not self._is_music_active(guild_id):
                     base_response_message = f"チャンネルを移動したわね。{success_message_prefix} 再生を開始するわ 🎶"
                     await interaction.followup.send(f"{base_response_message}{added_songs_summary}")
                     asyncio.create_task(self._play_next_song(guild_id))
@@ -318,12 +559,12 @@ class MusicCog(commands.Cog):
                     base_response_message = f"{success_message_prefix} キューの最後に追加したわ。"
                     await interaction.followup.send(f"{base_response_message}{added_songs_summary}")
             else: # 同じチャンネルに既に接続済み
-                if current_vc.is_playing() or current_vc.is_paused():
+                if self._is_music_active(guild_id):
                     base_response_message = f"{success_message_prefix} キューの最後に追加したわ。順番が来たら再生するわね。"
                 else:
                     base_response_message = f"{success_message_prefix} 再生を開始するわ 🎶"
                 await interaction.followup.send(f"{base_response_message}{added_songs_summary}")
-                if not (current_vc.is_playing() or current_vc.is_paused()): # 再生中でなければ再生開始
+                if not self._is_music_active(guild_id): # 再生中でなければ再生開始
                     asyncio.create_task(self._play_next_song(guild_id))
 
         except Exception as e:
@@ -367,7 +608,7 @@ class MusicCog(commands.Cog):
             return
 
         guild_id = interaction.guild.id
-        self.last_text_channel_ids[guild_id] = interaction.channel.id # コマンドが使われたチャンネルを記憶
+        self._session(guild_id).text_channel_id = interaction.channel.id # コマンドが使われたチャンネルを記憶
 
 
         if interaction.user.voice is None or interaction.user.voice.channel is None:
@@ -379,73 +620,47 @@ class MusicCog(commands.Cog):
             await interaction.followup.send(f"ごめんなさい、'{MUSIC_DIR}' フォルダに再生できる曲が見当たらないわ。`/listmusic` で確認してみて。")
             return
 
-        song_query_lower = song_query.lower()
-        
-        # 優先度順に検索
-        # 優先度1: display_name (フォルダパス含むファイル名) が song_query と完全一致
-        level1_matches = list(set([
-            (fp, dn) for fp, dn in music_files_details if song_query_lower == dn.lower()
-        ]))
-
-        # 優先度2: ファイル名部分(拡張子なし) が song_query と完全一致
-        level2_matches = []
-        if not level1_matches:
-            level2_matches = list(set([
-                (fp, dn) for fp, dn in music_files_details 
-                if song_query_lower == os.path.splitext(os.path.basename(dn))[0].lower()
-            ]))
-
-        # 優先度3: song_query が display_name に含まれる (部分一致)
-        level3_matches = []
-        if not level1_matches and not level2_matches:
-            level3_matches = list(set([
-                (fp, dn) for fp, dn in music_files_details if song_query_lower in dn.lower()
-            ]))
-        
-        # 優先度4: song_query が ファイル名部分(拡張子なし) に含まれる (部分一致)
-        level4_matches = []
-        if not level1_matches and not level2_matches and not level3_matches:
-            level4_matches = list(set([
-                (fp, dn) for fp, dn in music_files_details 
-                if song_query_lower in os.path.splitext(os.path.basename(dn))[0].lower()
-            ]))
-
-        final_matches = []
-        if level1_matches:
-            final_matches = level1_matches
-        elif level2_matches:
-            final_matches = level2_matches
-        elif level3_matches:
-            final_matches = level3_matches
-        elif level4_matches:
-            final_matches = level4_matches
-        
-        found_song_details_tuple = None # (full_path, display_name)
+        # 検索索引で優先度順に探す (完全一致 → ファイル名一致 → 部分一致 → あいまい一致)
+        final_matches = self._get_search_index().resolve(song_query)
+
+        found_track = None
 
         if len(final_matches) == 1:
-            found_song_details_tuple = final_matches[0]
+            found_track = final_matches[0]
         elif len(final_matches) > 1:
-            files_list_str = "\n".join([f"- {dn}" for _, dn in final_matches[:5]]) # 上位5件を表示
+            files_list_str = "\n".join([f"- {track.display_name}" for track in final_matches[:5]]) # 上位5件を表示
             await interaction.followup.send(
                 f"'{song_query}' に合いそうな曲が複数見つかったわ。\n{files_list_str}\nもっと詳しく指定するか、`/listmusic` で確認してちょうだい。"
             )
             return
         
-        if not found_song_details_tuple:
+        if not found_track:
             await interaction.followup.send(f"ごめんなさいね、'{song_query}' という曲は見つからなかったわ。`/listmusic` で再生できる曲を確認してみて。")
             return
 
-        song_path_to_play, song_name_to_display = found_song_details_tuple
+        song_path_to_play, song_name_to_display = found_track.path, found_track.display_name
 
         if not os.path.exists(song_path_to_play): # 念のため (フルパスのはず)
             await interaction.followup.send(f"あら、'{song_name_to_display}' が見つかったけどファイルが存在しないみたい…？")
             logger.error(f"ファイルが見つかりません (フルパスのはず): {song_path_to_play}")
             return
 
-        songs_to_add = [(song_path_to_play, song_name_to_display)]
+        songs_to_add = [found_track]
         message_prefix = f"わかったわ、'{song_name_to_display}' を" # _add_to_queue_and_play で "再生するわね" などが続く
         await self._add_to_queue_and_play(interaction, songs_to_add, message_prefix)
 
+    @play_music_command.autocomplete("song_query")
+    async def song_query_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        # Discordは3秒しか待ってくれないので、索引だけで即答する
+        return [
+            app_commands.Choice(name=self._truncate_choice(track.display_name), value=track.display_name[:100])
+            for track in self._get_search_index().suggest(current, limit=25)
+        ]
+
+    @staticmethod
+    def _truncate_choice(text: str) -> str:
+        return text if len(text) <= 100 else text[:99] + "…" # 選択肢の表示名は100文字まで
+
     @app_commands.command(name="playfolder", description="指定したフォルダ内の曲をまとめて再生/キュー追加するわ")
     @app_commands.describe(folder_path="再生したいフォルダのパス (例: J-POP や アニソン/お気に入り)")
     @app_commands.guilds(*GUILDS)
@@ -458,7 +673,7 @@ class MusicCog(commands.Cog):
             return
 
         guild_id = interaction.guild.id
-        self.last_text_channel_ids[guild_id] = interaction.channel.id # コマンドが使われたチャンネルを記憶
+        self._session(guild_id).text_channel_id = interaction.channel.id # コマンドが使われたチャンネルを記憶
 
         if interaction.user.voice is None or interaction.user.voice.channel is None:
             await interaction.followup.send("ボイスチャンネルに入ってから呼んでちょうだい🎧")
@@ -469,33 +684,25 @@ class MusicCog(commands.Cog):
             await interaction.followup.send(f"ごめんなさい、'{MUSIC_DIR}' フォルダに再生できる曲が見当たらないわ。")
             return
 
-        normalized_folder_path_query_str = str(Path(os.path.normpath(folder_path.lower())))
-        
-        songs_in_folder = []
-        for full_path, display_name in music_files_details:
-            # display_name の親ディレクトリのパス文字列を取得し、正規化・小文字化
-            # 例: display_name = "J-POP/ArtistX/SongC.mp3" -> parent_dir_str = "j-pop/artistx" (OS依存の区切り文字)
-            # Pathオブジェクトを使うことでOS間のパス区切り文字の違いを吸収
-            normalized_display_name_obj = Path(os.path.normpath(display_name.lower()))
-            current_song_parent_dir_str = str(normalized_display_name_obj.parent)
-
-            # 指定されたフォルダパスが、曲の親フォルダパスと一致するか、
-            # または曲の親フォルダパスが指定されたフォルダパスで始まる（サブフォルダ内も含む）場合に合致
-            if current_song_parent_dir_str == normalized_folder_path_query_str or \
-               current_song_parent_dir_str.startswith(normalized_folder_path_query_str + os.sep):
-                songs_in_folder.append((full_path, display_name))
-        
-        if not songs_in_folder:
+        # フォルダ索引を引いて、配下 (サブフォルダ含む) の曲を表示名順でまとめて取り出す
+        folder_tree = self._get_folder_tree()
+        folder_node = folder_tree.resolve(folder_path)
+        if folder_node is None:
             await interaction.followup.send(f"ごめんなさいね、フォルダ '{folder_path}' に曲が見つからなかったわ。パスを確認してみて。")
             return
-
-        # 曲順を display_name でソート (フォルダ内でファイル名順になるように)
-        songs_in_folder.sort(key=lambda x: x[1])
+        songs_in_folder = folder_tree.tracks_in(folder_node)
 
         num_added = len(songs_in_folder)
         message_prefix = f"フォルダ '{folder_path}' の {num_added}曲を" # "から" を削除して自然に
         await self._add_to_queue_and_play(interaction, songs_in_folder, message_prefix)
 
+    @play_folder_command.autocomplete("folder_path")
+    async def folder_path_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        return [
+            app_commands.Choice(name=self._truncate_choice(f"{node.path} ({node.count}曲)"), value=node.path[:100])
+            for node in self._get_folder_tree().suggest(current, limit=25)
+        ]
+
     @app_commands.command(name="skipmusic", description="今の曲をスキップして、キューの次の曲を再生するわ")
     @app_commands.guilds(*GUILDS)
     async def skip_music_command(self, interaction: discord.Interaction):
@@ -511,23 +718,25 @@ class MusicCog(commands.Cog):
             await interaction.response.send_message("アタシ、今ボイスチャンネルにいないみたいよ。", ephemeral=True)
             return
         
-        if not (current_vc.is_playing() or current_vc.is_paused()):
+        if not self._is_music_active(guild_id):
             await interaction.response.send_message("今、何も再生してないみたいね。スキップできないわ。", ephemeral=True)
             return
 
-        queue = self.music_queues.get(guild_id)
-        if not queue: # キューが空（または存在しない）
+        queue = self._session(guild_id).queue
+        if not queue: # キューが空
             await interaction.response.send_message("キューに次の曲がないわ。今の曲を止めるわね。")
-            current_vc.stop() # afterコールバックが呼ばれ、キューが空なので_play_next_songは何もしない
+            self._session(guild_id).mixer.stop(MUSIC) # afterコールバックが呼ばれ、キューが空なので_play_next_songは何もしない
         else:
             # キューの先頭（次に再生される曲）の名前を取得
-            _, next_song_name = queue[0] # (full_path, display_name)
+            next_song_name = queue.peek().display_name
             await interaction.response.send_message(f"わかったわ、今の曲をスキップして、次は '{next_song_name}' を再生するわね！")
-            current_vc.stop() # これで _after_playing が呼ばれ、_play_next_song が実行される
+            # 先読み済みならその場で切り替わる。なければ _after_playing が呼ばれ、_play_next_song が実行される
+            self._session(guild_id).mixer.skip(MUSIC)
 
     @app_commands.command(name="queuemusic", description="今の音楽再生キューを表示するわ")
+    @app_commands.describe(page="表示するページ (1から。省略したら最初のページよ)")
     @app_commands.guilds(*GUILDS)
-    async def queue_music_command(self, interaction: discord.Interaction):
+    async def queue_music_command(self, interaction: discord.Interaction, page: app_commands.Range[int, 1] = 1):
         logger.info(f"/queuemusic from {interaction.user} in {interaction.guild.name}")
         await interaction.response.defer(thinking=True)
 
@@ -536,12 +745,13 @@ class MusicCog(commands.Cog):
             return
         guild_id = interaction.guild.id
 
-        queue = self.music_queues.get(guild_id)
+        session = self._session(guild_id)
+        queue = session.queue
         if not queue:
             await interaction.followup.send("音楽キューは空っぽよ。何かリクエストしてちょうだい💋")
             return
 
-        current_repeat_mode = self.repeat_modes.get(guild_id, RepeatMode.NONE)
+        current_repeat_mode = session.repeat_mode
         mode_text = "オフ"
         if current_repeat_mode == RepeatMode.ONE:
             mode_text = "現在の曲をリピート"
@@ -550,20 +760,20 @@ class MusicCog(commands.Cog):
 
         embed = discord.Embed(title="🎵 再生待機中の曲リスト 🎵", color=discord.Color.purple())
         
+        # 1ページに QUEUE_ITEMS_PER_PAGE 曲ずつ表示（多すぎるとメッセージが長くなるため）
+        total_pages = math.ceil(len(queue) / QUEUE_ITEMS_PER_PAGE)
+        page = min(page, total_pages)
+        start_index = (page - 1) * QUEUE_ITEMS_PER_PAGE
         queue_description = ""
-        # キューの曲は (song_path, song_name) のタプル
-        # 最大10曲表示（多すぎるとメッセージが長くなるため）
-        for i, (_, song_name) in enumerate(queue[:10]): # song_name は表示名 (例: J-POP/曲.mp3)
-            queue_description += f"{i+1}. {song_name}\n"
+        for i, track in enumerate(queue.page(page - 1, QUEUE_ITEMS_PER_PAGE), start=start_index + 1):
+            queue_description += f"{i}. {track.display_name}\n" # 表示名 (例: J-POP/曲.mp3)
         
         if not queue_description:
              await interaction.followup.send("音楽キューは空っぽみたい。") # 通常ここには来ないはず
              return
 
         embed.description = queue_description
-        if len(queue) > 10:
-            queue_description += f"...他{len(queue)-10}曲"
-        embed.set_footer(text=f"全 {len(queue)} 曲が待機中 | リピートモード: {mode_text}")
+        embed.set_footer(text=f"ページ {page}/{total_pages} | 全 {len(queue)} 曲が待機中 | リピートモード: {mode_text}")
         await interaction.followup.send(embed=embed)
 
     @app_commands.command(name="clearmusicqueue", description="音楽再生キューを空にするわ")
@@ -576,12 +786,67 @@ class MusicCog(commands.Cog):
             return
         guild_id = interaction.guild.id
 
-        if guild_id in self.music_queues and self.music_queues[guild_id]:
-            self.music_queues[guild_id].clear()
+        queue = self._session(guild_id).queue
+        if queue:
+            queue.clear()
+            self._on_queue_changed(guild_id)
             await interaction.response.send_message("音楽キューを空にしたわ。")
         else:
             await interaction.response.send_message("音楽キューはもう空っぽよ。", ephemeral=True)
 
+    @app_commands.command(name="shufflemusic", description="音楽再生キューの順番をシャッフルするわ")
+    @app_commands.guilds(*GUILDS)
+    async def shuffle_music_command(self, interaction: discord.Interaction):
+        logger.info(f"/shufflemusic from {interaction.user} in {interaction.guild.name}")
+
+        if not interaction.guild:
+            await interaction.response.send_message("このコマンドはサーバー内でのみ使用可能です。", ephemeral=True)
+            return
+        guild_id = interaction.guild.id
+        queue = self._session(guild_id).queue
+        if not queue:
+            await interaction.response.send_message("音楽キューは空っぽよ。", ephemeral=True)
+            return
+        queue.shuffle()
+        self._on_queue_changed(guild_id)
+        await interaction.response.send_message(f"キューの {len(queue)} 曲をシャッフルしたわ🎲")
+
+    @app_commands.command(name="removemusic", description="音楽再生キューから指定した番号の曲を取り除くわ")
+    @app_commands.describe(position="取り除く曲の番号 (/queuemusic の番号よ)")
+    @app_commands.guilds(*GUILDS)
+    async def remove_music_command(self, interaction: discord.Interaction, position: app_commands.Range[int, 1]):
+        logger.info(f"/removemusic position: {position} from {interaction.user} in {interaction.guild.name}")
+
+        if not interaction.guild:
+            await interaction.response.send_message("このコマンドはサーバー内でのみ使用可能です。", ephemeral=True)
+            return
+        guild_id = interaction.guild.id
+        queue = self._session(guild_id).queue
+        if not queue or position > len(queue):
+            await interaction.response.send_message("その番号の曲はキューにないわ。`/queuemusic` で確認してちょうだい。", ephemeral=True)
+            return
+        track = queue.remove(position - 1)
+        self._on_queue_changed(guild_id)
+        await interaction.response.send_message(f"'{track.display_name}' をキューから外したわ。")
+
+    @app_commands.command(name="movemusic", description="音楽再生キューの曲の順番を入れ替えるわ")
+    @app_commands.describe(from_position="動かす曲の番号", to_position="移動先の番号")
+    @app_commands.guilds(*GUILDS)
+    async def move_music_command(self, interaction: discord.Interaction, from_position: app_commands.Range[int, 1], to_position: app_commands.Range[int, 1]):
+        logger.info(f"/movemusic {from_position} -> {to_position} from {interaction.user} in {interaction.guild.name}")
+
+        if not interaction.guild:
+            await interaction.response.send_message("このコマンドはサーバー内でのみ使用可能です。", ephemeral=True)
+            return
+        guild_id = interaction.guild.id
+        queue = self._session(guild_id).queue
+        if not queue or from_position > len(queue) or to_position > len(queue):
+            await interaction.response.send_message("その番号の曲はキューにないわ。`/queuemusic` で確認してちょうだい。", ephemeral=True)
+            return
+        track = queue.move(from_position - 1, to_position - 1)
+        self._on_queue_changed(guild_id)
+        await interaction.response.send_message(f"'{track.display_name}' を {to_position} 番目に移動したわ。")
+
     @app_commands.command(name="stopmusic", description="音楽の再生を止めるわ (キューは残るわよ)")
     @app_commands.guilds(*GUILDS)
     async def stop_music_command(self, interaction: discord.Interaction):
@@ -593,8 +858,11 @@ class MusicCog(commands.Cog):
         guild_id = interaction.guild.id
         current_vc = self.get_vc_connection(guild_id)
 
-        if current_vc and (current_vc.is_playing() or current_vc.is_paused()):
-            current_vc.stop()
+        if current_vc and self._is_music_active(guild_id):
+            session = self._session(guild_id)
+            session.prefetched = None
+            session.mixer.stop(MUSIC) # 声が流れていてもそっちは止めない (予約済みの次の曲も取り消す)
+            self._schedule_idle_leave(guild_id)
             await interaction.response.send_message("音楽を止めたわよ。キューに残ってる曲は `/playmusic` や `/skipmusic` で続きから再生できるわ。")
         else:
             await interaction.response.send_message("今、何も再生してないみたいね。", ephemeral=True)
@@ -608,29 +876,44 @@ class MusicCog(commands.Cog):
             await interaction.response.send_message("このコマンドはサーバー内でのみ使用可能です。", ephemeral=True)
             return
         guild_id = interaction.guild.id
-        current_vc = self.get_vc_connection(guild_id)
-
-        if current_vc and current_vc.is_connected():
-            if current_vc.is_playing() or current_vc.is_paused():
-                current_vc.stop() # 再生中なら止める
-            
-            await current_vc.disconnect()
-            self.set_vc_connection(guild_id, None)
-            
-            if guild_id in self.music_queues: # キューもクリア
-                self.music_queues[guild_id].clear()
-                logger.info(f"音楽キューをクリアしました (ギルド {guild_id})")
+        session = self._session(guild_id)
 
+        if session.is_connected():
+            await session.disconnect("/leavemusic が使われた") # キューもクリアされるわ
             await interaction.response.send_message("ボイスチャンネルから退出したわ。また呼んでちょうだいね💋")
         else:
             # VCにいない場合でもキューが残っている可能性があるのでクリア
-            if guild_id in self.music_queues and self.music_queues[guild_id]:
-                self.music_queues[guild_id].clear()
+            if session.queue:
+                session.queue.clear()
                 logger.info(f"VCにはいなかったけど、音楽キューをクリアしました (ギルド {guild_id})")
                 await interaction.response.send_message("アタシ、今ボイスチャンネルにいないみたいだけど、キューはクリアしておいたわ。", ephemeral=True)
             else:
                 await interaction.response.send_message("アタシ、今ボイスチャンネルにいないみたいよ。", ephemeral=True)
 
+    @app_commands.command(name="volume", description="音楽の音量を変えるわ (省略したら今の音量を教えてあげる)")
+    @app_commands.describe(percent="音量 (0〜100%)。曲ごとの音量の違いはアタシが揃えておくわ")
+    @app_commands.guilds(*GUILDS)
+    async def volume_command(self, interaction: discord.Interaction, percent: app_commands.Range[int, 0, 100] | None = None):
+        logger.info(f"/volume percent: {percent} from {interaction.user} in {interaction.guild.name}")
+        if not interaction.guild:
+            await interaction.response.send_message("このコマンドはサーバー内でのみ使用可能です。", ephemeral=True)
+            return
+        guild_id = interaction.guild.id
+
+        if percent is None:
+            await interaction.response.send_message(f"今の音量は {round(self._session(guild_id).volume * 100)}% よ。", ephemeral=True)
+            return
+
+        volume = percent / 100
+        session = self._session(guild_id)
+        session.volume = volume
+        # 再生中の曲にもすぐ反映する (次のフレームから変わるわ)
+        mixer = session.mixer
+        for source in (mixer.source(MUSIC), mixer.next_source(MUSIC)): # 先読み済みの次の曲も
+            if isinstance(source, VolumeProcessor):
+                source.volume = volume
+        await interaction.response.send_message(f"音量を {percent}% にしたわ。")
+
     @app_commands.command(name="repeatmusic", description="音楽の再生リピートモードを設定するわ")
     @app_commands.describe(mode="リピートモードを選んでちょうだい (off, one, all)")
     @app_commands.choices(mode=[
@@ -649,91 +932,58 @@ class MusicCog(commands.Cog):
         chosen_mode_str = mode.value.lower()
 
         if chosen_mode_str == "off":
-            self.repeat_modes[guild_id] = RepeatMode.NONE
+            self._session(guild_id).repeat_mode = RepeatMode.NONE
             await interaction.response.send_message("リピートをオフにしたわ。")
         elif chosen_mode_str == "one":
-            self.repeat_modes[guild_id] = RepeatMode.ONE
+            self._session(guild_id).repeat_mode = RepeatMode.ONE
             await interaction.response.send_message("今の曲をリピートするわね。")
         elif chosen_mode_str == "all":
-            self.repeat_modes[guild_id] = RepeatMode.ALL
+            self._session(guild_id).repeat_mode = RepeatMode.ALL
             await interaction.response.send_message("キューに入ってる曲を全部リピートするわよ。")
         else: # 通常ここには到達しない
             await interaction.response.send_message("あら、よくわからないモードね。`off`, `one`, `all` から選んでちょうだい。", ephemeral=True)
+            return
+        self._on_queue_changed(guild_id) # 次に流れる曲が変わるかもしれないので先読みを見直す
 
-    async def pause_current_song(self, guild_id: int):
-        """指定されたギルドで再生中の音楽を一時停止するわ"""
-        logger.info(f"pause_current_song: Attempting to pause for guild {guild_id}. Currently playing info from self: {self.currently_playing_info.get(guild_id)}")
-        vc = self.get_vc_connection(guild_id)
-        if vc and vc.is_connected() and vc.is_playing():
-            current_song_info = self.currently_playing_info.get(guild_id)
-            if current_song_info:
-                vc.pause()
-                # VoiceCogによる中断なので、再開情報を保存
-                self.song_details_to_resume_after_voice[guild_id] = current_song_info
-                logger.info(f"pause_current_song: Stored song_details_to_resume_after_voice for guild {guild_id}: {current_song_info}")
-                logger.info(f"音楽を一時停止しました (曲: {current_song_info['name']})。VoiceCogのため再開情報を保存 (ギルド {guild_id})")
-                return True # 正常に情報を保存してpauseした場合のみTrue
-            else:
-                # 再生中だがこちらの管理情報がない。これは異常系。
-                # VoiceCog側で再開を期待させないようにFalseを返す。
-                logger.warning(f"pause_current_song: VC is playing, but no current song info in MusicCog's state for guild {guild_id}. Pausing VC, but returning False as resume info cannot be stored.")
-                vc.pause() # 念のためVCは止める
-                return False # 再開情報がないので、VoiceCogにresumeを期待させない
-        else: # VCがない、接続されてない、または再生中でない
-            logger.info(f"pause_current_song: Conditions for pause not met. VC Connected: {vc.is_connected() if vc else False}, VC Playing: {vc.is_playing() if vc else False} (Guild {guild_id})")
-            return False
-
-
-    async def resume_current_song(self, guild_id: int):
-        """指定されたギルドで一時停止中の音楽を再開するわ"""
-        logger.info(f"resume_current_song: Called for guild {guild_id}")
-        vc = self.get_vc_connection(guild_id)
-        if not vc or not vc.is_connected():
-            logger.warning(f"resume_current_song: VCが見つからないか未接続です (ギルド {guild_id})")
-            self.song_details_to_resume_after_voice.pop(guild_id, None) # VCがないなら再開情報もクリア
-            return False
-
-        details_to_resume = self.song_details_to_resume_after_voice.pop(guild_id, None)
-        resumed_or_played_successfully = False
-
-        if details_to_resume:
-            song_path = details_to_resume['path']
-            song_name = details_to_resume['name']
-            logger.info(f"resume_current_song: VoiceCogによる中断から '{song_name}' の再開を試みます (ギルド {guild_id})")
-
-            if not os.path.exists(song_path):
-                logger.error(f"resume_current_song: 再開しようとした曲のファイルが見つかりません: {song_path} (ギルド {guild_id})")
-                # 再開失敗なので、キューから次に進むことを試みる
-            else:
-                try:
-                    if vc.is_playing() or vc.is_paused(): # VoiceCogの再生が終わった直後は止まっているはずだが念のため
-                        vc.stop()
-                    
-                    # 再開する曲を「現在再生中」として再設定
-                    self.currently_playing_info[guild_id] = {'path': song_path, 'name': song_name}
-                    
-                    source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(song_path), volume=0.1)
-                    vc.play(source, after=lambda e: self._after_playing(e, guild_id, song_name))
-                    logger.info(f"resume_current_song: 中断された曲 '{song_name}' を再開しました (ギルド {guild_id})")
-                    resumed_or_played_successfully = True
-                except Exception as e:
-                    logger.error(f"resume_current_song: '{song_name}' の再開中にエラー: {e}", exc_info=True)
-                    self.currently_playing_info.pop(guild_id, None) # 再生失敗したのでクリア
-                    # 再開失敗、キューから次に進むことを試みる
-
-        if not resumed_or_played_successfully:
-            logger.info(f"resume_current_song: 中断された曲の再開処理が完了したか、中断情報がありませんでした。VCの状態を確認します。Playing: {vc.is_playing()}, Paused: {vc.is_paused()} (ギルド {guild_id})")
-            if not vc.is_playing() and not vc.is_paused(): # VCが何もしていない状態なら
-                if self.music_queues.get(guild_id):
-                    logger.info(f"resume_current_song: キューに次の曲があるので再生します (ギルド {guild_id})")
-                    await self._play_next_song(guild_id) # _play_next_song が成功したかはそちらで判断
-                    resumed_or_played_successfully = True # play_next_songが試みられた
-                else:
-                    logger.info(f"resume_current_song: 再開する曲もキューも空です (ギルド {guild_id})")
-            else:
-                logger.warning(f"resume_current_song: VCが再生中または一時停止中です。次の曲の再生は行いません (ギルド {guild_id})")
+    @app_commands.command(name="audiostats", description="再生の詰まり具合を見るわ (オーナーのみ)")
+    @app_commands.describe(reset="見たあとに数え直すか")
+    @app_commands.guilds(*GUILDS)
+    async def audio_stats_command(self, interaction: discord.Interaction, reset: bool = False):
+        logger.info(f"/audiostats reset: {reset} from {interaction.user} in {interaction.guild.name if interaction.guild else 'DM'}")
+        if not interaction.guild:
+            await interaction.response.send_message("このコマンドはサーバー内でのみ使用可能です。", ephemeral=True)
+            return
+        if not await self.bot.is_owner(interaction.user):
+            await interaction.response.send_message("あら、これはオーナーだけが見られるのよ？", ephemeral=True)
+            return
+        if not AUDIO_STATS_ENABLED:
+            await interaction.response.send_message("再生の計測はオフになっているわ (config.py の AUDIO_STATS_ENABLED)。", ephemeral=True)
+            return
+
+        stats_list = guild_frame_stats(interaction.guild.id)
+        if not stats_list:
+            await interaction.response.send_message("まだこのサーバーでは何も流していないわ。", ephemeral=True)
+            return
 
-        return resumed_or_played_successfully
+        def ms(value: float | None) -> str:
+            return f"{value:.1f}ms" if value is not None else "-"
+
+        lines = ["**再生の統計**"]
+        for stats in stats_list:
+            summary = stats.summary()
+            pipe = "測れないわ" if summary["pipe_bytes"] is None else f"最後 {summary['pipe_bytes']} bytes (空だった {summary['pipe_empty_samples']}/{summary['pipe_samples']} 回)"
+            lines.append(
+                f"**{stats.channel}** ({summary['frames']} フレーム)\n"
+                f"・遅れたフレーム: {summary['late_frames']} / 短いフレーム: {summary['short_frames']}\n"
+                f"・read(): 平均 {ms(summary['read_avg_ms'])} / p95 {ms(summary['read_p95_ms'])} / 最大 {ms(summary['read_max_ms'])}\n"
+                f"・ジッター: p95 {ms(summary['jitter_p95_ms'])} / 最大 {ms(summary['jitter_max_ms'])}\n"
+                f"・FFmpegのパイプ: {pipe}"
+            )
+            if reset:
+                stats.reset()
+        if reset:
+            lines.append("数え直すわね。")
+        await interaction.response.send_message("\n".join(lines), ephemeral=True)
 
 # Bot起動時にCogを読み込むsetup関数
 async def setup(bot: commands.Bot):
@@ -3,62 +3,42 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import asyncio
+import contextlib
 import logging
-import os # output.wavを削除するために追加
-from config import BASE_VOICE_PROMPT, GUILDS # configから読み込み
-from handlers.gemini_handler import GeminiHandler
-from handlers.voicevox_handler import synthesize_voice
+import time
+from config import GUILDS, RESPONSE_CACHE_ENABLED, PROMPT_VOICE_KEYWORD, AUDIO_STATS_ENABLED # configから読み込み
+from handlers.gemini_service import GeminiService, PRIORITY_VOICE, get_gemini_service
+from handlers.response_cache import ResponseCache, get_response_cache
+from handlers.prompt_store import persona_choices, resolve_persona
+from handlers.voicevox_handler import VoicevoxClient
+from audio.tts_cache import TTSCache
+from audio.tts_pipeline import QueuedPCMAudio, SpeechPipeline, stream_sentences
+from audio.mixer import VOICE
+from audio.instrumentation import InstrumentedAudioSource, get_frame_stats
+from core.session import get_session
+from core.metrics import COMMAND_LATENCY, register_cache_stats
 
 
 logger = logging.getLogger(__name__)
 
 class VoiceCog(commands.Cog):
-    def __init__(self, bot: commands.Bot, gemini_handler: GeminiHandler):
+    def __init__(self, bot: commands.Bot, gemini_service: GeminiService, voicevox_client: VoicevoxClient, response_cache: ResponseCache | None = None):
         self.bot = bot
-        self.gemini_handler = gemini_handler
-        self.vc_connections = {}  # ギルドIDをキーにしたVC接続の辞書
-        self.music_pause_states = {} # ギルドID: bool (Trueならvoice再生前にmusicをpauseした)
-        self.auto_disconnect_tasks = {} # ギルドIDをキーにした自動退出タスクの辞書
-        if not BASE_VOICE_PROMPT:
-            logger.warning("voiceコマンド用のベースプロンプトが読み込まれていません。")
-
-    def get_vc_connection(self, guild_id: int) -> discord.VoiceClient | None:
-        return self.vc_connections.get(guild_id)
-
-    def set_vc_connection(self, guild_id: int, vc: discord.VoiceClient | None):
-        if vc is None and guild_id in self.vc_connections:
-            del self.vc_connections[guild_id]
-        elif vc:
-            self.vc_connections[guild_id] = vc
-
-    async def _check_and_auto_disconnect(self, guild_id: int, initial_vc_channel_id: int):
-        logger.info(f"自動退出監視開始: ギルド {guild_id}, チャンネル {initial_vc_channel_id}")
-        await asyncio.sleep(10) # 初期遅延
-
-        while True:
-            vc = self.get_vc_connection(guild_id)
-            if not vc or not vc.is_connected() or vc.channel.id != initial_vc_channel_id:
-                logger.info(f"自動退出監視: VC切断またはチャンネル移動のため監視終了 (ギルド {guild_id})")
-                if guild_id in self.auto_disconnect_tasks: # タスクリストからも削除
-                    del self.auto_disconnect_tasks[guild_id]
-                return # タスク終了
-
-            # ボット自身を除いたメンバー数をカウント
-            human_members = [member for member in vc.channel.members if not member.bot]
-            if not human_members: # ボット以外のメンバーがいない
-                logger.info(f"VC ({vc.channel.name}) に他のユーザーがいなくなったため退出します (ギルド {guild_id})")
-                await vc.disconnect()
-                self.set_vc_connection(guild_id, None)
-                if guild_id in self.auto_disconnect_tasks: # タスクリストからも削除
-                    del self.auto_disconnect_tasks[guild_id]
-                return # タスク終了
-            
-            await asyncio.sleep(20) # チェック間隔
+        self.gemini_service = gemini_service
+        self.voicevox_client = voicevox_client
+        self.response_cache = response_cache
+        # VC接続とミキサーはギルドごとの VoiceSession (MusicCogと共有) にあるわ
+        # ベースプロンプトはコマンドのたびに PromptStore から受け取る (ファイルを書き換えたらすぐ反映されるわ)
+
+    async def cog_unload(self):
+        await self.voicevox_client.close() # 接続プールを閉じる
 
     @app_commands.command(name="voice", description="ママに喋ってもらうわよ♪")
+    @app_commands.describe(persona="喋る人格 (prompt フォルダのファイル名)。省略したらいつものアタシよ")
     @app_commands.guilds(*GUILDS)
-    async def voice_gemini_command(self, interaction: discord.Interaction, *, question: str):
-        logger.info(f"/voice 質問: {question} from {interaction.user} in {interaction.guild.name}")
+    async def voice_gemini_command(self, interaction: discord.Interaction, *, question: str, persona: str | None = None):
+        logger.info(f"/voice 質問: {question} (人格: {persona or PROMPT_VOICE_KEYWORD}) from {interaction.user} in {interaction.guild.name}")
+        started = time.perf_counter()
         await interaction.response.defer(thinking=True)
 
         if not interaction.guild:
@@ -67,154 +47,119 @@ class VoiceCog(commands.Cog):
         
         guild_id = interaction.guild.id
 
-        if not BASE_VOICE_PROMPT:
-            await interaction.followup.send(f"ごめんなさい、voice用の設定がうまくいってないみたい…")
+        base_prompt, persona_notice = resolve_persona(persona, PROMPT_VOICE_KEYWORD)
+
+        if interaction.user.voice is None or interaction.user.voice.channel is None:
+            await interaction.followup.send("ボイスチャンネルに入ってから呼んでちょうだい🎧")
             return
 
         try:
-            full_prompt = BASE_VOICE_PROMPT + question
-            answer_text = await self.gemini_handler.generate_response(full_prompt)
-
-            if not answer_text:
-                await interaction.followup.send("返答が生成できなかったわ…もう一度試してみて。")
-                return
+            # 人格設定 (base_prompt) は使い回せるように別に渡すので、毎回送るのは質問だけよ
+            full_prompt = question
 
-            await interaction.followup.send(f"🎤 **読み上げるわね♪**\n> {question}\n\n{answer_text}")
+            # Geminiの返答をストリーミングで受け取り、文が完成したそばから合成を始める
+            # (WAVはメモリ上でデコードしてそのまま流すので、一時ファイルもFFmpegも使わない)
+            answer_chunks: list[str] = []
+            answer_done = asyncio.Event()
+            # 同じ質問にさっき答えていたら、Geminiを呼ばずにその返答を読み上げる
+            cached_answer = self.response_cache.get(base_prompt, question) if self.response_cache else None
 
-            output_filename = f"output_{guild_id}.wav" # ギルドごとにファイル名を分ける
-            wav_path = synthesize_voice(answer_text, output_path=output_filename)
-            if not wav_path:
-                await interaction.followup.send("VOICEVOXで音声を生成できなかったわ…ごめんなさいね。")
-                return
-            
-            # --- MusicCog連携 ---
-            music_cog = self.bot.get_cog("MusicCog")
-            self.music_pause_states[guild_id] = False # 初期化
-            active_music_vc = None
-
-            if music_cog and hasattr(music_cog, 'pause_current_song') and hasattr(music_cog, 'resume_current_song'):
-                active_music_vc = music_cog.get_vc_connection(guild_id)
-                if active_music_vc and active_music_vc.is_connected() and active_music_vc.is_playing():
-                    if await music_cog.pause_current_song(guild_id):
-                        self.music_pause_states[guild_id] = True
-                        logger.info(f"音楽を一時停止しました (ギルド {guild_id}) for voice playback")
-            # --- MusicCog連携ここまで ---
-
-            if interaction.user.voice is None or interaction.user.voice.channel is None:
-                await interaction.followup.send("ボイスチャンネルに入ってから呼んでちょうだい🎧")
-                if os.path.exists(wav_path): os.remove(wav_path)
+            async def answer_stream():
+                try:
+                    if cached_answer:
+                        logger.info(f"/voice の返答をキャッシュから返します: {question}")
+                        answer_chunks.append(cached_answer)
+                        yield cached_answer
+                        return
+                    gemini_started = time.perf_counter()
+                    async for chunk in self.gemini_service.stream_response(full_prompt, priority=PRIORITY_VOICE, system_prompt=base_prompt):
+                        if not answer_chunks:
+                            COMMAND_LATENCY.observe(time.perf_counter() - gemini_started, command="voice", stage="gemini_first_chunk")
+                        answer_chunks.append(chunk)
+                        yield chunk
+                    COMMAND_LATENCY.observe(time.perf_counter() - gemini_started, command="voice", stage="gemini")
+                    answer_text = "".join(answer_chunks).strip()
+                    if self.response_cache and answer_text:
+                        self.response_cache.put(base_prompt, question, answer_text)
+                finally:
+                    answer_done.set()
+
+            voice_source = QueuedPCMAudio()
+            played_source = voice_source # ミキサーに差し込むもの (計測するときはラッパー越しよ)
+            pipeline = SpeechPipeline(self.voicevox_client, voice_source)
+            pipeline_task = asyncio.create_task(pipeline.run(stream_sentences(answer_stream())))
+
+            # 返答と合成を待つ間にVCの接続/移動を済ませておく
+            # (音楽が流れていればその接続を使い回すし、誰もいなくなったときの退出もセッションが見張ってくれるわ)
+            session = get_session(self.bot, guild_id)
+            target_vc_for_voice = await session.connect(interaction.user.voice.channel)
+
+            # 最初の文が喋れるようになるまで待つ (音楽はそのまま流しておく)
+            await pipeline.first_chunk_ready.wait()
+            COMMAND_LATENCY.observe(time.perf_counter() - started, command="voice", stage="first_sentence_ready")
+            if pipeline.synthesized_count == 0:
+                await pipeline_task
+                if not "".join(answer_chunks).strip():
+                    await interaction.followup.send("返答が生成できなかったわ…もう一度試してみて。")
+                else:
+                    await interaction.followup.send("VOICEVOXで音声を生成できなかったわ…ごめんなさいね。")
                 return
 
-            vc_channel = interaction.user.voice.channel
-            target_vc_for_voice = None # 音声再生に使うVC
-
-            # MusicCogがユーザーと同じチャンネルに接続済みなら、それを利用
-            if active_music_vc and active_music_vc.is_connected() and active_music_vc.channel == vc_channel:
-                target_vc_for_voice = active_music_vc
-                logger.info(f"MusicCogのVCを音声再生に使用します (ギルド {guild_id})")
-                # VoiceCog自身のVC管理は更新しない (MusicCogがプライマリの可能性)
-            else:
-                # MusicCogがいないか、違うチャンネルにいる場合、VoiceCogが接続/移動
-                voice_cog_vc = self.get_vc_connection(guild_id)
-                if voice_cog_vc is None or not voice_cog_vc.is_connected():
-                    target_vc_for_voice = await vc_channel.connect()
-                    self.set_vc_connection(guild_id, target_vc_for_voice) # VoiceCogが管理
-                elif voice_cog_vc.channel != vc_channel:
-                    await voice_cog_vc.move_to(vc_channel)
-                    target_vc_for_voice = voice_cog_vc # VoiceCogが管理
-                else:
-                    target_vc_for_voice = voice_cog_vc # VoiceCogが管理
-
-            # target_vc_for_voice が active_music_vc と同じインスタンスで、かつ音楽が一時停止されている場合、
-            # VoiceCogが喋るために stop() を呼ぶと、MusicCogの再生状態がリセットされてしまう可能性がある。
-            # MusicCogがpauseしたVCをそのまま使う場合、VoiceCogはstop()を呼ばずにplay()を開始する。
-            if not (target_vc_for_voice == active_music_vc and self.music_pause_states.get(guild_id)) and target_vc_for_voice.is_playing():
-                logger.info(f"VoiceCog: target_vc is playing and not the paused music_vc. Stopping. (Guild {guild_id})")
-                target_vc_for_voice.stop() # MusicCogがpauseしたもの以外が再生中なら止める
-
-            target_vc_for_voice.play(discord.FFmpegPCMAudio(source=wav_path), after=lambda e: self.after_playing(e, wav_path, guild_id))
-            
-            # 自動退出タスクの管理 (VoiceCogがVCを能動的に確保した場合のみ)
-            # MusicCogのVCを借りている場合は、MusicCogの管理に任せる（現状MusicCogに自動退出はない）
-            # もしtarget_vc_for_voice が self.get_vc_connection(guild_id) と同じなら、VoiceCogが管理しているVC
-
-            if guild_id in self.auto_disconnect_tasks and self.auto_disconnect_tasks[guild_id]:
-                if not self.auto_disconnect_tasks[guild_id].done():
-                    self.auto_disconnect_tasks[guild_id].cancel()
-                    logger.info(f"既存の自動退出タスクをキャンセルしました (ギルド {guild_id})")
-                del self.auto_disconnect_tasks[guild_id] # 古いタスクを削除
-
-            # 新しい自動退出タスクを開始
-            # target_vc_for_voice が self.vc_connections[guild_id] と同じインスタンスか確認
-            voice_cog_managed_vc = self.get_vc_connection(guild_id)
-            if voice_cog_managed_vc and voice_cog_managed_vc == target_vc_for_voice and target_vc_for_voice.is_connected():
-                logger.info(f"自動退出監視タスクを開始します (ギルド {guild_id}, チャンネル {target_vc_for_voice.channel.id})")
-                task = self.bot.loop.create_task(self._check_and_auto_disconnect(guild_id, target_vc_for_voice.channel.id))
-                self.auto_disconnect_tasks[guild_id] = task
-            elif target_vc_for_voice == active_music_vc:
-                logger.info(f"MusicCogのVCを借用中のため、VoiceCogによる自動退出監視は開始しません (ギルド {guild_id})")
-            else: # VoiceCogが管理するVCでもなく、MusicCogのVCでもない場合 (または接続エラーなど)
-                logger.warning(f"VC接続がないため自動退出監視を開始しません (ギルド {guild_id})")
+            # --- MusicCog連携: 声はミキサーの声チャンネルに差し込む ---
+            # 音楽が流れていればミキサーが音量を下げて重ねてくれるので、止めたり再開したりはしないわ。
+            # 前の返答をまだ喋っていたら、それは止めて入れ替える
+            mixer = session.mixer
+            if AUDIO_STATS_ENABLED: # 声の読み出しの遅れやジッターも測る (/audiostats で見られるわ)
+                played_source = InstrumentedAudioSource(voice_source, get_frame_stats(guild_id, VOICE), label="voice")
+            mixer.play(VOICE, played_source, after=lambda e: self.after_playing(e, guild_id))
+            mixer.ensure_playing(target_vc_for_voice)
+
+            await answer_done.wait()
+            answer_text = "".join(answer_chunks).strip()
+            notice = f"{persona_notice}\n" if persona_notice else "" # 人格が見つからなかったら一言添える
+            await interaction.followup.send(f"{notice}🎤 **読み上げるわね♪**\n> {question}\n\n{answer_text}")
+            await pipeline_task
+            if voice_source.first_frame_at is not None: # コマンドを受けてから、最初の声がVCに流れるまで
+                COMMAND_LATENCY.observe(voice_source.first_frame_at - started, command="voice", stage="first_audio")
 
         except Exception as e:
             logger.error(f"/voice コマンドエラー (ギルド {guild_id}): {e}", exc_info=True)
             await interaction.followup.send("読み上げ中に問題が発生したわ💦 ちょっと確認してみるわね。")
-            # エラー時にも音声ファイルを削除トライ
-            if 'wav_path' in locals() and os.path.exists(wav_path):
-                try:
-                    os.remove(wav_path)
-                except Exception as ex_rem:
-                    logger.error(f"エラー後の音声ファイル削除に失敗: {ex_rem}")
+            if 'voice_source' in locals():
+                mixer = get_session(self.bot, guild_id).mixer
+                if mixer.source(VOICE) is played_source:
+                    mixer.stop(VOICE) # ミキサーから外して、合成中の残りも打ち切る
+                else:
+                    voice_source.cleanup() # 合成中の残りを打ち切る
+        finally:
+            # エラーやキャンセルで抜けたときは、合成のタスクが残らないように止めて終わるのを待つ
+            if 'pipeline_task' in locals() and not pipeline_task.done():
+                pipeline_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await pipeline_task
+            COMMAND_LATENCY.observe(time.perf_counter() - started, command="voice", stage="total")
 
 
-    def after_playing(self, error, filepath: str, guild_id: int):
+    def after_playing(self, error, guild_id: int):
         if error:
             logger.error(f'音声再生エラー (ギルド {guild_id}): {error}')
         else:
-            logger.info(f'音声再生完了 (ギルド {guild_id}): {filepath}')
-        
-        # 再生が終わったファイルを削除
-        if os.path.exists(filepath):
-            try:
-                os.remove(filepath)
-                logger.info(f"音声ファイルを削除しました: {filepath}")
-            except Exception as e:
-                logger.error(f"音声ファイルの削除に失敗しました: {filepath}, エラー: {e}")
-       
-        # --- MusicCog連携: 音楽の再開 ---
-        was_music_paused = self.music_pause_states.pop(guild_id, False)
-        if was_music_paused:
-            music_cog = self.bot.get_cog("MusicCog")
-            if music_cog and hasattr(music_cog, 'resume_current_song'):
-                logger.info(f"音声再生完了、音楽の再開を試みます (ギルド {guild_id})")
-                if self.bot.loop.is_running():
-                    asyncio.run_coroutine_threadsafe(music_cog.resume_current_song(guild_id), self.bot.loop)
-                else:
-                    logger.warning(f"ボットループが実行されていないため、音楽を再開できません (ギルド {guild_id})")
-            elif music_cog:
-                logger.warning(f"MusicCogにresume_current_songメソッドがありません (ギルド {guild_id})")
-            else:
-                logger.warning(f"MusicCogが見つかりません。音楽を再開できません (ギルド {guild_id})")
-        # --- MusicCog連携ここまで ---
-
-        # 自動退出タスクがまだ動いていなければ（例えば手動で切断された後など）、
-        # 再度起動する必要はないかもしれないが、状況に応じて検討。
-        # ここでは、再生終了後に自動退出タスクがまだ存在し、かつVCが接続されていれば
-        # そのまま監視を継続させる。もしVCが切断されていればタスクは自動的に終了するはず。
-        vc = self.get_vc_connection(guild_id)
-        if not (vc and vc.is_connected()):
-             logger.info(f"再生終了後、VCが切断されているため自動退出タスクの再確認は不要 (ギルド {guild_id})")
-             if guild_id in self.auto_disconnect_tasks:
-                 if not self.auto_disconnect_tasks[guild_id].done():
-                     self.auto_disconnect_tasks[guild_id].cancel() #念のためキャンセル
-                 del self.auto_disconnect_tasks[guild_id]
+            logger.info(f'音声再生完了 (ギルド {guild_id})')
+
+        # 音楽はミキサーが自動で元の音量に戻すので、ここで再開する必要はないわ
+        # VCに誰もいなくなったときの退出は VoiceSession が見張っているので、ここでは何もしなくていいの
+
+    @voice_gemini_command.autocomplete("persona")
+    async def persona_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        return [app_commands.Choice(name=name[:100], value=name[:100]) for name in persona_choices(current)]
 
 
 async def setup(bot: commands.Bot):
-    # VoiceCogに渡すGeminiHandlerはAskCogと同じインスタンスを使い回すか、
-    # もしくはここで新しく生成するか。今回はAskCogで生成したものを渡す想定ではないので新しく作る。
-    # ただし、リソース効率を考えると、botインスタンスにhandlerを持たせて共有するのがベター。
-    # ここでは簡単のため、各Cogで必要に応じて生成する形を取るが、改善の余地あり。
-    gemini_h = GeminiHandler()
-    await bot.add_cog(VoiceCog(bot, gemini_h), guilds=GUILDS)
+    # Geminiの窓口はAskCogと同じインスタンスを使う。/voice は声で待たせるので優先して処理されるわ
+    # 接続プールと合成済み音声のキャッシュはCogが生きている間ずっと使い回す
+    tts_cache = TTSCache()
+    register_cache_stats("tts", tts_cache.stats)
+    voicevox_client = VoicevoxClient(cache=tts_cache)
+    response_cache = get_response_cache() if RESPONSE_CACHE_ENABLED else None
+    await bot.add_cog(VoiceCog(bot, get_gemini_service(), voicevox_client, response_cache), guilds=GUILDS)
     logger.info("VoiceCogが正常にロードされました。")
@@ -1,8 +1,12 @@
 # c:\Users\super\デスクトップ\新宿二丁目のオネエ\config.py
+import functools
 import os
 from dotenv import load_dotenv
-import discord
 import logging
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import discord
 
 logger = logging.getLogger(__name__)
 load_dotenv()
@@ -86,62 +90,99 @@ def find_music_file(keyword: str, directory: str = MUSIC_DIR, extensions: list[s
     logger.warning(f"キーワード '{keyword}' に一致する音楽ファイルが {directory} 内 (拡張子: {extensions}) に見つかりませんでした。")
     return None
 
-# プロンプトファイルのパスを検索して設定
+# プロンプトファイルと音楽ファイルを探すときのキーワード
 PROMPT_Q_KEYWORD = "q"
 PROMPT_VOICE_KEYWORD = "voice"
+BACKGROUND_MUSIC_KEYWORD = "bgm" # 例: "bgm.mp3" や "background_music_long.wav" などを探す
 
-PROMPT_Q_FILE_PATH = find_prompt_file(PROMPT_Q_KEYWORD)
-PROMPT_VOICE_FILE_PATH = find_prompt_file(PROMPT_VOICE_KEYWORD)
+class Settings:
+    """
+    手間のかかる設定 (ファイルの検索・ギルドの一覧) は、初めて使われたときに作って覚えておくの。
+    config を import しただけではファイルを探しに行かないから、起動が軽くなるわ。
+    昔からの名前 (BASE_Q_PROMPT や GUILDS など) で `from config import ...` しても、ここから返すのよ。
+    プロンプトは handlers.prompt_store に任せているので、ファイルを書き換えたら次に参照したときから新しい中身になるわ。
+    """
+    @staticmethod
+    def _prompt_store():
+        from handlers.prompt_store import get_prompt_store # handlers は config を読み込むので、使うときに読み込む
+        return get_prompt_store()
 
-BASE_Q_PROMPT = ""
-if PROMPT_Q_FILE_PATH:
-    try:
-        with open(PROMPT_Q_FILE_PATH, "r", encoding="utf-8") as f:
-            BASE_Q_PROMPT = f.read().strip() + "\n\n"
-        logger.info(f"qコマンド用プロンプトファイルを読み込みました: {PROMPT_Q_FILE_PATH}")
-    except Exception as e:
-        logger.error(f"qコマンド用プロンプトファイル ({PROMPT_Q_FILE_PATH}) の読み込み中にエラー: {e}")
-        BASE_Q_PROMPT = "プロンプトの読み込みでエラーよ！ (qプロンプト)\n\n" # フォールバック
-else:
-    logger.warning(f"警告: qコマンド用プロンプトファイルが見つかりません (キーワード: {PROMPT_Q_KEYWORD})。")
-    BASE_Q_PROMPT = "あら、ちょっと設定ファイルが見当たらないわね…？ (qプロンプト)\n\n" # フォールバック
+    @staticmethod
+    def _prompt(keyword: str) -> str:
+        from handlers.prompt_store import fallback_prompt
+        return Settings._prompt_store().get(keyword) or fallback_prompt(keyword)
 
-BASE_VOICE_PROMPT = ""
-if PROMPT_VOICE_FILE_PATH:
-    try:
-        with open(PROMPT_VOICE_FILE_PATH, "r", encoding="utf-8") as f:
-            BASE_VOICE_PROMPT = f.read().strip() + "\n\n"
-        logger.info(f"voiceコマンド用プロンプトファイルを読み込みました: {PROMPT_VOICE_FILE_PATH}")
-    except Exception as e:
-        logger.error(f"voiceコマンド用プロンプトファイル ({PROMPT_VOICE_FILE_PATH}) の読み込み中にエラー: {e}")
-        BASE_VOICE_PROMPT = "プロンプトの読み込みでエラーよ！ (voiceプロンプト)\n\n" # フォールバック
-else:
-    logger.warning(f"警告: voiceコマンド用プロンプトファイルが見つかりません (キーワード: {PROMPT_VOICE_KEYWORD})。")
-    BASE_VOICE_PROMPT = "あら、ちょっと設定ファイルが見当たらないわね…？ (voiceプロンプト)\n\n" # フォールバック
+    @property
+    def prompt_q_file_path(self) -> str | None:
+        return self._prompt_store().path(PROMPT_Q_KEYWORD)
 
-# 例: BGMファイルのパスを検索して設定 (music_cog.py などで利用することを想定)
-BACKGROUND_MUSIC_KEYWORD = "bgm" # 例: "bgm.mp3" や "background_music_long.wav" などを探す
-BACKGROUND_MUSIC_FILE_PATH = find_music_file(BACKGROUND_MUSIC_KEYWORD)
+    @property
+    def prompt_voice_file_path(self) -> str | None:
+        return self._prompt_store().path(PROMPT_VOICE_KEYWORD)
 
-if BACKGROUND_MUSIC_FILE_PATH:
-    logger.info(f"BGMファイルを見つけました: {BACKGROUND_MUSIC_FILE_PATH}")
-else:
-    logger.warning(f"BGMファイルが見つかりませんでした (キーワード: {BACKGROUND_MUSIC_KEYWORD})。")
+    @property
+    def base_q_prompt(self) -> str:
+        return self._prompt(PROMPT_Q_KEYWORD)
 
+    @property
+    def base_voice_prompt(self) -> str:
+        return self._prompt(PROMPT_VOICE_KEYWORD)
 
-# Discordギルド（サーバー）のIDを.envから読み込む
-GUILD_IDS_STR = os.getenv("DISCORD_GUILD_IDS")
-GUILD_IDS = []
-if GUILD_IDS_STR:
-    try:
-        GUILD_IDS = [int(gid.strip()) for gid in GUILD_IDS_STR.split(',')]
-        logger.info(f"DiscordギルドIDを .env から読み込みました: {GUILD_IDS}")
-    except ValueError:
-        logger.error(f"DISCORD_GUILD_IDS の形式が正しくありません。カンマ区切りの数値で指定してください。例: 123,456")
-else:
-    logger.warning("DISCORD_GUILD_IDS が .env ファイルに設定されていません。")
+    @functools.cached_property
+    def background_music_file_path(self) -> str | None:
+        # 例: BGMファイルのパス (music_cog.py などで利用することを想定)
+        path = find_music_file(BACKGROUND_MUSIC_KEYWORD)
+        if path:
+            logger.info(f"BGMファイルを見つけました: {path}")
+        else:
+            logger.warning(f"BGMファイルが見つかりませんでした (キーワード: {BACKGROUND_MUSIC_KEYWORD})。")
+        return path
+
+    @functools.cached_property
+    def guild_ids(self) -> list[int]:
+        # Discordギルド（サーバー）のIDを.envから読み込む
+        guild_ids_str = os.getenv("DISCORD_GUILD_IDS")
+        if not guild_ids_str:
+            logger.warning("DISCORD_GUILD_IDS が .env ファイルに設定されていません。")
+            return []
+        try:
+            guild_ids = [int(gid.strip()) for gid in guild_ids_str.split(',')]
+            logger.info(f"DiscordギルドIDを .env から読み込みました: {guild_ids}")
+            return guild_ids
+        except ValueError:
+            logger.error(f"DISCORD_GUILD_IDS の形式が正しくありません。カンマ区切りの数値で指定してください。例: 123,456")
+            return []
+
+    @functools.cached_property
+    def guilds(self) -> list["discord.Object"]:
+        import discord # discord.Object を作るときだけ読み込む
+        return [discord.Object(id=gid) for gid in self.guild_ids]
+
+_settings: Settings | None = None
+
+def get_settings() -> Settings:
+    """ボット全体で共有する Settings を返す。初めて呼ばれたときに作るわ"""
+    global _settings
+    if _settings is None:
+        _settings = Settings()
+    return _settings
+
+# 昔からの名前: Settings の属性名 (参照されたときに読み込むわ)
+_LAZY_SETTINGS = {
+    "PROMPT_Q_FILE_PATH": "prompt_q_file_path",
+    "PROMPT_VOICE_FILE_PATH": "prompt_voice_file_path",
+    "BASE_Q_PROMPT": "base_q_prompt",
+    "BASE_VOICE_PROMPT": "base_voice_prompt",
+    "BACKGROUND_MUSIC_FILE_PATH": "background_music_file_path",
+    "GUILD_IDS": "guild_ids",
+    "GUILDS": "guilds",
+}
 
-GUILDS = [discord.Object(id=gid) for gid in GUILD_IDS]
+def __getattr__(name: str):
+    attribute = _LAZY_SETTINGS.get(name)
+    if attribute is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(get_settings(), attribute)
 
 # VOICEVOX APIのベースURL
 VOICEVOX_BASE_URL = "http://127.0.0.1:50021"
@@ -151,3 +192,95 @@ GEMINI_MODEL_NAME = "gemini-2.0-flash"
 
 # スピーカーID
 VOICEVOX_SPEAKER_ID = 66
+
+# VOICEVOXクライアントの設定
+VOICEVOX_MAX_CONCURRENCY = 2 # 同時に合成リクエストを投げる上限 (エンジンのCPUと相談してね)
+VOICEVOX_QUERY_TIMEOUT = 10.0 # /audio_query のタイムアウト (秒)
+VOICEVOX_SYNTHESIS_TIMEOUT = 30.0 # /synthesis のタイムアウト (秒)
+VOICEVOX_MAX_RETRIES = 2 # タイムアウトや5xxのときのリトライ回数
+VOICEVOX_RETRY_BACKOFF = 0.5 # リトライ間隔の初期値 (秒)。リトライごとに倍になるわ
+TTS_PIPELINE_MAX_PARALLEL = 2 # /voice の返答を文ごとに合成するときの先読み並列数
+
+# /q の返答をストリーミングで表示するとき、メッセージを編集する最小間隔 (秒)
+ASK_STREAM_EDIT_INTERVAL = 1.0
+
+# 合成済み音声 (TTS) キャッシュの設定
+TTS_CACHE_MEMORY_BYTES = 32 * 1024 * 1024 # メモリ上に置いておく上限 (バイト)
+TTS_CACHE_DISK_DIR = os.path.join("cache", "tts") # メモリからあふれた分の退避先 (Noneならディスクは使わない)
+TTS_CACHE_DISK_BYTES = 256 * 1024 * 1024 # ディスク上の上限 (バイト)
+
+# 音楽ライブラリの索引の設定
+MUSIC_LIBRARY_INDEX_PATH = os.path.join("cache", "music_index.json") # 索引の保存先 (Noneなら保存しない)
+MUSIC_LIBRARY_REFRESH_INTERVAL = 60 # 変更がないか確認する間隔 (秒)。変わったディレクトリだけ読み直すわ
+
+# 音声ミキサーの設定 (音楽とママの声を1本にまとめて流すの)
+MIXER_DUCK_VOLUME = 0.3 # ママが喋っている間の音楽の音量 (1.0で下げない)
+MIXER_DUCK_FADE_MS = 200 # 音楽の音量を下げる/戻すときのフェード時間 (ミリ秒)
+MIXER_IDLE_TIMEOUT = 1.0 # 流すものがなくなってから再生を止めるまでの猶予 (秒)。曲の切り替えで途切れないように
+
+# 音楽の音量と音量の正規化の設定
+MUSIC_DEFAULT_VOLUME = 0.3 # /volume で変える前の音量 (1.0で正規化した音量そのまま)
+MUSIC_LIMITER_THRESHOLD = 0.8 # この大きさ (フルスケール比) を超えた分はソフトリミッターでなめらかに抑えるわ
+LOUDNESS_TARGET_LUFS = -18.0 # 曲ごとのラウドネスをこの値に揃える (ReplayGain 2.0 と同じ基準)
+LOUDNESS_MAX_GAIN_DB = 12.0 # 曲ごとの補正量の上限 (dB)。静かすぎる曲を持ち上げすぎないように
+LOUDNESS_ANALYSIS_ENABLED = True # 曲のラウドネスをバックグラウンドで測っておくか (FFmpegの ebur128 フィルタを使うわ)
+LOUDNESS_ANALYSIS_TIMEOUT = 120.0 # 1曲の測定にかける時間の上限 (秒)
+
+# 曲間を空けないための先読みの設定
+MUSIC_PREFETCH_ENABLED = True # 次の曲のFFmpegを前もって立ち上げておくか
+MUSIC_PREFETCH_FRAMES = 50 # 前もってデコードしておくフレーム数 (1フレーム20ms)
+
+# 音楽ライブラリのOpusキャッシュの設定 (一度だけOpusに変換しておいて、再生のたびのデコードを省くの)
+MUSIC_OPUS_CACHE_ENABLED = False # 有効にするとバックグラウンドで曲を変換し始めるわ (ディスクを曲の数だけ使うので注意)
+MUSIC_OPUS_CACHE_DIR = os.path.join("cache", "opus") # 変換したファイルの置き場所
+MUSIC_OPUS_BITRATE = 96 # 変換するときのビットレート (kbps)
+
+# Geminiへのリクエストの設定 (ボット全体で1つのサービスを共有するわ)
+GEMINI_MAX_CONCURRENCY = 4 # 同時に投げるリクエストの上限
+GEMINI_RATE_LIMIT_PER_MINUTE = 15 # 1分あたりのリクエスト数の上限 (モデルのクォータに合わせてね)
+GEMINI_RATE_LIMIT_BURST = 3 # 間が空いたあとに続けて投げてもいいリクエスト数
+
+# Geminiの返答キャッシュの設定 (同じ質問にはAPIを呼ばずにすぐ答えるの)
+RESPONSE_CACHE_ENABLED = True # /q と /voice の返答をキャッシュするか
+RESPONSE_CACHE_TTL = 600 # 返答を使い回す時間 (秒)
+RESPONSE_CACHE_MAX_ENTRIES = 256 # 覚えておく返答の数 (超えたら一番使われていないものから捨てるわ)
+RESPONSE_CACHE_INCLUDE_HISTORY = False # /q の会話履歴もキーに含めるか (Trueだと流れが変わると当たらなくなるわ)
+RESPONSE_CACHE_NEAR_DUPLICATE = False # よく似た質問にも同じ返答を返すか
+RESPONSE_CACHE_SIMILARITY = 0.8 # 「よく似た」とみなす文字n-gramの重なり具合 (0〜1)
+RESPONSE_CACHE_NGRAM = 2 # 似ているかを比べる文字n-gramの長さ (日本語は2くらいがちょうどいいわ)
+
+# 会話履歴の設定 (/q のプロンプトに入れる最近の発言を、ボットがメモリ上で覚えておくの)
+CONVERSATION_HISTORY_SIZE = 5 # チャンネルごとに覚えておく発言の数 (この数だけプロンプトに入れるわ)
+CONVERSATION_HISTORY_MAX_CHANNELS = 500 # 覚えておくチャンネルの数 (超えたら一番使われていないチャンネルから忘れる)
+
+# プロンプトの組み立ての設定
+PROMPT_HISTORY_TOKEN_BUDGET = 800 # /q のプロンプトに入れる会話履歴のトークン数の上限 (新しい発言から入れていくわ)
+GEMINI_CONTEXT_CACHE_ENABLED = True # 人格設定 (prompt/*.txt) をGeminiのコンテキストキャッシュに置くか
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = 4096 # これより短い人格設定はキャッシュできないので、system_instruction として渡すわ (モデルの下限に合わせてね)
+GEMINI_CONTEXT_CACHE_TTL = 3600 # コンテキストキャッシュの有効期限 (秒)。切れたら作り直すの
+
+# VCからの自動退出の設定
+AUTO_DISCONNECT_IDLE_SECONDS = 30 # VCに誰もいなくなってから退出するまでの猶予 (秒)
+MUSIC_IDLE_TIMEOUT = 300 # 音楽が止まってから (キューが空になってから) 退出するまでの時間 (秒)
+PRESENCE_TIMER_TICK = 1.0 # 退出の期限を見るタイマーの刻み (秒)
+PRESENCE_TIMER_SLOTS = 512 # タイマーホイールのスロット数 (刻み×スロット数より長い期限は何周かして発火するわ)
+
+# スラッシュコマンドの同期の設定
+COMMAND_SYNC_STATE_PATH = os.path.join("cache", "command_tree.json") # 最後に同期したコマンド定義の指紋 (消すと次の起動で全部同期し直すわ)
+COMMAND_SYNC_CONCURRENCY = 3 # 同時に同期するギルドの数 (多すぎるとレート制限に引っかかるわ)
+
+# 起動時間の計測の設定 (python bot.py --profile-startup で使うわ)
+STARTUP_PROFILE_TOP_MODULES = 25 # 読み込みの遅かったモジュールを何件まで表示するか
+
+# プロンプト (人格設定) の読み直しの設定
+PROMPT_RELOAD_CHECK_INTERVAL = 2.0 # prompt/*.txt が書き換えられていないか確認する間隔 (秒)。変わっていたら再起動なしで読み直すわ
+
+# メトリクスの設定 (Prometheus のテキスト形式で http://METRICS_HOST:METRICS_PORT/metrics に出すわ)
+METRICS_ENABLED = True # メトリクスのHTTPサーバーを立てるか
+METRICS_HOST = "127.0.0.1" # 外から見せたいときだけ "0.0.0.0" にしてね
+METRICS_PORT = 9108 # ポート番号
+
+# 再生の計測の設定 (/audiostats とメトリクスで見られるわ)
+AUDIO_STATS_ENABLED = True # フレームごとに read() の時間やジッターを測るか (Falseなら計測用のラッパーを挟まないわ)
+AUDIO_STATS_LATE_FRAME_MS = 15 # read() がこれ (ミリ秒) より長くかかったフレームを「遅れた」と数える (1フレームは20ms)
+AUDIO_STATS_PIPE_SAMPLE_FRAMES = 50 # FFmpegのパイプの残量を何フレームごとに測るか (50で1秒に1回)
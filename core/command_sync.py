@@ -0,0 +1,80 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\core\command_sync.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import discord
+from discord import app_commands
+from config import COMMAND_SYNC_STATE_PATH, COMMAND_SYNC_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+def command_fingerprint(tree: app_commands.CommandTree, guild: discord.abc.Snowflake) -> str:
+    """ギルドに同期するコマンド定義 (Discordに送る中身そのもの) の指紋"""
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands(guild=guild)), key=lambda c: (c.get("type", 1), c["name"]))
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _load_state(path: str) -> dict[str, str]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"コマンド同期の記録 ({path}) を読み込めませんでした。全部同期し直すわ: {e}")
+        return {}
+
+def _save_state(path: str, state: dict[str, str]):
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"コマンド同期の記録 ({path}) を保存できませんでした: {e}")
+
+async def _sync_guild(tree: app_commands.CommandTree, guild: discord.abc.Snowflake, semaphore: asyncio.Semaphore) -> bool:
+    async with semaphore:
+        for attempt in range(3):
+            try:
+                synced = await tree.sync(guild=guild)
+                logger.info(f"{len(synced)} 個のコマンドをギルド {guild.id} に同期しました")
+                return True
+            except discord.Forbidden:
+                logger.error(f"ギルド {guild.id} へのコマンド同期権限がありません。ボットが 'applications.commands' スコープで招待されているか確認してください。")
+                return False
+            except discord.RateLimited as e:
+                # 普段は discord.py が429を待ってくれるけど、待ち時間が長すぎると投げてくるので、ここで待ってやり直す
+                if attempt == 2:
+                    logger.error(f"ギルド {guild.id} へのコマンド同期がレート制限で続けて失敗しました")
+                    return False
+                logger.warning(f"ギルド {guild.id} へのコマンド同期がレート制限にかかったので {e.retry_after:.1f}秒待ちます")
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.error(f"ギルド {guild.id} へのコマンド同期中にエラー: {e}", exc_info=True)
+                return False
+        return False
+
+async def sync_changed_commands(tree: app_commands.CommandTree, guilds: list[discord.abc.Snowflake], application_id: int | None,
+                                state_path: str = COMMAND_SYNC_STATE_PATH, concurrency: int = COMMAND_SYNC_CONCURRENCY) -> int:
+    """
+    コマンド定義が前回の同期から変わったギルドだけ、並列に同期する。同期したギルドの数を返すわ。
+    指紋はアプリケーションIDごとに覚えておくので、別のボットのトークンで起動したときはちゃんと同期し直すの。
+    """
+    state = _load_state(state_path)
+    fingerprints = {guild.id: f"{application_id}:{command_fingerprint(tree, guild)}" for guild in guilds}
+    changed = [guild for guild in guilds if state.get(str(guild.id)) != fingerprints[guild.id]]
+    if not changed:
+        logger.info(f"コマンド定義は前回の同期から変わっていないので、同期は省略します ({len(guilds)} ギルド)")
+        return 0
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    results = await asyncio.gather(*(_sync_guild(tree, guild, semaphore) for guild in changed))
+    for guild, ok in zip(changed, results):
+        if ok: # 失敗したギルドは記録しないので、次の起動でもう一度同期するわ
+            state[str(guild.id)] = fingerprints[guild.id]
+    _save_state(state_path, state)
+    return sum(results)
@@ -0,0 +1,84 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\core\history.py
+import logging
+from collections import OrderedDict, deque
+import discord
+from config import CONVERSATION_HISTORY_SIZE, CONVERSATION_HISTORY_MAX_CHANNELS
+
+logger = logging.getLogger(__name__)
+
+class ConversationHistory:
+    """
+    チャンネルごとの最近の発言 (人間のものだけ) を覚えておくリングバッファ。
+    on_message で届いた発言を積んでいくので、/q のたびにDiscordのAPIで履歴を取りに行かなくて済むわ。
+    チャンネルごとに max_messages 件まで、チャンネルは max_channels 個まで (一番使われていないものから忘れる) なので、
+    メモリは増え続けないの。
+    """
+    def __init__(self, max_messages: int = CONVERSATION_HISTORY_SIZE, max_channels: int = CONVERSATION_HISTORY_MAX_CHANNELS):
+        self.max_messages = max_messages
+        self.max_channels = max_channels
+        self._channels: OrderedDict[int, deque[tuple[int, str]]] = OrderedDict() # チャンネルID: (メッセージID, "名前: 本文")
+        self._seeded: set[int] = set() # 起動後にAPIから履歴を一度読み込んだチャンネル
+
+    @staticmethod
+    def _format(message: discord.Message) -> str | None:
+        if message.author.bot:
+            return None
+        content = message.content.strip()
+        if not content:
+            return None
+        author_name = message.author.display_name if message.author else "不明なユーザー"
+        return f"{author_name}: {content}"
+
+    def _buffer(self, channel_id: int) -> deque[tuple[int, str]]:
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            buffer = self._channels[channel_id] = deque(maxlen=self.max_messages)
+            while len(self._channels) > self.max_channels:
+                forgotten, _ = self._channels.popitem(last=False)
+                self._seeded.discard(forgotten)
+        else:
+            self._channels.move_to_end(channel_id)
+        return buffer
+
+    def add(self, message: discord.Message):
+        """届いた発言を覚える (ボットや空の発言は無視するわ)"""
+        line = self._format(message)
+        if line is None:
+            return
+        self._buffer(message.channel.id).append((message.id, line))
+
+    def remove(self, channel_id: int, message_id: int):
+        """消された発言を忘れる"""
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return
+        for entry in buffer:
+            if entry[0] == message_id:
+                buffer.remove(entry)
+                return
+
+    def is_seeded(self, channel_id: int) -> bool:
+        return channel_id in self._seeded
+
+    def seed(self, channel_id: int, messages: list[discord.Message]):
+        """
+        APIから取ってきた過去の発言で埋める (起動直後でまだ何も覚えていないチャンネル用)。
+        取りに行っている間に on_message で届いた発言とは、メッセージIDの順に並べて重複なく混ぜるわ。
+        """
+        buffer = self._buffer(channel_id)
+        entries = {message_id: line for message_id, line in buffer}
+        for message in messages:
+            line = self._format(message)
+            if line is not None:
+                entries[message.id] = line
+        buffer.clear()
+        buffer.extend(sorted(entries.items())[-self.max_messages:]) # メッセージIDは時刻順なので、並べれば古い順になる
+        self._seeded.add(channel_id)
+
+    def recent(self, channel_id: int) -> list[str]:
+        """覚えている発言を古い順に返す"""
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return []
+        self._channels.move_to_end(channel_id)
+        return [line for _, line in buffer]
@@ -0,0 +1,252 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\core\metrics.py
+import bisect
+import contextlib
+import logging
+import math
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from aiohttp import web
+from config import METRICS_HOST, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# 所要時間のヒストグラムの区切り (秒)。Geminiの返答や音声合成は数秒かかるので、長めまで用意しておくわ
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: Iterable[tuple[str, str]]) -> str:
+    pairs = ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels)
+    return f"{{{pairs}}}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+class MetricFamily:
+    """1つのメトリクスを出力するときの形 (名前・種類・説明と、ラベルごとの値)"""
+    __slots__ = ("name", "type", "help", "samples")
+
+    def __init__(self, name: str, type: str, help: str):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.samples: list[tuple[str, tuple[tuple[str, str], ...], float]] = [] # (名前の接尾辞, ラベル, 値)
+
+    def add(self, value: float, suffix: str = "", **labels) -> "MetricFamily":
+        self.samples.append((suffix, tuple(labels.items()), float(value)))
+        return self
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples:
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock() # 音声のプレイヤーのスレッドからも更新されるので
+        self._values: dict[tuple[str, ...], object] = {}
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        if len(labels) != len(self.labelnames) or any(name not in labels for name in self.labelnames):
+            raise ValueError(f"{self.name} のラベルは {self.labelnames} よ (渡されたのは {tuple(labels)})")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple[str, ...]) -> dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+class Counter(_Metric):
+    """増えていくだけの数 (リクエスト数やアンダーランしたフレーム数など)。名前は _total で終わらせてね"""
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self) -> MetricFamily:
+        family = MetricFamily(self.name, self.type, self.help)
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            family.add(value, **self._labels(key))
+        return family
+
+class Gauge(Counter):
+    """増えたり減ったりする今の値 (動いているFFmpegの数など)"""
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    @contextlib.contextmanager
+    def track_inprogress(self, **labels) -> Iterator[None]:
+        """with の中にいる間だけ1増やしておく"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class Histogram(_Metric):
+    """所要時間などの分布。区切り (buckets) ごとの件数と、合計と件数を覚えておくの"""
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value) # value 以上で一番小さい区切り (なければ +Inf)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0] # 区切りごとの件数, 合計, 件数
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """with の中にかかった時間を記録する (async の関数の中でもそのまま使えるわ)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def collect(self) -> MetricFamily:
+        family = MetricFamily(self.name, self.type, self.help)
+        with self._lock:
+            items = [(key, list(state[0]), state[1], state[2]) for key, state in self._values.items()]
+        for key, counts, total, count in items:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), counts):
+                cumulative += bucket_count
+                family.add(cumulative, "_bucket", **labels, le=_format_value(bound))
+            family.add(total, "_sum", **labels)
+            family.add(count, "_count", **labels)
+        return family
+
+Collector = Callable[[], Iterable[MetricFamily]]
+
+class MetricsRegistry:
+    """
+    メトリクスの置き場所。render() で Prometheus のテキスト形式にするわ。
+    キューの長さのように、その場で数えればいい値はコレクター (出力のたびに呼ばれる関数) で返してね。
+    """
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._collectors: list[Collector] = []
+
+    def _register(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"メトリクス {metric.name} はもう登録されているわ")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def register_collector(self, collector: Collector):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.collect().render())
+        for collector in list(self._collectors):
+            try:
+                families = list(collector())
+            except Exception as e:
+                logger.error(f"メトリクスの収集中にエラー ({collector}): {e}", exc_info=True)
+                continue
+            for family in families:
+                lines.extend(family.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+# --- ボット全体で使うメトリクス ---
+COMMAND_LATENCY = REGISTRY.histogram(
+    "mama_command_stage_seconds", "コマンドの段階ごとの所要時間 (秒)。stage=total が全体よ", ("command", "stage"))
+GEMINI_LATENCY = REGISTRY.histogram(
+    "mama_gemini_request_seconds", "Geminiへのリクエストの所要時間 (秒)。queue_wait は並んでいた時間", ("stage",))
+VOICEVOX_LATENCY = REGISTRY.histogram(
+    "mama_voicevox_request_seconds", "VOICEVOX APIの所要時間 (秒、リトライ込み)", ("endpoint",))
+VOICEVOX_ERRORS = REGISTRY.counter(
+    "mama_voicevox_errors_total", "VOICEVOX APIがリトライしても失敗した回数", ("endpoint",))
+FFMPEG_PROCESSES = REGISTRY.gauge(
+    "mama_ffmpeg_processes", "動いているFFmpegのプロセス数", ("purpose",))
+AUDIO_UNDERRUNS = REGISTRY.counter(
+    "mama_audio_underrun_frames_total", "流すデータが間に合わずに無音を流したフレーム数", ("source",))
+
+_cache_stats: dict[str, dict[str, int]] = {}
+
+def register_cache_stats(cache: str, stats: dict[str, int]):
+    """キャッシュの stats (ヒット数などの辞書) を登録しておくと、mama_cache_events_total として出力するわ"""
+    _cache_stats[cache] = stats
+
+def _collect_caches() -> Iterable[MetricFamily]:
+    family = MetricFamily("mama_cache_events_total", "counter", "キャッシュのヒット・ミス・追い出しの回数")
+    for cache, stats in list(_cache_stats.items()):
+        for event, value in list(stats.items()):
+            family.add(value, cache=cache, event=event)
+    return [family]
+
+REGISTRY.register_collector(_collect_caches)
+
+class MetricsServer:
+    """/metrics でメトリクスを返すだけの小さなHTTPサーバー (aiohttp)。Prometheus からスクレイプしてね"""
+    def __init__(self, registry: MetricsRegistry = REGISTRY, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner: web.AppRunner | None = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, self.host, self.port).start()
+        except Exception:
+            # ポートが使われているときなど。用意した runner は片付けてから呼び出し元に任せるわ
+            await self._runner.cleanup()
+            self._runner = None
+            raise
+        logger.info(f"メトリクスを http://{self.host}:{self.port}/metrics で公開しました")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        body = self.registry.render().encode("utf-8")
+        return web.Response(body=body, headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
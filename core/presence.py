@@ -0,0 +1,184 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\core\presence.py
+import asyncio
+import inspect
+import logging
+import math
+from collections.abc import Awaitable, Callable, Hashable
+import discord
+from discord.ext import commands
+from config import PRESENCE_TIMER_TICK, PRESENCE_TIMER_SLOTS, AUTO_DISCONNECT_IDLE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+TimerCallback = Callable[[], Awaitable[None] | None]
+
+class _Timer:
+    __slots__ = ("key", "callback", "slot", "rounds")
+
+    def __init__(self, key: Hashable, callback: TimerCallback, slot: int, rounds: int):
+        self.key = key
+        self.callback = callback
+        self.slot = slot
+        self.rounds = rounds # あと何周したら発火するか
+
+class TimerWheel:
+    """
+    タイマーホイール。期限を tick 秒刻みの輪っかのスロットに入れておいて、1本のタスクで順に回るの。
+    ギルドの数だけ sleep するタスクを作らなくていいし、登録も取り消しも一瞬よ。
+    期限は tick 秒単位に切り上げるので、ざっくりした期限 (退出の猶予など) 向けね。
+    待っているタイマーがなくなったらタスクは止まって、次に登録されたらまた動き出すわ。
+    """
+    def __init__(self, tick: float = PRESENCE_TIMER_TICK, slots: int = PRESENCE_TIMER_SLOTS):
+        self.tick = tick
+        self._slots: list[dict[Hashable, _Timer]] = [{} for _ in range(slots)]
+        self._timers: dict[Hashable, _Timer] = {}
+        self._cursor = 0
+        self._task: asyncio.Task | None = None
+
+    def schedule(self, key: Hashable, delay: float, callback: TimerCallback):
+        """delay 秒後に callback を呼ぶ。同じキーのタイマーがあれば入れ替えるわ (コルーチン関数でもいいの)"""
+        self.cancel(key)
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self._cursor + ticks) % len(self._slots)
+        timer = _Timer(key, callback, slot, (ticks - 1) // len(self._slots))
+        self._slots[slot][key] = timer
+        self._timers[key] = timer
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def cancel(self, key: Hashable) -> bool:
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        del self._slots[timer.slot][key]
+        return True
+
+    def pending(self, key: Hashable) -> bool:
+        return key in self._timers
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while self._timers:
+            next_tick += self.tick
+            await asyncio.sleep(max(0.0, next_tick - loop.time())) # sleep の遅れが積み重ならないように
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            slot = self._slots[self._cursor]
+            due = []
+            for key, timer in list(slot.items()):
+                if timer.rounds > 0:
+                    timer.rounds -= 1
+                    continue
+                del slot[key]
+                del self._timers[key]
+                due.append(timer)
+            for timer in due:
+                self._fire(timer)
+
+    def _fire(self, timer: _Timer):
+        try:
+            result = timer.callback()
+            if inspect.isawaitable(result):
+                asyncio.create_task(self._await_callback(timer.key, result))
+        except Exception as e:
+            logger.error(f"タイマー {timer.key} の処理中にエラー: {e}", exc_info=True)
+
+    @staticmethod
+    async def _await_callback(key: Hashable, awaitable: Awaitable[None]):
+        try:
+            await awaitable
+        except Exception as e:
+            logger.error(f"タイマー {key} の処理中にエラー: {e}", exc_info=True)
+
+class _Watch:
+    __slots__ = ("guild_id", "channel_getter", "on_idle", "delay")
+
+    def __init__(self, guild_id: int, channel_getter: Callable[[], discord.abc.GuildChannel | None], on_idle: TimerCallback, delay: float):
+        self.guild_id = guild_id
+        self.channel_getter = channel_getter
+        self.on_idle = on_idle
+        self.delay = delay
+
+class PresenceTracker:
+    """
+    ボイスチャンネルにいる人間 (ボット以外) の人数を on_voice_state_update で差分だけ数えておくの。
+    watch() で「このチャンネルに誰もいなくなったら delay 秒後に on_idle を呼んで」と頼んでおけば、
+    いなくなった瞬間にタイマーホイールに期限を入れて、誰か戻ってきたら取り消すわ。
+    20秒ごとにメンバーを数え直すようなポーリングは要らないのよ。
+    """
+    def __init__(self, wheel: TimerWheel | None = None):
+        self.wheel = wheel or TimerWheel()
+        self._counts: dict[int, int] = {} # チャンネルID: 人間の人数 (一度数えたチャンネルだけ)
+        self._watches: dict[Hashable, _Watch] = {}
+
+    def human_count(self, channel: discord.abc.GuildChannel) -> int:
+        count = self._counts.get(channel.id)
+        if count is None: # 初めてのチャンネルは一度だけ数える。あとはイベントで差分を足し引きするわ
+            count = self._counts[channel.id] = sum(1 for member in channel.members if not member.bot)
+        return count
+
+    def watch(self, key: Hashable, guild_id: int, channel_getter: Callable[[], discord.abc.GuildChannel | None],
+              on_idle: TimerCallback, delay: float = AUTO_DISCONNECT_IDLE_SECONDS):
+        """
+        channel_getter が返すチャンネル (ボットのいるVC) に人間がいなくなったら、delay 秒後に on_idle を呼ぶ。
+        channel_getter がNoneを返したら (もうVCにいない) 見張りは自然に終わるわ。同じキーで呼べば入れ替えよ。
+        """
+        watch = self._watches[key] = _Watch(guild_id, channel_getter, on_idle, delay)
+        self._evaluate(key, watch)
+
+    def unwatch(self, key: Hashable):
+        self._watches.pop(key, None)
+        self.wheel.cancel(("presence", key))
+
+    def _evaluate(self, key: Hashable, watch: _Watch):
+        channel = watch.channel_getter()
+        if channel is None:
+            self.unwatch(key)
+            return
+        timer_key = ("presence", key)
+        if self.human_count(channel) == 0:
+            if not self.wheel.pending(timer_key):
+                logger.info(f"VC ({channel.name}) に誰もいなくなったので、{watch.delay}秒後に退出します (ギルド {watch.guild_id})")
+                self.wheel.schedule(timer_key, watch.delay, lambda: self._fire(key))
+        elif self.wheel.cancel(timer_key):
+            logger.info(f"VC ({channel.name}) に人が戻ってきたので、退出を取りやめます (ギルド {watch.guild_id})")
+
+    def _fire(self, key: Hashable) -> Awaitable[None] | None:
+        watch = self._watches.get(key)
+        if watch is None:
+            return None
+        channel = watch.channel_getter()
+        if channel is None or self.human_count(channel) > 0:
+            return None
+        del self._watches[key]
+        return watch.on_idle()
+
+    async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+        if before.channel == after.channel:
+            return # ミュートや画面共有の切り替えなど
+        if not member.bot:
+            for channel, delta in ((before.channel, -1), (after.channel, 1)):
+                if channel is not None and channel.id in self._counts:
+                    self._counts[channel.id] = max(0, self._counts[channel.id] + delta)
+        # ボット自身が移動したときも含めて、このギルドの見張りを見直す
+        for key, watch in list(self._watches.items()):
+            if watch.guild_id == member.guild.id:
+                self._evaluate(key, watch)
+
+    async def on_resumed(self):
+        # 接続が途切れていた間のイベントは届かないので、数え直す。
+        # 見張っているチャンネルはメンバーから数え直して、その間に誰もいなくなっていたら退出のタイマーを入れる (戻っていたら取り消す) わ
+        self._counts.clear()
+        for key, watch in list(self._watches.items()):
+            self._evaluate(key, watch)
+
+_tracker: PresenceTracker | None = None
+
+def get_presence_tracker(bot: commands.Bot) -> PresenceTracker:
+    """ボット全体で共有するPresenceTrackerを返す。初めて呼ばれたときに作って、イベントを受け取れるようにするわ"""
+    global _tracker
+    if _tracker is None:
+        _tracker = PresenceTracker()
+        bot.add_listener(_tracker.on_voice_state_update, "on_voice_state_update")
+        bot.add_listener(_tracker.on_resumed, "on_resumed")
+    return _tracker
@@ -0,0 +1,106 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\core\session.py
+import asyncio
+import logging
+from collections.abc import Awaitable, Callable
+import discord
+from discord.ext import commands
+from config import MUSIC_DEFAULT_VOLUME
+from audio.mixer import AudioMixer
+from library.index import Track
+from library.queue import MusicQueue, RepeatMode
+from core.presence import PresenceTracker, get_presence_tracker
+from core.metrics import REGISTRY, MetricFamily
+
+logger = logging.getLogger(__name__)
+
+class VoiceSession:
+    """
+    ギルドごとのボイスまわりの状態をまとめたもの。VC接続・ミキサー・再生キュー・再生中の曲・退出の見張りを1つに持つの。
+    MusicCog も VoiceCog もこれを通してVCを使うので、接続は1本を使い回して、移動も1回で済むわ。
+    VCから抜けても音量やリピートモードは覚えておくので、セッション自体はギルドごとにずっと残しておくのよ。
+    """
+    def __init__(self, guild_id: int, presence: PresenceTracker):
+        self.guild_id = guild_id
+        self.presence = presence
+        self.voice_client: discord.VoiceClient | None = None
+        self.mixer = AudioMixer() # VCでは常にこれ1本を流しておく
+        self.queue = MusicQueue()
+        self.current: Track | None = None # 再生中の曲
+        self.repeat_mode = RepeatMode.NONE
+        self.volume = MUSIC_DEFAULT_VOLUME
+        self.prefetched: tuple[Track, discord.AudioSource] | None = None # ミキサーに予約済みの次の曲
+        self.prefetch_generation = 0 # 先読みのやり直し回数 (古い先読みを捨てる目印)
+        self.text_channel_id: int | None = None # 最後に音楽コマンドが使われたテキストチャンネル
+        self._connect_lock = asyncio.Lock() # /voice と /playmusic が同時に来ても接続は1回だけにする
+
+    def is_connected(self) -> bool:
+        return self.voice_client is not None and self.voice_client.is_connected()
+
+    @property
+    def channel(self) -> discord.abc.GuildChannel | None:
+        """今いるボイスチャンネル (いなければNone)"""
+        return self.voice_client.channel if self.is_connected() else None
+
+    async def connect(self, channel: discord.VoiceChannel | discord.StageChannel) -> discord.VoiceClient:
+        """channel に接続する。もう接続していればそれを使い回して、違うチャンネルなら移動するだけよ"""
+        async with self._connect_lock:
+            vc = self.voice_client
+            if vc is None or not vc.is_connected():
+                existing = channel.guild.voice_client # 前の接続が残っていたら使い回す
+                if isinstance(existing, discord.VoiceClient) and existing.is_connected():
+                    vc = existing
+                else:
+                    vc = await channel.connect()
+                    logger.info(f"VCに接続しました: {channel.name} (ギルド {self.guild_id})")
+                self.voice_client = vc
+            if vc.channel != channel:
+                await vc.move_to(channel)
+                logger.info(f"VCを移動しました: {channel.name} (ギルド {self.guild_id})")
+            self.presence.watch(("session", self.guild_id), self.guild_id, lambda: self.channel,
+                                lambda: self.disconnect("VCに他のユーザーがいなくなった"))
+            return vc
+
+    def schedule_idle(self, delay: float, callback: Callable[[], Awaitable[None] | None]):
+        """delay 秒後に callback を呼ぶ (音楽が止まったままのときの退出など)。もう一度呼べば期限を延ばすわ"""
+        self.presence.wheel.schedule(("idle", self.guild_id), delay, callback)
+
+    def cancel_idle(self):
+        self.presence.wheel.cancel(("idle", self.guild_id))
+
+    async def disconnect(self, reason: str):
+        """VCから退出して、流しているものとキューを片付ける"""
+        self.presence.unwatch(("session", self.guild_id))
+        self.cancel_idle()
+        vc, self.voice_client = self.voice_client, None
+        self.prefetched = None
+        self.queue.clear()
+        self.mixer.close() # 音楽も声も止めて片付ける (FFmpegもここで終わるわ)
+        if vc is not None and vc.is_connected():
+            logger.info(f"{reason}ため、VC ({vc.channel.name}) から退出します (ギルド {self.guild_id})")
+            await vc.disconnect()
+
+_sessions: dict[int, VoiceSession] = {}
+
+def get_session(bot: commands.Bot, guild_id: int) -> VoiceSession:
+    """ギルドのセッションを返す。なければ作るわ"""
+    session = _sessions.get(guild_id)
+    if session is None:
+        session = _sessions[guild_id] = VoiceSession(guild_id, get_presence_tracker(bot))
+    return session
+
+def find_session(guild_id: int) -> VoiceSession | None:
+    """ギルドのセッションがあれば返す (作らない)"""
+    return _sessions.get(guild_id)
+
+def all_sessions() -> list[VoiceSession]:
+    return list(_sessions.values())
+
+def _collect_sessions() -> list[MetricFamily]:
+    connected = MetricFamily("mama_voice_connected", "gauge", "VCにつながっているか (ギルドごと、1ならつながっている)")
+    queue_length = MetricFamily("mama_music_queue_length", "gauge", "音楽の再生キューに並んでいる曲数 (ギルドごと)")
+    for session in all_sessions():
+        connected.add(1 if session.is_connected() else 0, guild=session.guild_id)
+        queue_length.add(len(session.queue), guild=session.guild_id)
+    return [connected, queue_length]
+
+REGISTRY.register_collector(_collect_sessions)
@@ -0,0 +1,76 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\core\startup_profile.py
+import builtins
+import importlib.util
+import sys
+import threading
+import time
+
+# このモジュールは --profile-startup のときに discord などより先に読み込まれるので、標準ライブラリしか使わないの
+
+class ImportProfiler:
+    """
+    モジュールごとに、読み込みにかかった時間を測るの (python -X importtime の簡易版よ)。
+    builtins.__import__ を差し替えて、まだ読み込まれていないモジュールの import だけ時間を記録するわ。
+    cumulative はそのモジュールが読み込んだ子も含めた時間、self_time は子を除いた時間よ。
+    __import__ を通るぶん少しだけ遅くなるので、--profile-startup のときにしか使わないでね。
+    """
+    def __init__(self):
+        self.cumulative: dict[str, float] = {}
+        self.self_time: dict[str, float] = {}
+        self._local = threading.local() # スレッドごとの入れ子の import (子にかかった時間の合計)
+        self._original = None
+
+    def install(self) -> "ImportProfiler":
+        if self._original is None:
+            self._original = builtins.__import__
+            builtins.__import__ = self._import
+        return self
+
+    def uninstall(self):
+        if self._original is not None:
+            builtins.__import__ = self._original
+            self._original = None
+
+    def _resolve(self, name: str, globals: dict | None, level: int) -> str | None:
+        if not level:
+            return name
+        try:
+            return importlib.util.resolve_name("." * level + name, (globals or {}).get("__package__"))
+        except (ImportError, ValueError):
+            return None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        original = self._original or builtins.__import__
+        module_name = self._resolve(name, globals, level)
+        if module_name is None or module_name in sys.modules:
+            return original(name, globals, locals, fromlist, level)
+
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - started
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            if module_name in sys.modules:
+                self.cumulative[module_name] = elapsed
+                self.self_time[module_name] = max(0.0, elapsed - children)
+
+    def slowest(self, limit: int) -> list[tuple[str, float, float]]:
+        """(モジュール名, 子を除いた時間, 子も含めた時間) を、子も含めた時間の長い順に返す"""
+        names = sorted(self.cumulative, key=self.cumulative.get, reverse=True)[:limit]
+        return [(name, self.self_time[name], self.cumulative[name]) for name in names]
+
+def format_report(profiler: ImportProfiler | None, startup_timings: dict[str, float], limit: int) -> str:
+    """起動の段階ごとの時間と、読み込みの遅かったモジュールを表にするわ"""
+    lines = ["起動プロファイル", "  段階ごとの所要時間:"]
+    for phase, seconds in startup_timings.items():
+        lines.append(f"    {phase:<30} {seconds * 1000:>9.1f} ms")
+    if profiler is not None and profiler.cumulative:
+        lines.append(f"  読み込みの遅かったモジュール (上位{limit}件, 自身 / 子を含む):")
+        for name, self_seconds, cumulative_seconds in profiler.slowest(limit):
+            lines.append(f"    {name:<40} {self_seconds * 1000:>9.1f} ms / {cumulative_seconds * 1000:>9.1f} ms")
+    return "\n".join(lines)
@@ -1,25 +1,98 @@
 # c:\Users\super\デスクトップ\新宿二丁目のオネエ\handlers\gemini_handler.py
-import google.generativeai as genai
+import asyncio
+import datetime
+import hashlib
 import logging
+import threading
+import time
+from collections.abc import AsyncIterator
+from typing import TYPE_CHECKING
 from config import GEMINI_API_KEY, GEMINI_MODEL_NAME # configから読み込み
+from config import GEMINI_CONTEXT_CACHE_ENABLED, GEMINI_CONTEXT_CACHE_MIN_TOKENS, GEMINI_CONTEXT_CACHE_TTL
+from handlers.prompt_builder import estimate_tokens
+
+if TYPE_CHECKING:
+    import google.generativeai as genai
 
 logger = logging.getLogger(__name__)
 
 class GeminiHandler:
+    """
+    google.generativeai は読み込むだけで時間がかかる (grpc や protobuf まで連れてくる) ので、
+    import するのは初めてリクエストするとき (か warm_up() を呼んだとき) よ。Cogを読み込むだけなら待たされないわ。
+    """
     def __init__(self):
         if not GEMINI_API_KEY:
             logger.error("Gemini APIキーが設定されていません。")
             raise ValueError("Gemini APIキーが設定されていません。")
-        genai.configure(api_key=GEMINI_API_KEY)
-        self.model = genai.GenerativeModel(GEMINI_MODEL_NAME)
-        logger.info(f"Geminiモデルを初期化しました: {GEMINI_MODEL_NAME}")
+        self._genai = None
+        self.model: "genai.GenerativeModel | None" = None
+        self._init_lock = threading.Lock() # warm_up() のスレッドと同時に初期化しないように
+        # 人格設定 (system_prompt) ごとのモデル。ハッシュ: (モデル, 作り直す時刻 (キャッシュでなければNone))
+        self._persona_models: dict[str, tuple["genai.GenerativeModel", float | None]] = {}
+        self._persona_lock = asyncio.Lock()
+
+    def _client(self):
+        """google.generativeai を読み込んで設定したものを返す (2回目からは読み込み済みのものよ)"""
+        if self._genai is not None:
+            return self._genai
+        with self._init_lock:
+            if self._genai is None:
+                started = time.perf_counter()
+                import google.generativeai as genai
+                genai.configure(api_key=GEMINI_API_KEY)
+                self.model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+                self._genai = genai
+                logger.info(f"Geminiモデルを初期化しました: {GEMINI_MODEL_NAME} ({time.perf_counter() - started:.2f}秒)")
+        return self._genai
 
-    async def generate_response(self, prompt: str) -> str | None:
+    async def warm_up(self):
+        """最初の質問を待たせないように、SDKの読み込みを別スレッドで先に済ませておく"""
+        try:
+            await asyncio.to_thread(self._client)
+        except Exception as e:
+            logger.error(f"Gemini SDKの読み込み中にエラー: {e}", exc_info=True)
+
+    async def _model_for(self, system_prompt: str | None) -> "genai.GenerativeModel":
+        """
+        人格設定つきのモデルを返す。人格設定は毎回送らずに使い回すわ。
+        十分に長ければGeminiのコンテキストキャッシュに置いて、短ければ system_instruction として持たせたモデルを取っておくの。
+        """
+        genai = self._client()
+        if not system_prompt or not system_prompt.strip():
+            return self.model
+        system_prompt = system_prompt.strip()
+        key = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()
+        async with self._persona_lock:
+            entry = self._persona_models.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+                return entry[0]
+            model, refresh_at = None, None
+            if GEMINI_CONTEXT_CACHE_ENABLED and estimate_tokens(system_prompt) >= GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+                try:
+                    cached = await asyncio.to_thread(
+                        genai.caching.CachedContent.create,
+                        model=GEMINI_MODEL_NAME, system_instruction=system_prompt,
+                        ttl=datetime.timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL),
+                    )
+                    model = genai.GenerativeModel.from_cached_content(cached_content=cached)
+                    refresh_at = time.monotonic() + GEMINI_CONTEXT_CACHE_TTL * 0.9 # 切れる少し前に作り直す
+                    logger.info(f"人格設定をGeminiのコンテキストキャッシュに置きました: {cached.name}")
+                except Exception as e:
+                    logger.warning(f"コンテキストキャッシュを作れなかったので、system_instruction として渡します: {e}")
+            if model is None:
+                model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=system_prompt)
+            self._persona_models[key] = (model, refresh_at)
+            return model
+
+    async def generate_response(self, prompt: str, system_prompt: str | None = None) -> str | None:
         """
         指定されたプロンプトに基づいてGeminiから応答を生成します。
+        system_prompt (人格設定) はリクエストごとには送らず、使い回すモデルに持たせるわ。
         """
         try:
-            response = await self.model.generate_content_async(prompt)
+            model = await self._model_for(system_prompt)
+            response = await model.generate_content_async(prompt)
             if response and hasattr(response, "text") and response.text.strip():
                 logger.info("Geminiからの応答を正常に取得しました。")
                 return response.text.strip()
@@ -30,3 +103,27 @@ class GeminiHandler:
             logger.error(f"Gemini APIでの応答生成中にエラー: {e}")
             return None
 
+    async def stream_response(self, prompt: str, system_prompt: str | None = None) -> AsyncIterator[str]:
+        """
+        指定されたプロンプトに基づいてGeminiから応答をストリーミングで受け取り、
+        届いたテキストの断片を順に返す非同期ジェネレータ。
+        エラーが起きたらそこで打ち切るので、呼び出し側は何も届かなかった場合に備えてね。
+        """
+        try:
+            model = await self._model_for(system_prompt)
+            response = await model.generate_content_async(prompt, stream=True)
+            received = 0
+            async for chunk in response:
+                try:
+                    text = chunk.text
+                except ValueError: # セーフティで弾かれた断片などはテキストを持たない
+                    continue
+                if text:
+                    received += len(text)
+                    yield text
+            if received:
+                logger.info(f"Geminiからのストリーミング応答を正常に取得しました ({received} 文字)。")
+            else:
+                logger.warning("Geminiからのストリーミング応答が空でした。")
+        except Exception as e:
+            logger.error(f"Gemini APIでのストリーミング応答生成中にエラー: {e}")
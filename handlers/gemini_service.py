@@ -0,0 +1,199 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\handlers\gemini_service.py
+import asyncio
+import itertools
+import logging
+import time
+from collections.abc import AsyncIterator
+from config import GEMINI_MAX_CONCURRENCY, GEMINI_RATE_LIMIT_PER_MINUTE, GEMINI_RATE_LIMIT_BURST
+from handlers.gemini_handler import GeminiHandler
+from core.metrics import GEMINI_LATENCY, REGISTRY, MetricFamily
+
+logger = logging.getLogger(__name__)
+
+# 優先度 (小さいほど先に処理する)。声で待たせるほうが気まずいので /voice を先にするわ
+PRIORITY_VOICE = 0
+PRIORITY_ASK = 1
+
+class TokenBucket:
+    """トークンバケット式のレート制限。1リクエストごとにトークンを1つ使うの"""
+    def __init__(self, rate_per_second: float, capacity: int):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.waited_seconds = 0.0 # レート制限で待った合計時間
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                self.waited_seconds += wait
+                await asyncio.sleep(wait)
+
+class _Job:
+    """1つのプロンプトに対するリクエスト。同じプロンプトを待っている人みんなで結果を分け合うわ"""
+    __slots__ = ("prompt", "system_prompt", "priority", "chunks", "started", "done", "subscribers", "submitted_at", "_condition")
+
+    def __init__(self, prompt: str, system_prompt: str | None, priority: int):
+        self.prompt = prompt
+        self.system_prompt = system_prompt
+        self.priority = priority
+        self.chunks: list[str] = []
+        self.started = False
+        self.done = False
+        self.subscribers = 0
+        self.submitted_at = time.perf_counter()
+        self._condition = asyncio.Condition()
+
+    async def push(self, chunk: str):
+        async with self._condition:
+            self.chunks.append(chunk)
+            self._condition.notify_all()
+
+    async def finish(self):
+        async with self._condition:
+            self.done = True
+            self._condition.notify_all()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        """届いた断片を最初から順に返す (途中から合流しても最初から受け取れるわ)"""
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                return
+            async with self._condition:
+                await self._condition.wait_for(lambda: index < len(self.chunks) or self.done)
+
+class GeminiService:
+    """
+    ボット全体で1つだけ使うGeminiの窓口。
+    - リクエストは優先度付きのキューに並べて、決まった数のワーカーで順に処理する (同時実行数の上限)
+    - 投げる前にトークンバケットでレート制限をかける (クォータ超えのエラーを避けるため)
+    - 同じプロンプトがもう並んでいたり処理中だったりしたら、新しく投げずに結果を分けてもらうわ
+    """
+    def __init__(self, handler: GeminiHandler, max_concurrency: int = GEMINI_MAX_CONCURRENCY,
+                 rate_per_minute: float = GEMINI_RATE_LIMIT_PER_MINUTE, burst: int = GEMINI_RATE_LIMIT_BURST):
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self._bucket = TokenBucket(rate_per_minute / 60, burst)
+        self._queue: asyncio.PriorityQueue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._sequence = itertools.count() # 同じ優先度なら来た順
+        self._jobs: dict[tuple[str | None, str], _Job] = {} # (人格設定, プロンプト): 並んでいるか処理中のリクエスト
+        self.running = 0
+        self.stats = {"submitted": 0, "coalesced": 0, "completed": 0, "failed": 0}
+
+    @property
+    def queue_depth(self) -> int:
+        """まだ処理が始まっていないリクエストの数"""
+        return sum(1 for job in self._jobs.values() if not job.started)
+
+    def metrics(self) -> dict[str, float]:
+        return {
+            "queue_depth": self.queue_depth,
+            "running": self.running,
+            "rate_limit_wait_seconds": self._bucket.waited_seconds,
+            **self.stats,
+        }
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+
+    def _submit(self, prompt: str, system_prompt: str | None, priority: int) -> _Job:
+        self._ensure_workers()
+        key = (system_prompt, prompt)
+        job = self._jobs.get(key)
+        if job is not None:
+            self.stats["coalesced"] += 1
+            if priority < job.priority and not job.started:
+                # 優先度の高い人が合流したら、高い優先度でもう一度並べておく (先に取り出されたほうが処理するわ)
+                job.priority = priority
+                self._queue.put_nowait((priority, next(self._sequence), job))
+            logger.info(f"同じ質問がすでに処理中なので相乗りします (待ち {self.queue_depth} 件)")
+        else:
+            job = self._jobs[key] = _Job(prompt, system_prompt, priority)
+            self._queue.put_nowait((priority, next(self._sequence), job))
+            self.stats["submitted"] += 1
+            logger.info(f"Geminiへのリクエストを受け付けました (優先度 {priority}, 待ち {self.queue_depth} 件, 処理中 {self.running} 件)")
+        job.subscribers += 1
+        return job
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self._queue.get()
+            if job.started: # 優先度を上げて並べ直した分の残り
+                self._queue.task_done()
+                continue
+            job.started = True
+            try:
+                await self._bucket.acquire()
+                started = time.perf_counter()
+                GEMINI_LATENCY.observe(started - job.submitted_at, stage="queue_wait") # レート制限で待った分も含むわ
+                self.running += 1
+                try:
+                    async for chunk in self.handler.stream_response(job.prompt, job.system_prompt):
+                        if not job.chunks:
+                            GEMINI_LATENCY.observe(time.perf_counter() - started, stage="first_chunk")
+                        await job.push(chunk)
+                finally:
+                    self.running -= 1
+                    GEMINI_LATENCY.observe(time.perf_counter() - started, stage="total")
+                self.stats["completed" if job.chunks else "failed"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"Geminiへのリクエスト処理中にエラー: {e}", exc_info=True)
+            finally:
+                key = (job.system_prompt, job.prompt)
+                if self._jobs.get(key) is job:
+                    del self._jobs[key]
+                await job.finish()
+                self._queue.task_done()
+
+    async def stream_response(self, prompt: str, priority: int = PRIORITY_ASK, system_prompt: str | None = None) -> AsyncIterator[str]:
+        """
+        GeminiHandler.stream_response と同じく、返答の断片を順に返す。
+        エラーのときは何も返さずに終わるので、呼び出し側は空の返答に備えてね。
+        """
+        job = self._submit(prompt, system_prompt, priority)
+        async for chunk in job.subscribe():
+            yield chunk
+
+    async def generate_response(self, prompt: str, priority: int = PRIORITY_ASK, system_prompt: str | None = None) -> str | None:
+        chunks = [chunk async for chunk in self.stream_response(prompt, priority, system_prompt)]
+        text = "".join(chunks).strip()
+        return text or None
+
+    def collect_metrics(self) -> list[MetricFamily]:
+        """メトリクスのコレクター。待ち行列の長さなどを、出力するたびにその場で数えるわ"""
+        return [
+            MetricFamily("mama_gemini_queue_depth", "gauge", "Geminiへのリクエストの待ち件数").add(self.queue_depth),
+            MetricFamily("mama_gemini_running", "gauge", "Geminiへ投げている最中のリクエスト数").add(self.running),
+            MetricFamily("mama_gemini_rate_limit_wait_seconds_total", "counter", "レート制限で待った合計時間 (秒)").add(self._bucket.waited_seconds),
+            MetricFamily("mama_gemini_jobs_total", "counter", "Geminiへのリクエストの件数 (相乗りも含む)").add(self.stats["submitted"], result="submitted")
+                .add(self.stats["coalesced"], result="coalesced").add(self.stats["completed"], result="completed").add(self.stats["failed"], result="failed"),
+        ]
+
+_service: GeminiService | None = None
+
+def get_gemini_service() -> GeminiService:
+    """ボット全体で共有するGeminiServiceを返す。初めて呼ばれたときに作るわ"""
+    global _service
+    if _service is None:
+        _service = GeminiService(GeminiHandler())
+        REGISTRY.register_collector(_service.collect_metrics)
+    return _service
@@ -0,0 +1,40 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\handlers\prompt_builder.py
+import logging
+import re
+from config import PROMPT_HISTORY_TOKEN_BUDGET
+
+logger = logging.getLogger(__name__)
+
+# 1文字でだいたい1トークンになる文字 (かな・カナ・漢字・全角記号)
+_WIDE_PATTERN = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数の見積もり。Geminiのトークナイザーは手元にないので、APIを呼ばずにざっくり数えるわ。
+    日本語は1文字1トークン、それ以外 (英数字や空白) は4文字で1トークンくらいとして数えるの (少し多めに出る見積もりよ)。
+    """
+    wide = len(_WIDE_PATTERN.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+def trim_history(history: list[str], budget: int = PROMPT_HISTORY_TOKEN_BUDGET) -> list[str]:
+    """古い順に並んだ会話履歴から、新しい発言を優先して budget トークンに収まる分だけ返す (古い順のまま)"""
+    kept: list[str] = []
+    used = 0
+    for line in reversed(history):
+        tokens = estimate_tokens(line) + 1 # 改行の分
+        if used + tokens > budget:
+            break
+        kept.append(line)
+        used += tokens
+    kept.reverse()
+    if len(kept) < len(history):
+        logger.info(f"会話履歴をトークン数の上限に合わせて {len(history)} 件から {len(kept)} 件に減らしました (約 {used} トークン)")
+    return kept
+
+def build_q_prompt(history: list[str], user_display_name: str, question: str) -> str:
+    """
+    /q で毎回送る部分 (会話履歴と質問) を組み立てる。
+    人格設定 (prompt/q.txt) はここには入れずに、system_prompt として別に渡してね (キャッシュされるわ)
+    """
+    history_text = "\n".join(trim_history(history))
+    return f"--- 会話履歴 ---\n{history_text}\n\n--- {user_display_name}からの質問 ---\n{question}"
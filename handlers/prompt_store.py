@@ -0,0 +1,150 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\handlers\prompt_store.py
+import logging
+import os
+import time
+from config import PROMPT_DIR, PROMPT_RELOAD_CHECK_INTERVAL, find_prompt_file
+
+logger = logging.getLogger(__name__)
+
+def fallback_prompt(keyword: str) -> str:
+    """プロンプトファイルが見当たらないときの代わりの文"""
+    return f"あら、ちょっと設定ファイルが見当たらないわね…？ ({keyword}プロンプト)\n\n"
+
+class _Prompt:
+    __slots__ = ("path", "mtime_ns", "size", "text", "checked_at")
+
+    def __init__(self, path: str | None):
+        self.path = path
+        self.mtime_ns: int | None = None
+        self.size: int | None = None
+        self.text: str | None = None
+        self.checked_at = 0.0
+
+class PromptStore:
+    """
+    prompt/ フォルダのプロンプト (人格設定) を、キーワード (= 人格の名前) ごとに覚えておくの。
+    ファイルの探し方は find_prompt_file と同じよ (q なら q.txt、なければ q を含む .txt)。
+    使うたびに更新日時とサイズを見て (check_interval 秒に1回まで)、変わっていたときだけ読み直すわ。
+    だから q.txt を書き換えてもボットを再起動しなくていいし、VCの接続や音楽のキューも切れないの。
+    ファイルを足したり消したりしたときは reload() で探し直してね。
+    """
+    def __init__(self, directory: str = PROMPT_DIR, check_interval: float = PROMPT_RELOAD_CHECK_INTERVAL):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._prompts: dict[str, _Prompt] = {} # キーワード: 読み込んだプロンプト (見つからなかったものも覚えておくわ)
+        self._personas: list[str] = []
+        self._personas_mtime_ns: int | None = None # 人格の一覧を作ったときのフォルダの更新日時
+        self.stats = {"reads": 0, "checks": 0}
+
+    def get(self, keyword: str) -> str | None:
+        """キーワードに合うプロンプトを返す。ファイルが見つからなければNone"""
+        return self._entry(keyword).text
+
+    def path(self, keyword: str) -> str | None:
+        return self._entry(keyword).path
+
+    def _entry(self, keyword: str) -> _Prompt:
+        now = time.monotonic()
+        prompt = self._prompts.get(keyword)
+        if prompt is not None and now - prompt.checked_at < self.check_interval:
+            return prompt
+        self.stats["checks"] += 1
+
+        if prompt is None or prompt.path is None:
+            prompt = self._prompts[keyword] = _Prompt(find_prompt_file(keyword, self.directory))
+        prompt.checked_at = now
+        if prompt.path is None:
+            return prompt
+        try:
+            stat = os.stat(prompt.path)
+        except FileNotFoundError:
+            # 消されたか名前が変わったので、探し直す
+            logger.info(f"プロンプトファイルが見つからなくなったので探し直します: {prompt.path}")
+            path = find_prompt_file(keyword, self.directory)
+            if path is None:
+                prompt.path, prompt.text, prompt.mtime_ns, prompt.size = None, None, None, None
+                return prompt
+            prompt.path = path
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                logger.error(f"プロンプトファイル ({path}) の確認中にエラー: {e}")
+                return prompt
+        except OSError as e:
+            logger.error(f"プロンプトファイル ({prompt.path}) の確認中にエラー: {e}")
+            return prompt
+
+        if prompt.text is not None and stat.st_mtime_ns == prompt.mtime_ns and stat.st_size == prompt.size:
+            return prompt # 変わっていない
+        try:
+            with open(prompt.path, "r", encoding="utf-8") as f:
+                text = f.read().strip() + "\n\n"
+        except Exception as e:
+            # 読めなかったら、前に読めたものがあればそれを使い続けるわ
+            logger.error(f"{keyword}コマンド用プロンプトファイル ({prompt.path}) の読み込み中にエラー: {e}")
+            return prompt
+        if prompt.text is None:
+            logger.info(f"{keyword}コマンド用プロンプトファイルを読み込みました: {prompt.path}")
+        elif text != prompt.text:
+            logger.info(f"{keyword}コマンド用プロンプトファイルが変更されたので読み直しました: {prompt.path}")
+        prompt.text, prompt.mtime_ns, prompt.size = text, stat.st_mtime_ns, stat.st_size
+        self.stats["reads"] += 1
+        return prompt
+
+    def personas(self) -> list[str]:
+        """prompt/ フォルダにある人格 (.txt ファイルの名前) の一覧。フォルダが変わったときだけ数え直すわ"""
+        try:
+            mtime_ns = os.stat(self.directory).st_mtime_ns
+            if mtime_ns != self._personas_mtime_ns:
+                self._personas = sorted(
+                    os.path.splitext(filename)[0] for filename in os.listdir(self.directory)
+                    if filename.lower().endswith(".txt")
+                )
+                self._personas_mtime_ns = mtime_ns
+        except OSError as e:
+            logger.warning(f"プロンプトディレクトリを確認できませんでした ({self.directory}): {e}")
+            return []
+        return self._personas
+
+    def reload(self) -> dict[str, bool]:
+        """
+        覚えているプロンプトを全部探し直して読み直す。キーワード: 中身が変わったか、を返すわ。
+        ファイルを足したり名前を変えたりしたときはこれを呼んでね (中身を書き換えただけなら自動で読み直すわ)
+        """
+        previous = {keyword: prompt.text for keyword, prompt in self._prompts.items()}
+        self._prompts.clear()
+        self._personas_mtime_ns = None
+        return {keyword: self.get(keyword) != text for keyword, text in previous.items()}
+
+_store: PromptStore | None = None
+
+def get_prompt_store() -> PromptStore:
+    """ボット全体で共有するPromptStoreを返す。初めて呼ばれたときに作るわ"""
+    global _store
+    if _store is None:
+        _store = PromptStore()
+    return _store
+
+def resolve_persona(persona: str | None, default_keyword: str) -> tuple[str, str | None]:
+    """
+    コマンドで選ばれた人格のプロンプトと、ユーザーへのお知らせ (なければNone) を返す。
+    選ばれていなければいつもの (default_keyword の) プロンプトよ。
+    選べるのは personas() にある名前だけで、それ以外はファイルを探しに行かずにいつものプロンプトにするわ
+    (好きな文字列で PromptStore に覚えるものが増えていかないように)。
+    いつものプロンプトが見つからないときは代わりの文を返すわ。
+    """
+    store = get_prompt_store()
+    notice = None
+    if persona:
+        if persona in store.personas():
+            prompt = store.get(persona)
+            if prompt:
+                return prompt, None
+        logger.info(f"人格 '{persona}' は見当たらないので、いつもの ({default_keyword}) プロンプトを使います")
+        notice = f"'{persona}' っていう人格は見当たらないから、いつものアタシで答えるわね。"
+    return store.get(default_keyword) or fallback_prompt(default_keyword), notice
+
+def persona_choices(current: str, limit: int = 25) -> list[str]:
+    """オートコンプリート用に、入力中の文字を含む人格の名前を返す"""
+    current = current.casefold()
+    return [name for name in get_prompt_store().personas() if current in name.casefold()][:limit]
@@ -0,0 +1,163 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\handlers\response_cache.py
+import hashlib
+import logging
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from config import (
+    RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_NEAR_DUPLICATE,
+    RESPONSE_CACHE_SIMILARITY, RESPONSE_CACHE_NGRAM,
+)
+from core.metrics import register_cache_stats
+
+logger = logging.getLogger(__name__)
+
+# 正規化で消す文字 (空白・記号・句読点。「？」と「?」、「ママ!」と「ママ！！」を同じ質問として扱うため)
+_IGNORED_PATTERN = re.compile(r"[\s\W_ー〜～]+", re.UNICODE)
+
+def normalize_question(question: str) -> str:
+    """全角半角・大文字小文字・記号や空白の違いをならした質問文を返す"""
+    text = unicodedata.normalize("NFKC", question).casefold()
+    return _IGNORED_PATTERN.sub("", text)
+
+def template_version(template: str) -> str:
+    """プロンプトのテンプレートの版。テンプレートを書き換えたら別の版になるので、古い返答は使われなくなるわ"""
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()[:12]
+
+def history_digest(history: str) -> str:
+    return hashlib.sha256(history.encode("utf-8")).hexdigest()[:12]
+
+def _ngrams(text: str, n: int) -> frozenset[str]:
+    if len(text) <= n:
+        return frozenset((text,)) if text else frozenset()
+    return frozenset(text[i:i + n] for i in range(len(text) - n + 1))
+
+class _Entry:
+    __slots__ = ("namespace", "question", "answer", "expires_at", "grams")
+
+    def __init__(self, namespace: str, question: str, answer: str, expires_at: float, grams: frozenset[str]):
+        self.namespace = namespace
+        self.question = question
+        self.answer = answer
+        self.expires_at = expires_at
+        self.grams = grams
+
+class ResponseCache:
+    """
+    Geminiの返答のキャッシュ。キーは「テンプレートの版 (+会話履歴のハッシュ, +聞いた人) + 正規化した質問文」よ。
+    一定時間 (ttl) で期限切れになって、入りきらなくなったら一番長く使われていないものから捨てる (LRU)。
+    near_duplicate を有効にすると、文字n-gramの重なり (Jaccard係数) が similarity 以上の
+    よく似た質問にも同じ返答を返すわ。n-gramから逆引きする索引を持っているので、全件と比べたりはしないの。
+    """
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 near_duplicate: bool = RESPONSE_CACHE_NEAR_DUPLICATE, similarity: float = RESPONSE_CACHE_SIMILARITY,
+                 ngram: int = RESPONSE_CACHE_NGRAM):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.near_duplicate = near_duplicate
+        self.similarity = similarity
+        self.ngram = ngram
+        self._entries: OrderedDict[tuple[str, str], _Entry] = OrderedDict()
+        self._index: dict[str, set[tuple[str, str]]] = {} # n-gram: それを含むエントリのキー
+        self.stats = {"hits": 0, "near_hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def _namespace(template: str, history: str | None, user: str | None) -> str:
+        namespace = template_version(template)
+        if history is not None:
+            namespace += f":{history_digest(history)}"
+        if user is not None:
+            namespace += f":{history_digest(user)}"
+        return namespace
+
+    def get(self, template: str, question: str, history: str | None = None, user: str | None = None) -> str | None:
+        """
+        キャッシュ済みの返答を返す。なければNone。
+        history を渡すと、会話履歴まで同じときだけ当たりにするわ (保存するときも同じように渡してね)。
+        user はプロンプトに聞いた人の名前が入るとき用よ。別の人に宛てた返答を返さないように、同じ人のときだけ当たりにするの
+        """
+        namespace = self._namespace(template, history, user)
+        normalized = normalize_question(question)
+        now = time.monotonic()
+        key = (namespace, normalized)
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= now:
+            self._remove(key)
+            entry = None
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry.answer
+        if self.near_duplicate and normalized:
+            entry = self._find_similar(namespace, normalized, now)
+            if entry is not None:
+                self._entries.move_to_end((entry.namespace, entry.question))
+                self.stats["near_hits"] += 1
+                logger.info(f"よく似た質問の返答をキャッシュから返します: {question}")
+                return entry.answer
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, template: str, question: str, answer: str, history: str | None = None, user: str | None = None):
+        namespace = self._namespace(template, history, user)
+        normalized = normalize_question(question)
+        if not normalized or not answer:
+            return
+        key = (namespace, normalized)
+        if key in self._entries:
+            self._remove(key)
+        grams = _ngrams(normalized, self.ngram) if self.near_duplicate else frozenset()
+        self._entries[key] = _Entry(namespace, normalized, answer, time.monotonic() + self.ttl, grams)
+        for gram in grams:
+            self._index.setdefault(gram, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.stats["evictions"] += 1
+
+    def _find_similar(self, namespace: str, normalized: str, now: float) -> _Entry | None:
+        grams = _ngrams(normalized, self.ngram)
+        shared: dict[tuple[str, str], int] = {}
+        for gram in grams:
+            for key in self._index.get(gram, ()):
+                if key[0] == namespace:
+                    shared[key] = shared.get(key, 0) + 1
+        best, best_score = None, self.similarity
+        expired = []
+        for key, count in shared.items():
+            entry = self._entries[key]
+            if entry.expires_at <= now:
+                expired.append(key)
+                continue
+            score = count / (len(grams) + len(entry.grams) - count)
+            if score >= best_score:
+                best, best_score = entry, score
+        for key in expired:
+            self._remove(key)
+        return best
+
+    def _remove(self, key: tuple[str, str]):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for gram in entry.grams:
+            keys = self._index.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[gram]
+
+    def clear(self):
+        self._entries.clear()
+        self._index.clear()
+
+_cache: ResponseCache | None = None
+
+def get_response_cache() -> ResponseCache:
+    """ボット全体で共有する返答キャッシュを返す。初めて呼ばれたときに作るわ"""
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache()
+        register_cache_stats("response", _cache.stats)
+    return _cache
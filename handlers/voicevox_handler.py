@@ -1,44 +1,134 @@
 # c:\Users\super\デスクトップ\新宿二丁目のオネエ\handlers\voicevox_handler.py
-import requests
+import aiohttp
+import asyncio
 import logging
-from config import VOICEVOX_BASE_URL, VOICEVOX_SPEAKER_ID # configから読み込み
+from config import ( # configから読み込み
+    VOICEVOX_BASE_URL, VOICEVOX_SPEAKER_ID, VOICEVOX_MAX_CONCURRENCY,
+    VOICEVOX_QUERY_TIMEOUT, VOICEVOX_SYNTHESIS_TIMEOUT,
+    VOICEVOX_MAX_RETRIES, VOICEVOX_RETRY_BACKOFF,
+)
+from audio.tts_cache import TTSCache, make_cache_key
+from core.metrics import VOICEVOX_LATENCY, VOICEVOX_ERRORS
 
 logger = logging.getLogger(__name__)
 
-def synthesize_voice(text: str, speaker: int = VOICEVOX_SPEAKER_ID, output_path="output.wav"):
+class VoicevoxClient:
     """
-    VOICEVOX APIを使用して音声を合成する関数。
+    VOICEVOX APIと非同期でお話しするクライアント。
+    keep-aliveの接続プールを使い回し、同時合成数をセマフォで制限するわ。
+    タイムアウトや5xxエラーのときは指数バックオフでリトライするの。
+    cache を渡すと、同じ台詞はVOICEVOXに問い合わせずキャッシュから返すわ。
     """
-    try:
-        # 音声生成のためのクエリ作成
-        query_url = f"{VOICEVOX_BASE_URL}/audio_query"
-        query_params = {"text": text, "speaker": speaker}
-        response_query = requests.post(query_url, params=query_params, timeout=10) # 10秒のタイムアウト
-        response_query.raise_for_status()  # エラーがあれば例外を発生
-
-        # 実際の音声を合成
-        synthesis_url = f"{VOICEVOX_BASE_URL}/synthesis"
-        synthesis_params = {"speaker": speaker}
-        synthesis_headers = {"Content-Type": "application/json"}
-        response_synthesis = requests.post(
-            synthesis_url,
-            params=synthesis_params,
-            headers=synthesis_headers,
-            json=response_query.json(),
-            timeout=30 # 音声合成は少し長めに30秒のタイムアウト
-        )
-        response_synthesis.raise_for_status() # エラーがあれば例外を発生
-
-        # 合成した音声をファイルとして保存
-        with open(output_path, "wb") as f:
-            f.write(response_synthesis.content)
-        logger.info(f"音声を合成しました: {output_path}")
-        return output_path
-    except requests.exceptions.RequestException as e:
-        logger.error(f"VOICEVOX APIリクエストエラー: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            logger.error(f"VOICEVOX APIレスポンス: {e.response.status_code} {e.response.text}")
-        return None
-    except Exception as e:
-        logger.error(f"VOICEVOX音声合成中に予期せぬエラー: {e}")
+    def __init__(
+        self,
+        base_url: str = VOICEVOX_BASE_URL,
+        max_concurrency: int = VOICEVOX_MAX_CONCURRENCY,
+        query_timeout: float = VOICEVOX_QUERY_TIMEOUT,
+        synthesis_timeout: float = VOICEVOX_SYNTHESIS_TIMEOUT,
+        max_retries: int = VOICEVOX_MAX_RETRIES,
+        retry_backoff: float = VOICEVOX_RETRY_BACKOFF,
+        cache: TTSCache | None = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.query_timeout = query_timeout
+        self.synthesis_timeout = synthesis_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.cache = cache
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session: aiohttp.ClientSession | None = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # セッションはイベントループ上で遅延生成する (import時にはループがないため)
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency * 2, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+            logger.info(f"VOICEVOX用のHTTPセッションを作成しました (同時実行数: {self.max_concurrency})")
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+            logger.info("VOICEVOX用のHTTPセッションを閉じました。")
+        self._session = None
+
+    async def _post(self, path: str, *, params: dict, timeout: float, json: dict | None = None, as_json: bool = False):
+        """リトライ付きでPOSTし、レスポンス本体 (JSONまたはバイト列) を返す。"""
+        url = f"{self.base_url}{path}"
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._get_session().post(url, params=params, json=json, timeout=client_timeout) as response:
+                    if response.status >= 500:
+                        body = await response.text()
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history,
+                            status=response.status, message=body,
+                        )
+                    if response.status >= 400:
+                        # 4xxはリトライしても直らないので即座に諦める
+                        body = await response.text()
+                        logger.error(f"VOICEVOX APIレスポンス: {response.status} {body}")
+                        return None
+                    if as_json:
+                        return await response.json()
+                    return await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    logger.error(f"VOICEVOX APIリクエストエラー ({path}, {attempt + 1}回目で断念): {e!r}")
+                    return None
+                delay = self.retry_backoff * (2 ** attempt)
+                logger.warning(f"VOICEVOX APIリクエストエラー ({path}, {attempt + 1}回目): {e!r}。{delay:.1f}秒後にリトライするわ。")
+                await asyncio.sleep(delay)
         return None
+
+    async def audio_query(self, text: str, speaker: int = VOICEVOX_SPEAKER_ID) -> dict | None:
+        """音声生成のためのクエリを作成する。"""
+        with VOICEVOX_LATENCY.time(endpoint="audio_query"):
+            query = await self._post(
+                "/audio_query", params={"text": text, "speaker": speaker},
+                timeout=self.query_timeout, as_json=True,
+            )
+        if query is None:
+            VOICEVOX_ERRORS.inc(endpoint="audio_query")
+        return query
+
+    async def synthesis(self, query: dict, speaker: int = VOICEVOX_SPEAKER_ID) -> bytes | None:
+        """クエリから実際の音声 (WAVバイト列) を合成する。"""
+        with VOICEVOX_LATENCY.time(endpoint="synthesis"):
+            wav_bytes = await self._post(
+                "/synthesis", params={"speaker": speaker}, json=query,
+                timeout=self.synthesis_timeout,
+            )
+        if wav_bytes is None:
+            VOICEVOX_ERRORS.inc(endpoint="synthesis")
+        return wav_bytes
+
+    async def synthesize(self, text: str, speaker: int = VOICEVOX_SPEAKER_ID) -> bytes | None:
+        """
+        テキストから音声を合成してWAVのバイト列を返す。失敗したらNone。
+        同時に合成できる数は max_concurrency までに制限されるわ。
+        """
+        try:
+            cache_key = None
+            if self.cache is not None:
+                cache_key = make_cache_key(text, speaker)
+                cached = await self.cache.get(cache_key)
+                if cached is not None:
+                    logger.info(f"TTSキャッシュにヒットしたわ ({len(cached)} bytes, speaker={speaker})")
+                    return cached
+
+            async with self._semaphore:
+                query = await self.audio_query(text, speaker)
+                if query is None:
+                    return None
+                wav_bytes = await self.synthesis(query, speaker)
+            if wav_bytes:
+                logger.info(f"音声を合成しました ({len(wav_bytes)} bytes, speaker={speaker})")
+                if cache_key is not None:
+                    await self.cache.put(cache_key, wav_bytes)
+            return wav_bytes
+        except Exception as e:
+            logger.error(f"VOICEVOX音声合成中に予期せぬエラー: {e}", exc_info=True)
+            return None
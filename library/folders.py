@@ -0,0 +1,90 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\library\folders.py
+import logging
+import os
+import posixpath
+import time
+from library.index import Track
+from library.search import fold
+
+logger = logging.getLogger(__name__)
+
+class FolderNode:
+    """フォルダ1つ分。配下 (サブフォルダ含む) の曲を、ライブラリ一覧上の区間で覚えておくの。"""
+    __slots__ = ("path", "key", "ranges", "count", "children")
+
+    def __init__(self, path: str, key: str):
+        self.path = path # 表示用のフォルダパス (最初に見つかった表記)
+        self.key = key   # 正規化したフォルダパス
+        self.ranges: list[list[int]] = [] # [開始, 終了) の区間のリスト
+        self.count = 0   # 配下の曲数
+        self.children: dict[str, "FolderNode"] = {}
+
+    def _add(self, index: int):
+        if self.ranges and self.ranges[-1][1] == index:
+            self.ranges[-1][1] = index + 1
+        else:
+            self.ranges.append([index, index + 1])
+        self.count += 1
+
+def normalize_folder(folder_path: str) -> str:
+    """ユーザーが打ったフォルダパスを索引のキーに揃える"""
+    key = posixpath.normpath(fold(folder_path.strip()))
+    return key.strip("/") if key != "." else ""
+
+class FolderTree:
+    """
+    音楽ライブラリのフォルダ構造。ライブラリ一覧は表示名順に並んでいるので、
+    あるフォルダ配下の曲は一覧上でひと続きの区間になるわ (大文字/小文字違いで分かれたときだけ複数区間)。
+    だからフォルダの解決は辞書を一回引くだけ、曲の取り出しはスライスだけで済むの。
+    """
+    def __init__(self, tracks: list[Track]):
+        started = time.perf_counter()
+        self.tracks = tracks
+        self.root = FolderNode("", "")
+        self.nodes: dict[str, FolderNode] = {}
+        for index, track in enumerate(tracks):
+            if not track.folder:
+                continue
+            parts = track.folder.split(os.sep)
+            parent = self.root
+            for depth in range(1, len(parts) + 1):
+                path = os.sep.join(parts[:depth])
+                key = normalize_folder(path)
+                node = self.nodes.get(key)
+                if node is None:
+                    node = self.nodes[key] = FolderNode(path, key)
+                    parent.children[key] = node
+                node._add(index)
+                parent = node
+        self.sorted_keys = sorted(self.nodes)
+        elapsed = (time.perf_counter() - started) * 1000
+        logger.info(f"フォルダ索引を作りました: {len(self.nodes)} フォルダ ({elapsed:.1f} ms)")
+
+    def resolve(self, folder_path: str) -> FolderNode | None:
+        key = normalize_folder(folder_path)
+        return self.nodes.get(key) if key else None
+
+    def tracks_in(self, node: FolderNode) -> list[Track]:
+        """フォルダ配下 (サブフォルダ含む) の曲を表示名順で返す"""
+        if len(node.ranges) == 1:
+            start, end = node.ranges[0]
+            return self.tracks[start:end]
+        return sorted(
+            (track for start, end in node.ranges for track in self.tracks[start:end]),
+            key=lambda t: t.display_name,
+        )
+
+    def suggest(self, query: str, limit: int = 25) -> list[FolderNode]:
+        """オートコンプリート用に、クエリを含むフォルダを返す (前方一致を優先)。"""
+        q = fold(query.strip()).strip("/")
+        if not q:
+            return [self.nodes[key] for key in self.sorted_keys[:limit]]
+        starts, contains = [], []
+        for key in self.sorted_keys:
+            if key.startswith(q):
+                starts.append(self.nodes[key])
+                if len(starts) >= limit:
+                    break
+            elif q in key and len(contains) < limit:
+                contains.append(self.nodes[key])
+        return (starts + contains)[:limit]
@@ -0,0 +1,169 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\library\index.py
+import json
+import logging
+import os
+import threading
+import time
+from config import MUSIC_LIBRARY_INDEX_PATH
+
+logger = logging.getLogger(__name__)
+
+# サポートする可能性のある拡張子 (FFmpegが対応するもの)
+SUPPORTED_EXTENSIONS = ('.mp3', '.wav', '.ogg', '.flac', '.m4a', '.aac')
+
+class Track:
+    """ライブラリ内の1曲。キューなどからはこのオブジェクトを参照して使い回すわ。"""
+    __slots__ = ("path", "display_name", "size", "mtime_ns", "folder", "gain_db")
+
+    def __init__(self, path: str, display_name: str, size: int, mtime_ns: int, folder: str, gain_db: float | None = None):
+        self.path = path                 # 絶対パス
+        self.display_name = display_name # 音楽ディレクトリからの相対パス (表示名)
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.folder = folder             # 表示名の親フォルダ ("" ならルート直下)
+        self.gain_db = gain_db           # ラウドネスを揃えるための補正量 (dB)。まだ測っていなければNone
+
+    def __repr__(self) -> str:
+        return f"Track({self.display_name!r})"
+
+class MusicLibrary:
+    """
+    音楽ディレクトリの索引。起動時に一度だけ全体を走査して、以降はメモリから返すの。
+    再走査はディレクトリのmtimeを比べて、中身が変わったディレクトリだけ読み直すわ。
+    (ディレクトリのmtimeはファイルの追加・削除・リネームで変わるので、それを変更の目印にしているの)
+    索引はJSONに保存しておくので、再起動後も変わったところだけ読み直せば済むわよ。
+    """
+    def __init__(self, root: str, index_path: str | None = MUSIC_LIBRARY_INDEX_PATH, extensions: tuple[str, ...] = SUPPORTED_EXTENSIONS):
+        self.root = os.path.abspath(root)
+        self.index_path = index_path
+        self.extensions = extensions
+        # 相対ディレクトリパス: (mtime_ns, サブディレクトリ名のリスト, そのディレクトリ直下の曲のリスト)
+        self._dirs: dict[str, tuple[int, list[str], list[Track]]] = {}
+        self.tracks: list[Track] = [] # display_name 順
+        self._details: list[tuple[str, str]] = [] # (absolute_path, display_name) 順序は tracks と同じ
+        self.version = 0 # 中身が変わるたびに増える (検索索引などの作り直しの目印)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    def details(self) -> list[tuple[str, str]]:
+        """(absolute_path, display_name) のリスト。呼び出し側で書き換えないでね。"""
+        return self._details
+
+    def _scan_dir(self, rel_dir: str, abs_dir: str, mtime_ns: int) -> tuple[int, list[str], list[Track]]:
+        subdirs = []
+        tracks = []
+        # 前回から変わっていないファイルは、測っておいたラウドネスを引き継ぐ
+        previous = self._dirs.get(rel_dir)
+        previous_tracks = {t.display_name: t for t in previous[2]} if previous else {}
+        with os.scandir(abs_dir) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.name.lower().endswith(self.extensions) and entry.is_file():
+                        stat = entry.stat()
+                        display_name = os.path.normpath(os.path.join(rel_dir, entry.name))
+                        old = previous_tracks.get(display_name)
+                        unchanged = old is not None and old.size == stat.st_size and old.mtime_ns == stat.st_mtime_ns
+                        tracks.append(Track(
+                            os.path.join(self.root, display_name), display_name,
+                            stat.st_size, stat.st_mtime_ns, rel_dir,
+                            old.gain_db if unchanged else None,
+                        ))
+                except OSError as e:
+                    logger.warning(f"音楽ファイルの情報を取得できませんでした: {entry.path} ({e})")
+        return (mtime_ns, subdirs, tracks)
+
+    def refresh(self) -> bool:
+        """
+        音楽ディレクトリを再走査する。mtimeが変わっていないディレクトリは前回の結果を使い回すわ。
+        中身が変わったらTrueを返す。ブロッキングするので asyncio.to_thread などから呼んでね。
+        """
+        with self._lock:
+            started = time.perf_counter()
+            new_dirs: dict[str, tuple[int, list[str], list[Track]]] = {}
+            rescanned = 0
+            stack = [""]
+            while stack:
+                rel_dir = stack.pop()
+                abs_dir = os.path.join(self.root, rel_dir) if rel_dir else self.root
+                try:
+                    mtime_ns = os.stat(abs_dir).st_mtime_ns
+                    cached = self._dirs.get(rel_dir)
+                    if cached is not None and cached[0] == mtime_ns:
+                        entry = cached
+                    else:
+                        entry = self._scan_dir(rel_dir, abs_dir, mtime_ns)
+                        rescanned += 1
+                except OSError as e:
+                    if rel_dir:
+                        logger.warning(f"音楽ディレクトリを読めませんでした: {abs_dir} ({e})")
+                    continue
+                new_dirs[rel_dir] = entry
+                stack.extend(os.path.join(rel_dir, name) if rel_dir else name for name in entry[1])
+
+            changed = rescanned > 0 or new_dirs.keys() != self._dirs.keys()
+            self._dirs = new_dirs
+            if changed:
+                self._rebuild_tracks()
+            elapsed = (time.perf_counter() - started) * 1000
+            logger.info(f"音楽ライブラリを走査しました: {len(self.tracks)} 曲, 読み直したディレクトリ {rescanned}/{len(new_dirs)} ({elapsed:.1f} ms)")
+            return changed
+
+    def _rebuild_tracks(self):
+        tracks = [track for _, _, dir_tracks in self._dirs.values() for track in dir_tracks]
+        tracks.sort(key=lambda t: t.display_name) # display_name (相対パス) でソート
+        # 参照を丸ごと差し替えるので、読み手はロックなしで古いか新しいどちらかの一覧を見るわ
+        self.tracks = tracks
+        self._details = [(t.path, t.display_name) for t in tracks]
+        self.version += 1
+
+    def load(self) -> bool:
+        """保存しておいた索引を読み込む。読めたらTrue。"""
+        if not self.index_path or not os.path.exists(self.index_path):
+            return False
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("root") != self.root:
+                logger.info(f"音楽ライブラリの索引は別のディレクトリのものなので使わないわ: {data.get('root')}")
+                return False
+            dirs = {}
+            for rel_dir, (mtime_ns, subdirs, files) in data["dirs"].items():
+                tracks = []
+                for name, size, file_mtime_ns, *rest in files: # 古い索引にはラウドネスの欄がないわ
+                    display_name = os.path.normpath(os.path.join(rel_dir, name))
+                    gain_db = rest[0] if rest else None
+                    tracks.append(Track(os.path.join(self.root, display_name), display_name, size, file_mtime_ns, rel_dir, gain_db))
+                dirs[rel_dir] = (mtime_ns, subdirs, tracks)
+        except Exception as e:
+            logger.warning(f"音楽ライブラリの索引を読み込めませんでした ({self.index_path}): {e}")
+            return False
+        with self._lock:
+            self._dirs = dirs
+            self._rebuild_tracks()
+        logger.info(f"音楽ライブラリの索引を読み込みました: {self.index_path} ({len(dirs)} ディレクトリ)")
+        return True
+
+    def save(self):
+        """索引をJSONに保存する。次回起動時の走査が差分だけで済むようになるわ。"""
+        if not self.index_path:
+            return
+        with self._lock:
+            data = {
+                "root": self.root,
+                "dirs": {
+                    rel_dir: [mtime_ns, subdirs, [[os.path.basename(t.display_name), t.size, t.mtime_ns, t.gain_db] for t in tracks]]
+                    for rel_dir, (mtime_ns, subdirs, tracks) in self._dirs.items()
+                },
+            }
+        try:
+            os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            logger.error(f"音楽ライブラリの索引を保存できませんでした ({self.index_path}): {e}")
@@ -0,0 +1,46 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\library\loudness.py
+import asyncio
+import logging
+import re
+from config import LOUDNESS_TARGET_LUFS, LOUDNESS_MAX_GAIN_DB, LOUDNESS_ANALYSIS_TIMEOUT
+from core.metrics import FFMPEG_PROCESSES
+
+logger = logging.getLogger(__name__)
+
+# ebur128 フィルタの最後のまとめ ("Summary:" から後ろ) に出る統合ラウドネス (例: "I:         -14.2 LUFS")
+_SUMMARY_MARKER = b"Summary:"
+_INTEGRATED_PATTERN = re.compile(rb"I:\s+(-?\d+(?:\.\d+)?) LUFS")
+
+async def measure_loudness(path: str, timeout: float = LOUDNESS_ANALYSIS_TIMEOUT) -> float | None:
+    """
+    FFmpegの ebur128 フィルタで曲の統合ラウドネス (LUFS, EBU R128) を測る。
+    測れなかったらNoneを返すわ。
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-nostats", "-i", path,
+            "-vn", "-af", "ebur128=framelog=quiet", "-f", "null", "-", # フレームごとのログは出さない (まとめだけ info で出るわ)
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+        )
+    except OSError as e:
+        logger.error(f"ラウドネス測定のためのFFmpegを起動できませんでした: {e}")
+        return None
+    with FFMPEG_PROCESSES.track_inprogress(purpose="loudness"):
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"ラウドネスの測定がタイムアウトしました ({timeout}秒): {path}")
+            process.kill()
+            await process.wait()
+            return None
+    summary_at = stderr.rfind(_SUMMARY_MARKER)
+    match = _INTEGRATED_PATTERN.search(stderr, summary_at) if summary_at >= 0 else None
+    if process.returncode != 0 or match is None:
+        logger.warning(f"ラウドネスを測れませんでした (終了コード {process.returncode}): {path}")
+        return None
+    return float(match.group(1))
+
+def loudness_to_gain_db(loudness: float) -> float:
+    """測ったラウドネスを、目標に揃えるための補正量 (dB) にする"""
+    gain_db = LOUDNESS_TARGET_LUFS - loudness
+    return max(-LOUDNESS_MAX_GAIN_DB, min(LOUDNESS_MAX_GAIN_DB, gain_db))
@@ -0,0 +1,90 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\library\queue.py
+import collections
+import enum
+import itertools
+import random
+from collections.abc import Iterable, Iterator
+from library.index import Track
+
+class RepeatMode(enum.Enum):
+    NONE = 0    # リピートなし
+    ONE = 1     # 現在の曲をリピート
+    ALL = 2     # キュー全体をリピート
+
+class MusicQueue:
+    """
+    ギルドごとの再生待ちキュー。両端の出し入れはdequeなのでO(1)よ。
+    中身はライブラリの Track をそのまま参照するだけなので、パス文字列を複製しないの。
+    """
+    __slots__ = ("_items",)
+
+    def __init__(self, tracks: Iterable[Track] = ()):
+        self._items: collections.deque[Track] = collections.deque(tracks)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __bool__(self) -> bool:
+        return bool(self._items)
+
+    def __iter__(self) -> Iterator[Track]:
+        return iter(self._items)
+
+    def push(self, track: Track):
+        """末尾に追加する"""
+        self._items.append(track)
+
+    def push_front(self, track: Track):
+        """先頭に追加する (1曲リピートなど)"""
+        self._items.appendleft(track)
+
+    def extend(self, tracks: Iterable[Track]):
+        self._items.extend(tracks)
+
+    def pop(self) -> Track | None:
+        """先頭 (次に再生する曲) を取り出す。空ならNone"""
+        return self._items.popleft() if self._items else None
+
+    def pop_back(self) -> Track | None:
+        """末尾を取り出す。空ならNone"""
+        return self._items.pop() if self._items else None
+
+    def peek(self) -> Track | None:
+        return self._items[0] if self._items else None
+
+    def discard(self, track: Track) -> bool:
+        """同じ Track オブジェクトがあれば最初の1つを取り除く。取り除けたらTrue"""
+        for index, item in enumerate(self._items):
+            if item is track:
+                del self._items[index]
+                return True
+        return False
+
+    def clear(self):
+        self._items.clear()
+
+    def shuffle(self):
+        # dequeの途中へのアクセスはO(n)なので、一度リストにしてから混ぜる
+        items = list(self._items)
+        random.shuffle(items)
+        self._items = collections.deque(items)
+
+    def remove(self, index: int) -> Track:
+        """index番目 (0始まり) の曲を取り除いて返す。範囲外なら IndexError"""
+        track = self._items[index]
+        del self._items[index]
+        return track
+
+    def move(self, src: int, dst: int) -> Track:
+        """src番目の曲を dst番目に移動する (0始まり)。範囲外なら IndexError"""
+        if not (0 <= src < len(self._items) and 0 <= dst < len(self._items)):
+            raise IndexError("キューの範囲外よ")
+        track = self._items[src]
+        del self._items[src]
+        self._items.insert(dst, track)
+        return track
+
+    def page(self, page: int, per_page: int) -> list[Track]:
+        """page番目 (0始まり) のページに載る曲"""
+        start = page * per_page
+        return list(itertools.islice(self._items, start, start + per_page))
@@ -0,0 +1,175 @@
+# c:\Users\super\デスクトップ\新宿二丁目のオネエ\library\search.py
+import bisect
+import collections
+import heapq
+import logging
+import os
+import re
+import time
+import unicodedata
+import numpy as np
+from library.index import Track
+
+logger = logging.getLogger(__name__)
+
+FUZZY_MIN_SCORE = 0.3 # あいまい検索で候補に残すバイグラム類似度 (Dice係数) の下限
+
+# カタカナ -> ひらがな (ァ..ヶ を ぁ..ゖ に寄せる)
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+def fold(text: str) -> str:
+    """
+    検索用にテキストを正規化する。
+    全角/半角 (NFKC)・大文字/小文字・カタカナ/ひらがな・パス区切り文字の違いを吸収するわ。
+    """
+    text = unicodedata.normalize("NFKC", text).lower().translate(_KATAKANA_TO_HIRAGANA)
+    return text.replace("\\", "/")
+
+def _bigrams(text: str) -> set[str]:
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+def _stem(display_name: str) -> str:
+    return os.path.splitext(os.path.basename(display_name))[0]
+
+class SearchIndex:
+    """
+    音楽ライブラリの検索索引。ライブラリが変わるたびに作り直して使うの。
+    - 表示名/ファイル名の完全一致は辞書で一発
+    - ファイル名や単語の前方一致はソート済みリストを二分探索 (トライ木の代わりにメモリを食わない形で)
+    - 部分一致とあいまい検索はバイグラムの転置索引をNumPyで数え上げて候補を絞ってから確認するわ
+    """
+    def __init__(self, tracks: list[Track], version: int = 0):
+        started = time.perf_counter()
+        self.tracks = tracks
+        self.version = version
+        self._names = [fold(t.display_name) for t in tracks]
+        self._stems = [fold(_stem(t.display_name)) for t in tracks]
+
+        self._exact_names: dict[str, list[int]] = collections.defaultdict(list)
+        self._exact_stems: dict[str, list[int]] = collections.defaultdict(list)
+        token_entries: list[tuple[str, int]] = []
+        grams: dict[str, list[int]] = collections.defaultdict(list)
+        chars: dict[str, list[int]] = collections.defaultdict(list)
+        gram_counts = []
+        for i, (name, stem) in enumerate(zip(self._names, self._stems)):
+            self._exact_names[name].append(i)
+            self._exact_stems[stem].append(i)
+            token_entries.extend((token, i) for token in set(_TOKEN_PATTERN.findall(name)))
+            name_grams = _bigrams(name)
+            for gram in name_grams:
+                grams[gram].append(i)
+            for char in set(name):
+                chars[char].append(i)
+            gram_counts.append(len(name_grams))
+
+        # 転置索引は曲番号の昇順に並んだ int32 配列で持つ
+        self._grams = {gram: np.array(ids, dtype=np.int32) for gram, ids in grams.items()}
+        self._chars = {char: np.array(ids, dtype=np.int32) for char, ids in chars.items()}
+        self._gram_counts = np.array(gram_counts, dtype=np.float64)
+
+        token_entries.sort()
+        self._tokens = [token for token, _ in token_entries]
+        self._token_ids = [i for _, i in token_entries]
+        stem_entries = sorted((stem, i) for i, stem in enumerate(self._stems))
+        self._sorted_stems = [stem for stem, _ in stem_entries]
+        self._sorted_stem_ids = [i for _, i in stem_entries]
+
+        elapsed = (time.perf_counter() - started) * 1000
+        logger.info(f"音楽の検索索引を作りました: {len(tracks)} 曲, 単語 {len(self._tokens)}, バイグラム {len(self._grams)} ({elapsed:.1f} ms)")
+
+    def _gram_hits(self, query_grams: set[str]) -> np.ndarray | None:
+        """曲ごとに、クエリのバイグラムをいくつ含んでいるかを数える"""
+        postings = [self._grams[g] for g in query_grams if g in self._grams]
+        if not postings:
+            return None
+        return np.bincount(np.concatenate(postings), minlength=len(self.tracks))
+
+    def _substring_matches(self, query: str, hits: np.ndarray | None = None) -> list[int]:
+        """正規化済みクエリを表示名に含む曲 (ライブラリ順)"""
+        if len(query) < 2:
+            ids = self._chars.get(query)
+            return ids.tolist() if ids is not None else []
+        query_grams = _bigrams(query)
+        if any(g not in self._grams for g in query_grams):
+            return []
+        if hits is None:
+            hits = self._gram_hits(query_grams)
+        candidates = np.flatnonzero(hits == len(query_grams)) # すべてのバイグラムを含む曲だけ確認
+        names = self._names
+        return [i for i in candidates.tolist() if query in names[i]]
+
+    def _fuzzy_matches(self, query: str, limit: int, hits: np.ndarray | None = None) -> list[tuple[float, int]]:
+        """バイグラムの重なり具合 (Dice係数) で似ている曲を探す"""
+        query_grams = _bigrams(query)
+        if hits is None:
+            hits = self._gram_hits(query_grams)
+        if hits is None:
+            return []
+        scores = 2 * hits / (len(query_grams) + self._gram_counts)
+        candidates = np.flatnonzero(scores >= FUZZY_MIN_SCORE)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        scored = [(float(scores[i]), i) for i in candidates.tolist()]
+        scored.sort(key=lambda x: (-x[0], x[1]))
+        return scored
+
+    @staticmethod
+    def _prefix_range(sorted_keys: list[str], ids: list[int], query: str) -> list[int]:
+        start = bisect.bisect_left(sorted_keys, query)
+        end = bisect.bisect_left(sorted_keys, query + "\U0010ffff")
+        return ids[start:end]
+
+    def resolve(self, query: str, fuzzy_limit: int = 5) -> list[Track]:
+        """
+        /playmusic 用の検索。優先度の高い順に探して、最初に見つかった段階の候補を返す。
+        1. 表示名 (フォルダパス含む) の完全一致
+        2. ファイル名 (拡張子なし) の完全一致
+        3. 表示名の部分一致
+        4. あいまい一致 (似ている順に最大 fuzzy_limit 件)
+        """
+        q = fold(query.strip())
+        if not q:
+            return []
+        ids = self._exact_names.get(q) or self._exact_stems.get(q)
+        if ids:
+            return [self.tracks[i] for i in ids]
+        hits = self._gram_hits(_bigrams(q)) if len(q) >= 2 else None
+        ids = self._substring_matches(q, hits)
+        if ids:
+            return [self.tracks[i] for i in ids]
+        return [self.tracks[i] for _, i in self._fuzzy_matches(q, fuzzy_limit, hits)]
+
+    def suggest(self, query: str, limit: int = 25) -> list[Track]:
+        """
+        オートコンプリート用に、それっぽい順で曲を並べて返す。
+        完全一致 → ファイル名の前方一致 → 単語の前方一致 → 部分一致 → あいまい一致 の順に、
+        必要な件数が集まったところで打ち切るわ。
+        """
+        q = fold(query.strip())
+        if not q:
+            return self.tracks[:limit]
+        picked: list[int] = []
+        seen: set[int] = set()
+
+        def take(ids) -> bool:
+            for i in ids:
+                if i not in seen:
+                    seen.add(i)
+                    picked.append(i)
+                    if len(picked) >= limit:
+                        return True
+            return False
+
+        if take(self._exact_names.get(q, ())) or take(self._exact_stems.get(q, ())):
+            return [self.tracks[i] for i in picked]
+        if take(self._prefix_range(self._sorted_stems, self._sorted_stem_ids, q)):
+            return [self.tracks[i] for i in picked]
+        token_ids = self._prefix_range(self._tokens, self._token_ids, q)
+        if take(heapq.nsmallest(limit, set(token_ids))):
+            return [self.tracks[i] for i in picked]
+        hits = self._gram_hits(_bigrams(q)) if len(q) >= 2 else None
+        if take(self._substring_matches(q, hits)):
+            return [self.tracks[i] for i in picked]
+        take(i for _, i in self._fuzzy_matches(q, limit, hits))
+        return [self.tracks[i] for i in picked]